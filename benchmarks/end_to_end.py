@@ -0,0 +1,225 @@
+"""
+End-to-end latency benchmark - synthetic key presses run through ControllerApp against local Moode and Spotify
+stand-ins. Reports press-to-backend-call latency and throughput per scenario.
+
+    python3 mpd_control.py bench [scenario ...] [--moode-latency ms] [--spotify-latency ms] [--switch-delay ms]
+                                 [--presses n] [--runtime threads|asyncio]
+"""
+from itertools import islice
+from os import path
+from tempfile import TemporaryDirectory
+from threading import Thread
+from time import monotonic, sleep, time
+from typing import Callable, Dict, List, NamedTuple, Optional
+import argparse
+import json
+import sys
+
+DIR = path.dirname(path.dirname(path.realpath(__file__)))
+sys.path.insert(0, DIR)
+
+from benchmarks.fakes import Call, FakeMoode, FakeSpotify  # noqa: E402
+from dispatch.async_runtime import AsyncRuntime  # noqa: E402
+from handlers.moode import MoodeHandler  # noqa: E402
+from handlers.spotify import SCOPE  # noqa: E402
+from input.keymap import build_code_index  # noqa: E402
+from metrics.histogram import METRICS  # noqa: E402
+from metrics.server import print_snapshot  # noqa: E402
+from mpd_control import Config, ControllerApp  # noqa: E402
+
+# Seconds without new backend calls after which a scenario is considered finished
+SETTLE_TIME = 0.3
+SCENARIO_TIMEOUT = 60.0
+
+
+class Scenario(NamedTuple):
+    name: str
+    key: str
+    command: Dict
+    renderer: str
+    # Backend call that completes a key press
+    match: Callable[[Call], bool]
+    spotify: bool = False
+    # Seconds between presses, None - wait for previous press to finish
+    interval: Optional[float] = None
+    # Number of key presses a backend call carries out (coalesced presses)
+    presses_of: Callable[[Call], int] = lambda call: 1
+
+
+SCENARIOS = [
+    Scenario('volume_burst', 'vol_up', {'target': 'moode', 'command': 'vol_up', 'value': 1, 'coalesce': True},
+             renderer='moode', match=lambda call: 'vol.sh+up' in call.path, interval=0.02,
+             presses_of=lambda call: int(call.path.rsplit('+', 1)[1])),
+    Scenario('renderer_switch', 'play', {'target': 'moode', 'command': 'play'},
+             renderer='airplay', match=lambda call: call.path.endswith('?cmd=play')),
+    Scenario('playlist_load', 'playlist', {'target': 'moode', 'command': 'playlist', 'value': 'Favorites'},
+             renderer='moode', match=lambda call: 'clear_play_item' in call.path, interval=0.1),
+    Scenario('spotify_volume', 'spotify_vol_up', {'target': 'spotify', 'command': 'vol_up', 'value': 5},
+             renderer='spotify', match=lambda call: call.path.startswith('/v1/me/player/volume'), spotify=True,
+             interval=0.02),
+]
+
+
+def percentile(values: List[float], q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+
+class Bench(object):
+
+    def __init__(self, moode: FakeMoode, spotify: FakeSpotify, cache_path, runtime='threads'):
+        self.moode = moode
+        self.spotify = spotify
+
+        config = Config()
+        config.remotes = ['bench']
+        config.enable_ir_remote = False
+        config.enable_usb_remote = False
+        config.runtime = runtime
+        config.moode_url = moode.url
+        config.metrics = {**config.metrics, 'enabled': False}
+        # Synthetic presses come faster than any debounce window
+        config.event_queue = {**config.event_queue, 'debounce': 0}
+        config.logging = {**config.logging, 'level': 'WARNING'}
+        config.spotify = {
+            'redirect_uri': 'http://127.0.0.1/auth',
+            'client_id': 'bench',
+            'client_secret': 'bench',
+            'auth_server_listen_ip': '127.0.0.1',
+            'auth_server_listen_port': 8099,
+            'api_url': spotify.api_url
+        }
+
+        self.app = ControllerApp(config=config, cache_path=cache_path)
+        self.app.wait_ready(timeout=SCENARIO_TIMEOUT)
+
+        keymap = {scenario.key: [{'bench_key': scenario.key}] for scenario in SCENARIOS}
+        self.app.keymap = keymap
+        self.app.code_index = build_code_index(keymap)
+        self.app.commands = {scenario.key: {'global': scenario.command} for scenario in SCENARIOS}
+        self.app.verify_commands()
+
+        self.runtime = AsyncRuntime(self.app) if self.app.use_asyncio else None
+        self.thread = Thread(target=self.runtime.run if self.runtime else self.app.dispatch_events, daemon=True)
+        self.thread.start()
+
+    def _wait_settled(self, server, start):
+        deadline = monotonic() + SCENARIO_TIMEOUT
+        while monotonic() < deadline:
+            calls = server.calls_since(start)
+            idle = self.runtime.idle if self.runtime else self.app.lanes.wait_idle(timeout=0)
+            if not len(self.app.event_queue) and idle and (not calls or monotonic() - calls[-1].time > SETTLE_TIME):
+                return
+            sleep(0.05)
+
+    def _prepare(self, scenario: Scenario):
+        self.moode.set_renderer(scenario.renderer)
+        MoodeHandler().invalidate_cfg_system()
+
+    def run(self, scenario: Scenario, presses: int) -> Dict:
+        server = self.spotify if scenario.spotify else self.moode
+        self._prepare(scenario)
+        self._wait_settled(server, monotonic())
+
+        press_times = []
+        for _ in range(presses):
+            if scenario.interval is None:
+                self._prepare(scenario)
+            press_times.append(monotonic())
+            self.app.event_queue.enqueue({'bench_key': scenario.key})
+
+            if scenario.interval is None:
+                self._wait_settled(server, press_times[-1])
+            else:
+                sleep(scenario.interval)
+        self._wait_settled(server, press_times[0])
+
+        calls = server.calls_since(press_times[0], scenario.match)
+        # Commands of a key run in press order - each call completes the oldest presses not completed yet
+        latencies = []
+        pending = iter(press_times)
+        for call in calls:
+            for press_time in islice(pending, scenario.presses_of(call)):
+                latencies.append(call.time - press_time)
+
+        result = {'scenario': scenario.name, 'presses': presses, 'calls': len(calls),
+                  'missed': presses - len(latencies)}
+        if latencies:
+            result.update({
+                'p50': percentile(latencies, 0.5),
+                'p95': percentile(latencies, 0.95),
+                'p99': percentile(latencies, 0.99),
+                'throughput': presses / max(calls[-1].time - press_times[0], 1e-6)
+            })
+        return result
+
+    def stop(self):
+        self.app.event_queue.stop()
+        self.thread.join()
+        self.app.stop()
+
+
+def _write_token(cache_path):
+    # Valid token in spotipy cache - no authentication flow is started
+    with open(cache_path, 'w') as cache_file:
+        json.dump({'access_token': 'bench', 'token_type': 'Bearer', 'expires_in': 3600, 'scope': ' '.join(SCOPE),
+                   'expires_at': int(time()) + 24 * 3600, 'refresh_token': 'bench'}, cache_file)
+
+
+def _print_result(result):
+    if 'p50' not in result:
+        print(f'{result["scenario"]:<18}{result["presses"]:>8}{result["calls"]:>8}{result["missed"]:>8}   no calls')
+        return
+    print(f'{result["scenario"]:<18}{result["presses"]:>8}{result["calls"]:>8}{result["missed"]:>8}'
+          f'{result["p50"] * 1000:>10.1f}{result["p95"] * 1000:>10.1f}{result["p99"] * 1000:>10.1f}'
+          f'{result["throughput"]:>12.1f}')
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(prog='mpd_control.py bench', description=__doc__.splitlines()[1])
+    parser.add_argument('scenarios', nargs='*',
+                        help=f'scenarios to run, all by default: {", ".join(scenario.name for scenario in SCENARIOS)}')
+    parser.add_argument('--moode-latency', type=float, default=5.0, help='Moode response latency (ms)')
+    parser.add_argument('--spotify-latency', type=float, default=50.0, help='Spotify API response latency (ms)')
+    parser.add_argument('--switch-delay', type=float, default=500.0, help='renderer disconnect duration (ms)')
+    parser.add_argument('--presses', type=int, default=20, help='key presses per scenario')
+    parser.add_argument('--runtime', choices=['threads', 'asyncio'], default='threads')
+    parser.add_argument('--stages', action='store_true', help='print per-stage latency histograms')
+    args = parser.parse_args(argv)
+    unknown = set(args.scenarios) - {scenario.name for scenario in SCENARIOS}
+    if unknown:
+        parser.error(f'unknown scenarios: {", ".join(sorted(unknown))}')
+
+    moode = FakeMoode(latency=args.moode_latency / 1000, switch_delay=args.switch_delay / 1000)
+    spotify = FakeSpotify(moode, latency=args.spotify_latency / 1000)
+    moode.start()
+    spotify.start()
+
+    try:
+        with TemporaryDirectory() as cache_dir:
+            cache_path = path.join(cache_dir, '.cache')
+            _write_token(cache_path)
+            bench = Bench(moode, spotify, cache_path, runtime=args.runtime)
+
+            print(f'{"scenario":<18}{"presses":>8}{"calls":>8}{"missed":>8}'
+                  f'{"p50 ms":>10}{"p95 ms":>10}{"p99 ms":>10}{"presses/s":>12}')
+            try:
+                for scenario in SCENARIOS:
+                    if args.scenarios and scenario.name not in args.scenarios:
+                        continue
+                    METRICS.reset()
+                    _print_result(bench.run(scenario, args.presses))
+                    if args.stages:
+                        print_snapshot(METRICS.snapshot())
+                        print()
+            finally:
+                bench.stop()
+    finally:
+        moode.close()
+        spotify.close()
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,167 @@
+"""
+Local stand-ins for Moode Web API and Spotify Web API with injected latency, used by benchmarks.
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread, Timer
+from time import monotonic, sleep
+from typing import Callable, List, NamedTuple, Optional
+from urllib.parse import urlsplit
+import json
+
+
+class Call(NamedTuple):
+    time: float
+    method: str
+    path: str
+
+
+class FakeServer(object):
+    """
+    Threaded HTTP server recording every request. Each response is delayed by 'latency' seconds.
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls: List[Call] = []
+        self._lock = Lock()
+
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def _handle(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length).decode('utf-8') if length else ''
+                fake.record(self.command, self.path)
+                if fake.latency:
+                    sleep(fake.latency)
+
+                status, payload = fake.respond(self.command, self.path, body)
+                content = json.dumps(payload).encode('utf-8') if payload is not None else b''
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                if self.command != 'HEAD':
+                    self.wfile.write(content)
+
+            do_GET = do_POST = do_PUT = do_HEAD = _handle
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._server.daemon_threads = True
+        self._thread: Optional[Thread] = None
+
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self._server.server_address[1]}/'
+
+    def record(self, method, path):
+        with self._lock:
+            self.calls.append(Call(monotonic(), method, path))
+
+    def calls_since(self, start: float, predicate: Callable[[Call], bool] = lambda call: True) -> List[Call]:
+        with self._lock:
+            return [call for call in self.calls if call.time >= start and predicate(call)]
+
+    def respond(self, method, path, body):
+        return 404, None
+
+    def start(self):
+        self._thread = Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class FakeMoode(FakeServer):
+    """
+    'command/*' endpoints used by MoodeHandler. Disconnecting a renderer takes 'switch_delay' seconds.
+    """
+
+    renderer_flags = {
+        'roonbridge': 'rbactive',
+        'airplay': 'aplactive',
+        'bluetooth': 'btactive',
+        'squeezelite': 'slactive',
+        'spotify': 'spotactive',
+        'input': 'inpactive'
+    }
+
+    def __init__(self, latency=0.0, switch_delay=0.0, spotify_name='Moode Spotify'):
+        super().__init__(latency)
+        self.switch_delay = switch_delay
+        self.spotify_name = spotify_name
+        self.renderer = 'moode'
+        self.mpd_status = {'state': 'stop', 'random': '0', 'repeat': '0', 'song': '0', 'volume': '50'}
+
+    def set_renderer(self, renderer):
+        self.renderer = renderer
+
+    def _cfg_system(self):
+        cfg = {flag: '1' if renderer == self.renderer else '0' for renderer, flag in self.renderer_flags.items()}
+        cfg['spotifyname'] = self.spotify_name
+        return cfg
+
+    def respond(self, method, path, body):
+        url = urlsplit(path)
+        if method == 'HEAD':
+            return 200, None
+
+        if url.path == '/command/cfg-table.php':
+            return 200, self._cfg_system()
+        if url.path == '/command/playback.php':
+            return 200, self.mpd_status
+        if url.path == '/command/queue.php' and url.query == 'cmd=get_playqueue':
+            return 200, [{'file': 'NAS/Music/track.flac'}]
+        if url.path == '/command/renderer.php':
+            Timer(self.switch_delay, self.set_renderer, args=('moode',)).start()
+            return 200, None
+        if url.path.startswith('/command/'):
+            return 200, None
+        return 404, None
+
+
+class FakeSpotify(FakeServer):
+    """
+    Subset of Spotify Web API used by SpotifyHandler, a single device registered by Moode
+    """
+
+    def __init__(self, moode: FakeMoode, latency=0.0):
+        super().__init__(latency)
+        self.moode = moode
+        self.device_id = 'benchdevice'
+        self.volume = 50
+
+    @property
+    def api_url(self) -> str:
+        return self.url + 'v1/'
+
+    def _device(self):
+        return {'id': self.device_id, 'name': self.moode.spotify_name, 'type': 'Speaker',
+                'is_active': self.moode.renderer == 'spotify', 'volume_percent': self.volume}
+
+    def respond(self, method, path, body):
+        url = urlsplit(path)
+        if url.path == '/v1/me/player/devices':
+            return 200, {'devices': [self._device()]}
+        if url.path == '/v1/me/player' and method == 'GET':
+            return 200, {'device': self._device(), 'is_playing': True, 'shuffle_state': False,
+                         'repeat_state': 'off', 'progress_ms': 1000}
+        if url.path == '/v1/me/player' and method == 'PUT':
+            # Transfer - Moode reports Spotify as active renderer
+            self.moode.set_renderer('spotify')
+            return 204, None
+        if url.path == '/v1/me/player/volume':
+            self.volume = int(dict(param.split('=') for param in url.query.split('&'))['volume_percent'])
+            return 204, None
+        if url.path.startswith('/v1/me/player/'):
+            return 204, None
+        if url.path in ['/v1/me/playlists', '/v1/me/albums']:
+            return 200, {'items': [], 'next': None, 'total': 0}
+        return 404, {'error': {'status': 404, 'message': 'Not found'}}
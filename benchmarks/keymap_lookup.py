@@ -0,0 +1,63 @@
+"""
+Micro-benchmark of keymap code lookup: linear scan vs. signature index.
+
+    python3 benchmarks/keymap_lookup.py [rounds]
+"""
+from os import path
+from timeit import timeit
+import json
+import sys
+
+DIR = path.dirname(path.dirname(path.realpath(__file__)))
+sys.path.insert(0, DIR)
+
+from input.keymap import build_code_index, lookup_key  # noqa: E402
+
+KEYMAPS = ['ieast.json', 'default.json', 'usb_keyboard.json']
+
+
+def load_keymaps():
+    keymap = dict()
+    for keymap_name in KEYMAPS:
+        with open(path.join(DIR, 'keymaps', keymap_name), 'r') as keymap_file:
+            for key_name, codes in json.load(keymap_file).items():
+                if isinstance(codes, str):
+                    keymap[key_name] = codes
+                    continue
+                keymap.setdefault(key_name, list())
+                for code in codes:
+                    if code not in keymap[key_name]:
+                        keymap[key_name].append(code)
+    return keymap
+
+
+def linear_lookup(keymap, code):
+    key_name = None
+    for _key, _codes in keymap.items():
+        if isinstance(_codes, str):
+            continue
+        if code in _codes:
+            key_name = _key
+    return key_name
+
+
+def main(rounds=2000):
+    keymap = load_keymaps()
+    events = [code for codes in keymap.values() if not isinstance(codes, str) for code in codes]
+    events.append({'data': 'ffffffff', 'preamble': [16, 8], 'postamble': [1]})     # Unknown code
+
+    index_build = timeit(lambda: build_code_index(keymap), number=max(rounds // 100, 1)) / max(rounds // 100, 1)
+    index = build_code_index(keymap)
+
+    linear = timeit(lambda: [linear_lookup(keymap, code) for code in events], number=rounds)
+    indexed = timeit(lambda: [lookup_key(index, code) for code in events], number=rounds)
+
+    lookups = rounds * len(events)
+    print(f'keymaps: {", ".join(KEYMAPS)} ({len(index)} codes, {len(events)} events/round, {rounds} rounds)')
+    print(f'index build:  {index_build * 1e6:10.2f} us')
+    print(f'linear scan:  {linear / lookups * 1e6:10.2f} us/lookup')
+    print(f'index lookup: {indexed / lookups * 1e6:10.2f} us/lookup')
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 2000)
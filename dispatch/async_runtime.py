@@ -0,0 +1,204 @@
+from dispatch.plan import Operation
+from input.event_queue import QueuedEvent
+from metrics.histogram import METRICS
+from collections import defaultdict, deque
+from time import monotonic
+from typing import Deque, Dict, List, Optional, Set, Tuple
+from logging import getLogger
+import asyncio
+
+
+class _Press(object):
+    """
+    Key press dispatched to a task, waiting for the lock of its first target until it starts
+    """
+    __slots__ = ['key_name', 'operations', 'created', 'discarded']
+
+    def __init__(self, key_name, operations: Tuple[Operation, ...], created: float):
+        self.key_name = key_name
+        self.operations = operations
+        self.created = created
+        self.discarded = False
+
+
+class AsyncRuntime(object):
+    """
+    Runs input sources and command dispatching on a single asyncio event loop.
+
+    Commands for the same target run in the order keys were pressed, while a slow command (renderer disconnect,
+    Spotify call) does not block keys handled by other targets. Presses waiting for a busy target are limited the
+    same way as the event queue - at most 'max_len' per target, expired after 'max_age' seconds and coalesced.
+    """
+
+    def __init__(self, app):
+        self.logger = getLogger('MoodeIrController.AsyncRuntime')
+        self.app = app
+        self.sources = []
+
+        self._wakeup: asyncio.Event = None
+        self._locks: Dict[str, asyncio.Lock] = dict()
+        self._tasks: Set[asyncio.Task] = set()
+        self._dispatching = False
+        # First target -> presses waiting for its lock, in lock order
+        self._waiting: Dict[str, Deque[_Press]] = defaultdict(deque)
+        self.max_len: Optional[int] = app.config.event_queue['max_len']
+        self.max_age: Optional[float] = app.config.event_queue['max_age']
+
+        self.dropped = 0
+        self.expired = 0
+        self.coalesced = 0
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return {'dropped': self.dropped, 'expired': self.expired, 'coalesced': self.coalesced,
+                'waiting': sum(len(waiting) for waiting in self._waiting.values())}
+
+    @property
+    def idle(self) -> bool:
+        # No key press being dispatched and no command running or waiting for its target
+        return not self._dispatching and not self._tasks
+
+    def _create_sources(self) -> List:
+        sources = []
+        if self.app.config.enable_ir_remote:
+            from input.ir import AsyncIrSource
+            source = AsyncIrSource(self.app.event_queue, self.app.config.ir_gpio_pin)
+            source.matcher = self.app.pulse_matcher
+            source.decoder.pin_bound = self.app.is_pin_bound
+            METRICS.register_collector('ir', lambda: source.decoder.stats)
+            sources.append(source)
+        if self.app.config.enable_usb_remote:
+            if self.app.config.usb_backend == 'evdev':
+                from input.evdev_remote import AsyncEvdevSource
+                sources.append(AsyncEvdevSource(self.app.event_queue, self.app.config.keyboard_event_type,
+                                                self.app.config.usb_devices))
+            else:
+                from input.usb_remote import AsyncUsbSource
+                sources.append(AsyncUsbSource(self.app.event_queue, self.app.config.keyboard_event_type))
+        return sources
+
+    def run(self):
+        asyncio.run(self._main())
+
+    async def _main(self):
+        loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self.app.event_queue.on_change = lambda: loop.call_soon_threadsafe(self._wakeup.set)
+
+        self.sources = self._create_sources()
+        METRICS.register_collector('async_dispatch', lambda: self.stats)
+        source_tasks = [asyncio.create_task(source.run()) for source in self.sources]
+
+        try:
+            while self.app.event_queue.is_running:
+                # Set before the event leaves the queue - it is never unaccounted for
+                self._dispatching = True
+                try:
+                    event = self.app.event_queue.pop_event()
+                    if event is not None:
+                        await self._dispatch(event)
+                finally:
+                    self._dispatching = False
+
+                if event is None:
+                    await self._wakeup.wait()
+                    self._wakeup.clear()
+        finally:
+            self.app.event_queue.on_change = None
+            for task in source_tasks:
+                task.cancel()
+            await asyncio.gather(*source_tasks, *self._tasks, return_exceptions=True)
+
+    async def _dispatch(self, event: QueuedEvent):
+        key_name = self.app.lookup_event(event)
+        if key_name not in self.app.commands or not self.app.repeater.accept(key_name, event):
+            return
+
+        # Renderer lookup may need a request to Moode
+        try:
+            if self.app.pending.waiting and await asyncio.to_thread(self.app.defer_event, key_name, event):
+                return
+            operations = await asyncio.to_thread(self.app.select_operations, key_name, event)
+        except Exception as e:
+            self.logger.exception(e)
+            return
+
+        if not operations or self._merge_waiting(key_name, event, operations):
+            return
+
+        press = _Press(key_name, operations, event.timestamp)
+        waiting = self._waiting[operations[0].target]
+        if self.max_len and len(waiting) >= self.max_len:
+            # Oldest waiting press makes room, its task ends once it gets the lock
+            dropped = waiting.popleft()
+            dropped.discarded = True
+            self.dropped += 1
+            self.logger.info(f'Too many presses waiting for {operations[0].target}, dropped "{dropped.key_name}"')
+        waiting.append(press)
+
+        if self.app.repeater.tracks(key_name):
+            self.app.repeater.started(key_name)
+        task = asyncio.create_task(self._execute(press))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def _merge_waiting(self, key_name, event: QueuedEvent, operations: Tuple[Operation, ...]) -> bool:
+        """
+        Coalesce a press into the same key's press still waiting for its target
+
+        :return: True if merged
+        """
+        if len(operations) != 1 or not operations[0].coalesce or event.repeat:
+            return False
+        operation = operations[0]
+
+        waiting = self._waiting[operation.target]
+        if not waiting:
+            return False
+        press = waiting[-1]
+        if press.key_name != key_name or len(press.operations) != 1 or not press.operations[0].coalesce or \
+                press.operations[0].gpio != operation.gpio or event.timestamp - press.created > operation.coalesce:
+            return False
+
+        merged = press.operations[0]
+        press.operations = (merged.with_value(merged.args['value'] + operation.args['value']),)
+        self.coalesced += 1
+        self.logger.debug(f'Coalesced "{key_name}" press with a waiting one')
+        return True
+
+    def _start(self, press: _Press) -> bool:
+        """
+        Called once the press got the lock of its first target
+
+        :return: False if the press must not run - dropped or too old
+        """
+        waiting = self._waiting[press.operations[0].target]
+        if press.discarded:
+            return False
+        waiting.remove(press)
+
+        age = monotonic() - press.created
+        if self.max_age and age > self.max_age:
+            self.expired += 1
+            self.logger.info(f'Stale "{press.key_name}" press expired after {age:.1f}s')
+            return False
+        return True
+
+    async def _execute(self, press: _Press):
+        try:
+            for index in range(len(press.operations)):
+                lock = self._locks.setdefault(press.operations[index].target, asyncio.Lock())
+                async with lock:
+                    if index == 0 and not self._start(press):
+                        return
+                    # Read under the lock - waiting presses are coalesced into
+                    operation = press.operations[index]
+                    self.logger.debug(f"Running command {dict(operation.args)}")
+                    try:
+                        with METRICS.timer('command', key=press.key_name, target=operation.target):
+                            await operation.handler.execute_async(operation.func, operation.args)
+                    except Exception as e:
+                        self.logger.exception(e)
+        finally:
+            if self.app.repeater.tracks(press.key_name):
+                self.app.repeater.finished(press.key_name)
@@ -0,0 +1,221 @@
+from threading import Thread, Condition
+from collections import deque
+from time import monotonic
+from typing import Callable, Deque, Dict, List, Optional, Sequence, Tuple
+from logging import getLogger
+
+
+# (target, function, args)
+Job = Tuple[str, Callable, Sequence]
+
+
+class LaneStats(object):
+
+    def __init__(self):
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        # Jobs not run - pushed out of a full lane, waited longer than max_age, merged into a waiting job
+        self.dropped = 0
+        self.expired = 0
+        self.coalesced = 0
+        self.depth = 0
+        self.max_depth = 0
+        self.total_wait = 0.0
+        self.total_run = 0.0
+        self.max_latency = 0.0
+
+    def as_dict(self) -> Dict:
+        completed = max(self.completed, 1)
+        return {
+            'submitted': self.submitted,
+            'completed': self.completed,
+            'failed': self.failed,
+            'dropped': self.dropped,
+            'expired': self.expired,
+            'coalesced': self.coalesced,
+            'depth': self.depth,
+            'max_depth': self.max_depth,
+            'avg_wait_ms': round(self.total_wait / completed * 1000, 1),
+            'avg_run_ms': round(self.total_run / completed * 1000, 1),
+            'max_latency_ms': round(self.max_latency * 1000, 1),
+        }
+
+
+class LaneJob(object):
+    __slots__ = ['func', 'args', 'chain', 'submitted', 'created', 'on_discard']
+
+    def __init__(self, func: Callable, args: Sequence, chain: Sequence[Job], created: Optional[float],
+                 on_discard: Optional[Callable[[], None]]):
+        self.func = func
+        self.args = args
+        self.chain = chain
+        self.submitted = monotonic()
+        # Time of the key press, None for later commands of a press that already started
+        self.created = created
+        self.on_discard = on_discard
+
+
+class ExecutionLane(Thread):
+    """
+    Worker thread executing commands of a single target strictly in submission order.
+
+    At most 'max_len' jobs wait in the lane, the oldest one is dropped to make room for a new one. A key press
+    that waited longer than 'max_age' seconds is dropped instead of being run.
+    """
+
+    def __init__(self, target: str, dispatcher: 'LaneDispatcher', max_len: Optional[int] = None,
+                 max_age: Optional[float] = None):
+        super().__init__(name=f'lane-{target}', daemon=True)
+        self.logger = getLogger(f'MoodeIrController.Lane.{target}')
+        self.target = target
+        self.dispatcher = dispatcher
+        self.max_len = max_len
+        self.max_age = max_age
+        self.stats = LaneStats()
+
+        self._condition = Condition()
+        self._jobs: Deque[LaneJob] = deque()
+        self._running = True
+
+    def submit(self, func: Callable, args: Sequence, chain: Sequence[Job] = (), created: Optional[float] = None,
+               on_discard: Optional[Callable[[], None]] = None):
+        dropped = None
+        with self._condition:
+            if self.max_len and len(self._jobs) >= self.max_len:
+                dropped = self._jobs.popleft()
+                self.stats.dropped += 1
+            self._jobs.append(LaneJob(func, args, chain, created, on_discard))
+            self.stats.submitted += 1
+            self.stats.depth = len(self._jobs)
+            self.stats.max_depth = max(self.stats.max_depth, self.stats.depth)
+            self._condition.notify()
+
+        if dropped:
+            self.logger.info(f'Lane full, dropped command {dropped.args}')
+            self.dispatcher.discard(dropped)
+
+    def merge(self, match: Callable[[Sequence, Optional[float]], bool], update: Callable[[Sequence], Sequence]) -> bool:
+        """
+        Fold a new command into the newest waiting job if match(args, created) accepts it
+
+        :return: True if merged, the new command must not be submitted then
+        """
+        with self._condition:
+            if not self._jobs or self._jobs[-1].chain or not match(self._jobs[-1].args, self._jobs[-1].created):
+                return False
+            self._jobs[-1].args = update(self._jobs[-1].args)
+            self.stats.coalesced += 1
+            return True
+
+    def stop(self):
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+
+    def run(self):
+        while True:
+            with self._condition:
+                while not self._jobs and self._running:
+                    self._condition.wait()
+                if not self._jobs:
+                    return
+                job = self._jobs.popleft()
+                self.stats.depth = len(self._jobs)
+
+            started = monotonic()
+            if self.max_age and job.created is not None and started - job.created > self.max_age:
+                self.stats.expired += 1
+                self.logger.info(f'Stale command expired after {started - job.created:.1f}s {job.args}')
+                self.dispatcher.discard(job)
+                continue
+
+            self.logger.debug(f"Running command {job.args}")
+            try:
+                job.func(*job.args)
+            except Exception as e:
+                self.stats.failed += 1
+                self.logger.exception(e)
+            finished = monotonic()
+
+            self.stats.completed += 1
+            self.stats.total_wait += started - job.submitted
+            self.stats.total_run += finished - started
+            self.stats.max_latency = max(self.stats.max_latency, finished - job.submitted)
+
+            if job.chain:
+                # Remaining commands of the same key press continue on their own lanes, in order
+                (target, func, args), rest = job.chain[0], job.chain[1:]
+                self.dispatcher.lanes[target].submit(func, args, chain=rest, on_discard=job.on_discard)
+            else:
+                self.dispatcher.chain_done()
+
+
+class LaneDispatcher(object):
+    """
+    One ExecutionLane per handler target. Commands of the same target run in order, different targets in parallel.
+    """
+
+    def __init__(self, targets: Sequence[str], max_len: Optional[int] = None, max_age: Optional[float] = None):
+        self.lanes: Dict[str, ExecutionLane] = {target: ExecutionLane(target, self, max_len=max_len, max_age=max_age)
+                                                for target in targets}
+        for lane in self.lanes.values():
+            lane.start()
+
+        # Key presses (chains) submitted but not finished yet
+        self._pending = 0
+        self._idle = Condition()
+
+    def submit_chain(self, jobs: Sequence[Job], created: Optional[float] = None,
+                     on_discard: Optional[Callable[[], None]] = None):
+        """
+        Submit commands of a single key press. Each one starts only after the previous one finished.
+
+        :param created: time of the key press (monotonic), the press expires after lane's max_age
+        :param on_discard: called if the press is dropped or expires before its last command ran
+        """
+        if not jobs:
+            return
+        with self._idle:
+            self._pending += 1
+        (target, func, args), rest = jobs[0], jobs[1:]
+        self.lanes[target].submit(func, args, chain=rest, created=created, on_discard=on_discard)
+
+    def merge(self, target: str, match: Callable[[Sequence, Optional[float]], bool],
+              update: Callable[[Sequence], Sequence]) -> bool:
+        """
+        Fold a key press into the last press still waiting in the target's lane, see ExecutionLane.merge
+        """
+        return self.lanes[target].merge(match, update)
+
+    def discard(self, job: LaneJob):
+        if job.on_discard:
+            try:
+                job.on_discard()
+            except Exception as e:
+                getLogger('MoodeIrController.LaneDispatcher').exception(e)
+        self.chain_done()
+
+    def submit(self, target: str, func: Callable, args: Sequence):
+        self.submit_chain([(target, func, args)])
+
+    def chain_done(self):
+        with self._idle:
+            self._pending -= 1
+            self._idle.notify_all()
+
+    @property
+    def stats(self) -> Dict[str, Dict]:
+        return {target: lane.stats.as_dict() for target, lane in self.lanes.items()}
+
+    def wait_idle(self, timeout: Optional[float] = None) -> bool:
+        with self._idle:
+            return self._idle.wait_for(lambda: self._pending == 0, timeout)
+
+    def stop(self, timeout: Optional[float] = None):
+        self.wait_idle(timeout)
+        lanes: List[ExecutionLane] = list(self.lanes.values())
+        for lane in lanes:
+            lane.stop()
+        for lane in lanes:
+            lane.join(timeout)
@@ -0,0 +1,110 @@
+from input.event_queue import QueuedEvent
+from collections import deque
+from threading import Condition
+from time import monotonic
+from typing import Dict, Iterable, List, Optional, Tuple
+from logging import getLogger
+
+
+# Max number of key presses held back while their targets initialize
+MAX_PENDING = 20
+# Seconds after which a held back key press is dropped instead of being run once its target is ready
+MAX_PENDING_AGE = 15.0
+
+
+class PendingCommands(object):
+    """
+    Key presses waiting for targets (handlers) that are still initializing. Targets register as ready one by one,
+    presses of other targets are not held back meanwhile.
+    """
+
+    def __init__(self, targets: Iterable[str] = (), max_len=MAX_PENDING, max_age=MAX_PENDING_AGE):
+        self.logger = getLogger('MoodeIrController.PendingCommands')
+        self.max_len = max_len
+        self.max_age = max_age
+
+        self._condition = Condition()
+        self._waiting = set(targets)
+        # (target, event) in arrival order
+        self._events: deque = deque()
+
+        self.deferred = 0
+        self.flushed = 0
+        self.expired = 0
+        self.dropped = 0
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return {'pending': len(self._events), 'waiting_targets': len(self._waiting), 'deferred': self.deferred,
+                'flushed': self.flushed, 'expired': self.expired, 'dropped': self.dropped}
+
+    @property
+    def waiting(self) -> bool:
+        return bool(self._waiting)
+
+    def is_waiting(self, target) -> bool:
+        return target in self._waiting
+
+    def defer(self, target, event: QueuedEvent) -> bool:
+        """
+        Hold a key press back until target is ready
+
+        :return: False if target is ready (or was never expected) - run the press now
+        """
+        with self._condition:
+            if target not in self._waiting:
+                return False
+
+            if len(self._events) >= self.max_len:
+                self._events.popleft()
+                self.dropped += 1
+                self.logger.warning(f'Too many key presses waiting for handlers, oldest one dropped {self.stats}')
+
+            self._events.append((target, event))
+            self.deferred += 1
+            return True
+
+    def _take(self, target) -> Tuple[List[QueuedEvent], int]:
+        events = [event for _target, event in self._events if _target == target]
+        self._events = deque(item for item in self._events if item[0] != target)
+
+        now = monotonic()
+        fresh = [event for event in events if now - event.timestamp <= self.max_age]
+        return fresh, len(events) - len(fresh)
+
+    def ready(self, target) -> List[QueuedEvent]:
+        """
+        Mark target ready
+
+        :return: key presses that waited for it and are not too old to run
+        """
+        with self._condition:
+            self._waiting.discard(target)
+            fresh, expired = self._take(target)
+            self.flushed += len(fresh)
+            self.expired += expired
+            self._condition.notify_all()
+
+        if fresh or expired:
+            self.logger.info(f'"{target}" ready, {len(fresh)} waiting key presses flushed, {expired} expired')
+        return fresh
+
+    def failed(self, target):
+        """
+        Target will never be ready - key presses waiting for it are dropped
+        """
+        with self._condition:
+            self._waiting.discard(target)
+            _fresh, _expired = self._take(target)
+            self.dropped += len(_fresh) + _expired
+            self._condition.notify_all()
+
+    def wait(self, targets: Optional[Iterable[str]] = None, timeout: Optional[float] = None) -> bool:
+        """
+        Block until targets (all by default) are no longer initializing
+
+        :return: False on timeout
+        """
+        with self._condition:
+            return self._condition.wait_for(
+                lambda: not (self._waiting if targets is None else self._waiting & set(targets)), timeout)
@@ -0,0 +1,139 @@
+from handlers.base_handler import BaseActionHandler
+from metrics.histogram import METRICS
+from types import MappingProxyType
+from typing import Any, Callable, Dict, FrozenSet, Mapping, NamedTuple, Optional, Tuple
+from logging import getLogger
+
+
+# Default window (seconds) in which queued presses of a "coalesce" command are merged into one call
+COALESCE_WINDOW = 0.5
+# Key level options of commands/*.json - not renderer names
+KEY_OPTIONS = ['repeat', 'debounce']
+
+
+class Operation(NamedTuple):
+    """
+    Command compiled at load time - a handler operation with its arguments already validated and converted
+    """
+    target: str
+    handler: BaseActionHandler
+    func: Callable[[Mapping], Any]
+    args: Mapping
+    coalesce: Optional[float] = None
+    # Run only for presses received on these IR receiver pins, for all presses when None
+    gpio: Optional[FrozenSet[int]] = None
+
+    def __call__(self):
+        return self.func(self.args)
+
+    def timed(self, key_name: str):
+        with METRICS.timer('command', key=key_name, target=self.target):
+            return self.func(self.args)
+
+    def with_value(self, value) -> 'Operation':
+        return self._replace(args=MappingProxyType({**self.args, 'value': value}))
+
+
+# key name -> renderer (or 'global') -> operations
+DispatchPlan = Mapping[str, Mapping[str, Tuple[Operation, ...]]]
+
+
+def _compile_operation(command: Dict, handlers: Dict[str, BaseActionHandler]) -> Optional[Operation]:
+    assert isinstance(command, dict), f'{command} is not a command'
+    assert 'target' in command, f'\'target\' missing from {command}'
+
+    coalesce = command.get('coalesce')
+    if coalesce is not None:
+        assert isinstance(coalesce, (bool, int, float)), \
+            f'"coalesce" must be a bool or a number of seconds in {command}'
+        assert 'value' in command, f'\'value\' is required by "coalesce" in {command}'
+        coalesce = (COALESCE_WINDOW if coalesce is True else float(coalesce)) or None
+
+    gpio = command.get('gpio')
+    if gpio is not None:
+        gpio = frozenset(gpio if isinstance(gpio, list) else [gpio])
+        assert gpio and all(isinstance(pin, int) and not isinstance(pin, bool) for pin in gpio), \
+            f'"gpio" must be a pin number or a list of them in {command}'
+
+    handler = handlers.get(command['target'])
+    if not handler:
+        return None
+
+    func, args = handler.compile(command)
+    return Operation(command['target'], handler, func, MappingProxyType(args), coalesce, gpio)
+
+
+def compile_plan(commands: Dict[str, Dict], handlers: Dict[str, BaseActionHandler]) -> DispatchPlan:
+    """
+    Compile commands loaded from commands/*.json into an immutable dispatch table
+
+    :raises AssertionError: on invalid command
+    """
+    logger = getLogger('MoodeIrController.DispatchPlan')
+
+    plan = dict()
+    for key_name, renderers in commands.items():
+        key_plan = dict()
+        for renderer, command in renderers.items():
+            if renderer in KEY_OPTIONS:
+                continue
+            commands_list = command if isinstance(command, list) else [command]
+            operations = [_compile_operation(_command, handlers) for _command in commands_list]
+            key_plan[renderer] = tuple(operation for operation in operations if operation)
+
+            if len(key_plan[renderer]) != len(operations):
+                logger.debug(f'"{key_name}" ({renderer}): commands with unavailable targets skipped')
+
+        plan[key_name] = MappingProxyType(key_plan)
+
+    return MappingProxyType(plan)
+
+
+# key name -> renderer (or 'global') -> targets of its commands
+TargetMap = Mapping[str, Mapping[str, Tuple[str, ...]]]
+
+
+def command_targets(commands: Dict[str, Dict]) -> TargetMap:
+    """
+    Targets each key needs per renderer - known without the handlers, unlike the compiled plan
+    """
+    targets = dict()
+    for key_name, renderers in commands.items():
+        targets[key_name] = MappingProxyType({
+            renderer: tuple(_command['target'] for _command in (command if isinstance(command, list) else [command])
+                            if isinstance(_command, dict) and 'target' in _command)
+            for renderer, command in renderers.items() if renderer not in KEY_OPTIONS
+        })
+    return MappingProxyType(targets)
+
+
+def pin_bound_keys(commands: Dict[str, Dict]) -> FrozenSet[str]:
+    """
+    Keys with commands bound to IR receiver pins ("gpio")
+    """
+    return frozenset(key_name for key_name, renderers in commands.items()
+                     for renderer, command in renderers.items() if renderer not in KEY_OPTIONS
+                     for _command in (command if isinstance(command, list) else [command])
+                     if isinstance(_command, dict) and _command.get('gpio') is not None)
+
+
+def select_operations(key_plan: Mapping[str, Tuple[Operation, ...]], renderer: str) -> Tuple[Operation, ...]:
+    if renderer in key_plan:
+        return key_plan[renderer]
+    return key_plan.get('global', ())
+
+
+def filter_gpio(operations: Tuple[Operation, ...], gpio: Optional[int]) -> Tuple[Operation, ...]:
+    """
+    Drop operations bound to other IR receiver pins than the one a press came from
+    """
+    if not any(operation.gpio for operation in operations):
+        return operations
+    return tuple(operation for operation in operations if operation.gpio is None or gpio in operation.gpio)
+
+
+def filter_handled_pins(operations: Tuple[Operation, ...], pins: FrozenSet[int]) -> Tuple[Operation, ...]:
+    """
+    Operations left for a press already handled for other receiver pins - those bound to none of them
+    """
+    return tuple(operation for operation in operations if operation.gpio and not operation.gpio & pins)
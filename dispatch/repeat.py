@@ -0,0 +1,106 @@
+from input.event_queue import QueuedEvent
+from collections import defaultdict
+from threading import Lock
+from typing import Dict, NamedTuple, Optional
+from logging import getLogger
+
+
+class RepeatOptions(NamedTuple):
+    """
+    Key level "repeat" option of commands/*.json
+    """
+    delay: float = 0.4              # Seconds a key has to be held before the first repeat
+    interval: float = 0.25          # Seconds between first repeats
+    min_interval: float = 0.08      # Fastest repeat rate reached by acceleration
+    acceleration: float = 0.85      # Interval multiplier applied after every repeat
+
+
+def parse_repeat_options(value) -> Optional[RepeatOptions]:
+    """
+    :param value: bool or dict with RepeatOptions fields
+    :raises AssertionError: on invalid options
+    """
+    if value is None or value is False:
+        return None
+    if value is True:
+        return RepeatOptions()
+
+    assert isinstance(value, dict), f'"repeat" must be a bool or an object, got {value}'
+    unknown = set(value.keys()) - set(RepeatOptions._fields)
+    assert not unknown, f'Unknown "repeat" options {unknown}'
+    assert all(isinstance(option, (int, float)) and not isinstance(option, bool) for option in value.values()), \
+        f'"repeat" options must be numbers in {value}'
+
+    options = RepeatOptions(**{name: float(option) for name, option in value.items()})
+    assert options.delay >= 0, f'"delay" must not be negative in {value}'
+    assert 0 < options.min_interval <= options.interval, f'"min_interval" must be in (0, interval] in {value}'
+    assert 0 < options.acceleration <= 1, f'"acceleration" must be in (0, 1] in {value}'
+    return options
+
+
+class _Hold(object):
+    __slots__ = ['next_time', 'interval']
+
+    def __init__(self, start: float, options: RepeatOptions):
+        self.next_time = start + options.delay
+        self.interval = options.interval
+
+
+class KeyRepeater(object):
+    """
+    Decide which repeat events of held keys run a command. Keys without "repeat" option ignore them, others repeat
+    at an accelerating rate - and never while the previous command of the key is still running, so a held key can't
+    pile up requests to slow backends.
+    """
+
+    def __init__(self, options: Dict[str, RepeatOptions]):
+        self.logger = getLogger('MoodeIrController.KeyRepeater')
+        self.options = options
+
+        self._holds: Dict[str, _Hold] = dict()
+        self._in_flight: Dict[str, int] = defaultdict(int)
+        self._lock = Lock()
+
+        self.repeated = 0
+        self.suppressed = 0
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return {'repeated': self.repeated, 'suppressed': self.suppressed}
+
+    def tracks(self, key_name) -> bool:
+        return key_name in self.options
+
+    def accept(self, key_name, event: QueuedEvent) -> bool:
+        options = self.options.get(key_name)
+        if not event.repeat:
+            if options:
+                self._holds[key_name] = _Hold(event.timestamp, options)
+            return True
+
+        if options is None:
+            return False
+
+        hold = self._holds.get(key_name)
+        if hold is None:
+            # Press itself was not seen (i.e. keyboard sending presses on key release)
+            hold = self._holds[key_name] = _Hold(event.timestamp, options)
+
+        with self._lock:
+            busy = self._in_flight[key_name] > 0
+        if event.timestamp < hold.next_time or busy:
+            self.suppressed += 1
+            return False
+
+        hold.next_time = event.timestamp + hold.interval
+        hold.interval = max(hold.interval * options.acceleration, options.min_interval)
+        self.repeated += 1
+        return True
+
+    def started(self, key_name):
+        with self._lock:
+            self._in_flight[key_name] += 1
+
+    def finished(self, key_name):
+        with self._lock:
+            self._in_flight[key_name] -= 1
@@ -1,3 +1,6 @@
+from typing import Any, Callable, Dict, Tuple
+
+
 class Singleton(type):
     _instances = {}
 
@@ -14,3 +17,18 @@ class BaseActionHandler(metaclass=Singleton):
 
     def verify(self, command_dict):
         return NotImplementedError
+
+    def compile(self, command_dict) -> Tuple[Callable[[Dict], Any], Dict]:
+        """
+        Validate a command and bind it to the handler operation that runs it
+
+        :return: (function, arguments) - function(arguments) executes the command
+        """
+        self.verify(command_dict)
+        return self.call, command_dict
+
+    async def execute_async(self, func, args):
+        # Handlers without a native coroutine implementation run in a worker thread. asyncio is only loaded by the
+        # asyncio runtime, not on the default threads startup path
+        import asyncio
+        return await asyncio.to_thread(func, args)
@@ -1,8 +1,66 @@
 from handlers.base_handler import BaseActionHandler
-from subprocess import check_output, run, DEVNULL
+from metrics.histogram import METRICS
+from subprocess import check_output, Popen, PIPE, DEVNULL
+from threading import Lock
+from time import monotonic
+from typing import Dict, Optional
+from types import MappingProxyType
+from logging import getLogger
 from re import search
 
 
+AMIXER = 'amixer'
+AMIXER_DEVICE = 'bluealsa'
+# Seconds a read device status (name, volume) stays valid. Volume steps are relative, only mute needs the level.
+STATUS_CACHE_TTL = 5.0
+
+
+class AmixerSession(object):
+    """
+    Long-lived 'amixer -s' process - set commands are piped through its stdin instead of spawning a process each time
+    """
+
+    def __init__(self, device=AMIXER_DEVICE, binary=AMIXER):
+        self.logger = getLogger('MoodeIrController.AmixerSession')
+        self.device = device
+        self.binary = binary
+        self._process: Optional[Popen] = None
+        self._lock = Lock()
+
+    def _start(self):
+        if self._process is not None:
+            self.logger.warning(f'amixer exited ({self._process.returncode}), restarting')
+        self._process = Popen([self.binary, '-q', '-D', self.device, '-s'],
+                              stdin=PIPE, stdout=DEVNULL, stderr=DEVNULL, universal_newlines=True, bufsize=1)
+
+    def send(self, command: str):
+        with self._lock:
+            for _ in range(2):
+                if self._process is None or self._process.poll() is not None:
+                    self._start()
+                try:
+                    self._process.stdin.write(command + '\n')
+                    self._process.stdin.flush()
+                    return
+                except (BrokenPipeError, OSError):
+                    self._process.kill()
+                    self._process.wait()
+
+            self.logger.error(f'Unable to send "{command}" to amixer')
+
+    def read_status(self) -> str:
+        # Reading is not supported in stdin mode
+        with METRICS.timer('backend_call', target='bluetooth'):
+            return check_output([self.binary, '-D', self.device]).decode('utf-8')
+
+    def close(self):
+        with self._lock:
+            if self._process and self._process.poll() is None:
+                self._process.stdin.close()
+                self._process.wait()
+            self._process = None
+
+
 class BluetoothHandler(BaseActionHandler):
 
     # List of command that require a value
@@ -10,24 +68,46 @@ class BluetoothHandler(BaseActionHandler):
 
     def __init__(self):
         self.last_volume = 0
+        self.amixer = AmixerSession()
+
+        self._status: Dict = dict()
+        self._status_time = 0.0
+
+        self.operations = {
+            'vol_up': self._vol_up,
+            'vol_dn': self._vol_dn,
+            'mute': self._mute
+        }
+
+    def _get_device_status(self, refresh=False) -> Dict:
+        if not refresh and monotonic() - self._status_time < STATUS_CACHE_TTL and 'device_name' in self._status:
+            return self._status
 
-    @staticmethod
-    def _get_device_status():
-        output = check_output(['amixer', '-D', 'bluealsa'])
+        output = self.amixer.read_status()
         status = dict()
         if output:
-            match = search(r'Simple mixer control \'(?P<device_name>.*)\',\d\s', output.decode('utf-8'))
+            match = search(r'Simple mixer control \'(?P<device_name>.*)\',\d\s', output)
             if match:
                 status['device_name'] = match.group(1)
-            match = search(r'\[(?P<volume>\d{1,3})%\]', output.decode('utf-8'))
+            match = search(r'\[(?P<volume>\d{1,3})%\]', output)
             if match:
                 status['volume'] = match.group(1)
 
+        self._status = status
+        self._status_time = monotonic()
         return status
 
-    @staticmethod
-    def _send_amixer_command(ctype, device_name, command):
-        run(['amixer', '-D', 'bluealsa', ctype, device_name, command], stdout=DEVNULL)
+    def _set_volume(self, device_status, volume):
+        self.amixer.send(f'sset "{device_status["device_name"]}" {volume}%')
+        device_status['volume'] = str(volume)
+
+    def _step_volume(self, device_status, step: str):
+        # amixer steps from the current level - cached one may be outdated (i.e. volume changed on the phone)
+        self.amixer.send(f'sset "{device_status["device_name"]}" {step}')
+        device_status.pop('volume', None)
+
+    def stop(self):
+        self.amixer.close()
 
     def verify(self, command_dict):
         assert 'command' in command_dict, f'\'command\' missing from {command_dict}'
@@ -39,28 +119,46 @@ class BluetoothHandler(BaseActionHandler):
             assert isinstance(command_dict['value'], str) or isinstance(command_dict['value'], int), \
                 f'\'{command_dict["command"]}\' type({type(command_dict["command"])}) value is not allowed!'
 
+    def compile(self, command_dict):
+        self.verify(command_dict)
+
+        compiled = dict(command_dict)
+        compiled['op'] = self.operations.get(command_dict['command'], self._noop)
+        if command_dict['command'] in self.require_value:
+            compiled['value'] = int(command_dict['value'])
+
+        return self._call, MappingProxyType(compiled)
+
     def call(self, command_dict):
-        command = command_dict['command']
+        func, args = self.compile(command_dict)
+        func(args)
 
+    def _call(self, values):
         # No point in disconnecting renderers since we're only running volume commands
 
         device_status = self._get_device_status()
         if 'device_name' not in device_status:
             return
 
-        if command == 'vol_up':
-            if 'volume' in device_status:
-                vol = min(int(device_status['volume']) + int(command_dict['value']), 100)
-                self._send_amixer_command('sset', device_status['device_name'], f'{vol}%')
-        elif command == 'vol_dn':
-            if 'volume' in device_status:
-                vol = max(int(device_status['volume']) - int(command_dict['value']), 0)
-                self._send_amixer_command('sset', device_status['device_name'], f'{vol}%')
-        elif command == 'mute':
-            if 'volume' in device_status:
-                if self.last_volume == 0:
-                    self.last_volume = device_status['volume']
-                    self._send_amixer_command('sset', device_status['device_name'], '0%')
-                else:
-                    self._send_amixer_command('sset', device_status['device_name'], f'{self.last_volume}%')
-                    self.last_volume = 0
+        values['op'](values, device_status)
+
+    def _noop(self, values, device_status):
+        pass
+
+    def _vol_up(self, values, device_status):
+        self._step_volume(device_status, f'{values["value"]}%+')
+
+    def _vol_dn(self, values, device_status):
+        self._step_volume(device_status, f'{values["value"]}%-')
+
+    def _mute(self, values, device_status):
+        device_status = self._get_device_status(refresh=True)
+        if 'device_name' not in device_status or 'volume' not in device_status:
+            return
+
+        if self.last_volume == 0:
+            self.last_volume = device_status['volume']
+            self._set_volume(device_status, 0)
+        else:
+            self._set_volume(device_status, self.last_volume)
+            self.last_volume = 0
@@ -1,10 +1,21 @@
 from handlers.base_handler import BaseActionHandler
-from typing import Optional
-from time import sleep
+from handlers.moode_session import MoodeSession
+from util.polling import wait_until
+from typing import Optional, Dict, Mapping
+from types import MappingProxyType
+from collections import deque
+from time import monotonic
+from threading import Lock
 from logging import getLogger
 from urllib.parse import quote
 import json
-import requests
+
+
+DEFAULT_URL = 'http://localhost/'
+# Seconds a cached 'get_cfg_system' response stays valid
+CFG_CACHE_TTL = 2.0
+# Max seconds to wait for a renderer to disconnect
+RENDERER_SWITCH_TIMEOUT = 15.0
 
 
 class MoodeHandler(BaseActionHandler):
@@ -12,9 +23,20 @@ class MoodeHandler(BaseActionHandler):
     # List of command that require a value
     require_value = ['vol_up', 'vol_dn', 'playlist', 'radio', 'custom']
 
-    def __init__(self):
+    # Commands that are a single GET request
+    static_commands = {
+        'poweroff': 'system.php?cmd=poweroff',
+        'reboot': 'system.php?cmd=reboot',
+        'play': '?cmd=play',
+        'pause': '?cmd=pause',
+        'next': '?cmd=next',
+        'previous': '?cmd=previous',
+        'mute': '?cmd=vol.sh+mute'
+    }
+
+    def __init__(self, base_url=DEFAULT_URL):
         self.logger = getLogger('MoodeIrController.MoodeHandler')
-        self.base_url = 'http://localhost/'
+        self.base_url = base_url
         self.renderers = {
             'rbactive': 'roonbridge',
             'aplactive': 'airplay',
@@ -34,10 +56,57 @@ class MoodeHandler(BaseActionHandler):
         }
         self.default_set = ""
         self.current_set = ""
-        self._cookies = None
+        self.session = MoodeSession(self.base_url)
+
+        self._cfg_lock = Lock()
+        self._cfg_system: Optional[Dict] = None
+        self._cfg_time = 0.0
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+        # Recently observed renderer switches: (from, to, seconds or None on timeout)
+        self.switch_times = deque(maxlen=50)
+
+        self.operations = {
+            'toggle': self._toggle,
+            'random': self._random,
+            'repeat': self._repeat,
+            'fav-current-item': self._fav_current_item,
+            'vol_up': self._vol_up,
+            'vol_dn': self._vol_dn,
+            'playlist': self._playlist,
+            'radio': self._clear_play,
+            'custom': self._custom
+        }
+
+    @property
+    def cache_stats(self) -> Dict[str, int]:
+        return {'hits': self.cache_hits, 'misses': self.cache_misses}
+
+    @property
+    def switch_stats(self) -> Dict:
+        completed = [elapsed for _, _, elapsed in self.switch_times if elapsed is not None]
+        return {
+            'count': len(self.switch_times),
+            'timeouts': len(self.switch_times) - len(completed),
+            'avg_s': round(sum(completed) / len(completed), 3) if completed else None,
+            'max_s': round(max(completed), 3) if completed else None,
+        }
+
+    def record_switch(self, source, target, elapsed: Optional[float]):
+        self.switch_times.append((source, target, elapsed))
+        if elapsed is None:
+            self.logger.warning(f'Renderer switch {source} -> {target} timed out')
+        else:
+            self.logger.info(f'Renderer switch {source} -> {target} took {elapsed:.2f}s')
+        self.logger.debug(f'Renderer switch stats: {self.switch_stats}')
+
+    def invalidate_cfg_system(self):
+        with self._cfg_lock:
+            self._cfg_system = None
 
-    def get_active_renderer(self) -> Optional[str]:
-        sys_config = self.read_cfg_system()
+    def get_active_renderer(self, max_age: float = CFG_CACHE_TTL) -> Optional[str]:
+        sys_config = self.read_cfg_system(max_age=max_age)
 
         for config_name, player in self.renderers.items():
             if config_name in sys_config and int(sys_config[config_name]) == 1:
@@ -45,9 +114,28 @@ class MoodeHandler(BaseActionHandler):
 
         return 'moode'
 
-    def read_cfg_system(self):
+    def read_cfg_system(self, max_age: float = CFG_CACHE_TTL) -> Dict:
+        """
+        Read Moode system config, served from cache if it is not older than max_age
+
+        :param max_age: float - seconds, 0 forces a new request
+        :return: dict
+        """
+
+        with self._cfg_lock:
+            if self._cfg_system is not None and monotonic() - self._cfg_time < max_age:
+                self.cache_hits += 1
+                return self._cfg_system
+
         response = self._send_command('GET', 'cfg-table.php?cmd=get_cfg_system')
-        return json.loads(response.content.decode('utf-8'))
+        sys_config = json.loads(response.content.decode('utf-8'))
+
+        with self._cfg_lock:
+            self.cache_misses += 1
+            self._cfg_system = sys_config
+            self._cfg_time = monotonic()
+
+        return sys_config
 
     def _read_mpd_status(self):
         response = self._send_command('GET', 'playback.php?cmd=get_mpd_status')
@@ -84,109 +172,129 @@ class MoodeHandler(BaseActionHandler):
             # Make sure nothing else is playing
             response = self._send_command('POST', 'renderer.php?cmd=disconnect-renderer',
                                           data={'job': self.svc_map[active_renderer]})
+            self.invalidate_cfg_system()
 
-            for _ in range(15):     # Max 15s
-                sleep(1)
-                if self.get_active_renderer() == 'moode':
-                    break
-
-            self.logger.info(f"{active_renderer} disconnected")
+            elapsed = wait_until(lambda: self.get_active_renderer(max_age=0) == 'moode',
+                                 timeout=RENDERER_SWITCH_TIMEOUT)
+            self.record_switch(active_renderer, 'moode', elapsed)
+            self.logger.debug(f"cfg_system cache: {self.cache_stats}")
 
             return response
 
-    def _get_cookies(self):
-        if not self._cookies:
-            index = requests.get(self.base_url)
-            self._cookies = index.cookies
-
-        return self._cookies
-
     def _send_command(self, req_type, command, data=None):
         assert req_type in ['GET', 'POST']
 
-        response = None
-        if req_type == 'GET':
-            response = requests.get(self.base_url + 'command/' + command, cookies=self._get_cookies())
-        elif req_type == 'POST':
+        if req_type == 'POST':
             assert data
-            response = requests.post(self.base_url + 'command/' + command, data=data, cookies=self._get_cookies())
+        response = self.session.request(req_type, 'command/' + command, data=data)
 
-        if response and response.status_code != 200:
+        if response is not None and response.status_code != 200:
             self.logger.error(f'{response.status_code}: {response.content}')
 
         return response
 
+    def _compile_values(self, values: Dict) -> Mapping:
+        command = values['command']
+        compiled = dict(values)
+
+        if command in self.static_commands:
+            compiled['path'] = self.static_commands[command]
+            compiled['op'] = self._get_static
+        else:
+            # 'disconnect-renderer' and unknown commands only switch renderer and set
+            compiled['op'] = self.operations.get(command, self._noop)
+
+        if command in ['vol_up', 'vol_dn']:
+            compiled['value'] = int(values['value'])
+        elif command in ['playlist', 'custom']:
+            compiled['path'] = values['value']
+        elif command == 'radio':
+            compiled['path'] = f"RADIO/{values['value']}.pls"
+
+        return MappingProxyType(compiled)
+
+    def compile(self, command_dict):
+        self.verify(command_dict)
+
+        sets = [key for key in command_dict.keys() if key.startswith('set_')]
+        if sets and 'command' not in command_dict:
+            return self._call_set, {
+                'sets': MappingProxyType({_set: self._compile_values(command_dict[_set]) for _set in sets}),
+                'first': sets[0]
+            }
+
+        return self._call_values, self._compile_values(command_dict)
+
     def call(self, command_dict):
-        current_status = self._read_mpd_status()
-        
-        if str(self.current_set) in command_dict:
-            values = command_dict[str(self.current_set)]
-        elif len([key for key in command_dict.keys() if key.startswith('set_')]) > 0 and 'command' not in command_dict:
-            # Current set does not match any of possible sets
-            sets = [key for key in command_dict.keys() if key.startswith('set_')]
-            values = command_dict[sets[0]]
-            self.current_set = sets[0]
+        func, args = self.compile(command_dict)
+        func(args)
+
+    def _call_set(self, args):
+        if str(self.current_set) in args['sets']:
+            values = args['sets'][str(self.current_set)]
         else:
-            values = command_dict
+            # Current set does not match any of possible sets
+            values = args['sets'][args['first']]
+            self.current_set = args['first']
 
-        command = values['command']
-        self.disconnect_renderer(desired_state='moode', command_dict=command_dict)
+        self._call_values(values)
 
-        # Worker commands
-        if command == 'poweroff':
-            self._send_command('GET', 'system.php?cmd=poweroff')
-        elif command == 'reboot':
-            self._send_command('GET', 'system.php?cmd=reboot')
+    def _call_values(self, values):
+        self.disconnect_renderer(desired_state='moode', command_dict=values)
+        values['op'](values)
 
-        # Moode commands
-        elif command == 'play':
-            self._send_command('GET', '?cmd=play')
-        elif command == 'pause':
+    def _noop(self, values):
+        pass
+
+    def _get_static(self, values):
+        self._send_command('GET', values['path'])
+
+    # Moode commands
+    def _toggle(self, values):
+        current_status = self._read_mpd_status()
+        if current_status['state'] == 'play':
             self._send_command('GET', '?cmd=pause')
-        elif command == 'toggle':
-            if current_status['state'] == 'play':
-                self._send_command('GET', '?cmd=pause')
-            else:
-                self._send_command('GET', '?cmd=play')
-        elif command == 'next':
-            self._send_command('GET', '?cmd=next')
-        elif command == 'previous':
-            self._send_command('GET', '?cmd=previous')
-        elif command == 'random':
-            random = (int(current_status['random']) + 1) % 2
-            self._send_command('GET', f'index.php?cmd=random+{random}')
-        elif command == 'repeat':
-            repeat = (int(current_status['repeat']) + 1) % 2
-            self._send_command('GET', f'index.php?cmd=repeat+{repeat}')
-        elif command == 'mute':
-            self._send_command('GET', '?cmd=vol.sh+mute')
-        elif command == 'fav-current-item':
-            response = self._send_command('GET', 'queue.php?cmd=get_playqueue')
-            if response and response.status_code == 200:
-                playlist = json.loads(response.content)
-                if playlist and isinstance(playlist, list) and len(playlist) > int(current_status['song']):
-                    playlist_element = playlist[int(current_status['song'])]
-                    if isinstance(playlist_element, dict) and 'file' in playlist_element:
-                        self._send_command('GET', 'playlist.php?cmd=add_item_to_favorites&item=' +
-                                           quote(playlist_element['file'], safe=''))
-
-        # Commands with values
-        elif command == 'vol_up':
-            self._send_command('GET', '?cmd=vol.sh+up+{value}'.format(value=values['value']))
-        elif command == 'vol_dn':
-            self._send_command('GET', '?cmd=vol.sh+dn+{value}'.format(value=values['value']))
-        elif command == 'playlist':
-            if 'shuffled' in values and values['shuffled'] != bool(int(current_status['random'])):
-                self._send_command('GET', 'index.php?cmd=random+{value}'
-                                   .format(value=1 if values['shuffled'] else 0))
-            self._send_command('POST', 'queue.php?cmd=clear_play_item', data={'path': values['value']})
-        elif command == 'radio':
-            self._send_command('POST', 'queue.php?cmd=clear_play_item',
-                               data={'path': f"RADIO/{values['value']}.pls"})
-
-        elif command == 'custom':
-            # Allow for any other command as defined by user
-            if 'data' in values:
-                self._send_command('POST', values['value'], data=values['data'])
-            else:
-                self._send_command('GET', values['value'])
+        else:
+            self._send_command('GET', '?cmd=play')
+
+    def _random(self, values):
+        random = (int(self._read_mpd_status()['random']) + 1) % 2
+        self._send_command('GET', f'index.php?cmd=random+{random}')
+
+    def _repeat(self, values):
+        repeat = (int(self._read_mpd_status()['repeat']) + 1) % 2
+        self._send_command('GET', f'index.php?cmd=repeat+{repeat}')
+
+    def _fav_current_item(self, values):
+        current_status = self._read_mpd_status()
+        response = self._send_command('GET', 'queue.php?cmd=get_playqueue')
+        if response and response.status_code == 200:
+            playlist = json.loads(response.content)
+            if playlist and isinstance(playlist, list) and len(playlist) > int(current_status['song']):
+                playlist_element = playlist[int(current_status['song'])]
+                if isinstance(playlist_element, dict) and 'file' in playlist_element:
+                    self._send_command('GET', 'playlist.php?cmd=add_item_to_favorites&item=' +
+                                       quote(playlist_element['file'], safe=''))
+
+    # Commands with values
+    def _vol_up(self, values):
+        self._send_command('GET', '?cmd=vol.sh+up+{value}'.format(value=values['value']))
+
+    def _vol_dn(self, values):
+        self._send_command('GET', '?cmd=vol.sh+dn+{value}'.format(value=values['value']))
+
+    def _playlist(self, values):
+        if 'shuffled' in values and values['shuffled'] != bool(int(self._read_mpd_status()['random'])):
+            self._send_command('GET', 'index.php?cmd=random+{value}'
+                               .format(value=1 if values['shuffled'] else 0))
+        self._clear_play(values)
+
+    def _clear_play(self, values):
+        self._send_command('POST', 'queue.php?cmd=clear_play_item', data={'path': values['path']})
+
+    def _custom(self, values):
+        # Allow for any other command as defined by user
+        if 'data' in values:
+            self._send_command('POST', values['path'], data=values['data'])
+        else:
+            self._send_command('GET', values['path'])
@@ -0,0 +1,62 @@
+from metrics.histogram import METRICS
+from requests.adapters import HTTPAdapter
+from threading import Lock
+from logging import getLogger
+import requests
+
+
+# (connect, read) timeouts in seconds - a hung PHP worker must not freeze the dispatcher
+DEFAULT_TIMEOUT = (2.0, 10.0)
+POOL_SIZE = 4
+
+# Responses that mean our PHP session cookie is no longer accepted
+SESSION_ERROR_CODES = [401, 403, 419, 440]
+
+
+class MoodeSession(object):
+    """
+    Keep-alive, connection pooled HTTP session for Moode Web API
+    """
+
+    def __init__(self, base_url, timeout=DEFAULT_TIMEOUT, pool_size=POOL_SIZE):
+        self.logger = getLogger('MoodeIrController.MoodeSession')
+        self.base_url = base_url
+        self.timeout = timeout
+
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+
+        self._lock = Lock()
+        self._bootstrapped = False
+
+    def _bootstrap(self):
+        # HEAD request is enough for PHP to open a session and set its cookie without rendering the whole UI
+        self._session.cookies.clear()
+        self._session.head(self.base_url, timeout=self.timeout, allow_redirects=False)
+        self._bootstrapped = True
+
+    def renew(self):
+        with self._lock:
+            self._bootstrap()
+
+    def request(self, method, path, **kwargs) -> requests.Response:
+        with self._lock:
+            if not self._bootstrapped:
+                self._bootstrap()
+
+        kwargs.setdefault('timeout', self.timeout)
+        # Query string is not part of the label - keeps the number of histograms fixed
+        with METRICS.timer('backend_call', target='moode', endpoint=path.split('?')[0]):
+            response = self._session.request(method, self.base_url + path, **kwargs)
+
+        if response.status_code in SESSION_ERROR_CODES:
+            self.logger.info(f'Session rejected ({response.status_code}), renewing')
+            self.renew()
+            response = self._session.request(method, self.base_url + path, **kwargs)
+
+        return response
+
+    def close(self):
+        self._session.close()
@@ -1,28 +1,176 @@
-from typing import List, Dict
+from typing import List, Dict, Optional, Set
+from types import MappingProxyType
 from handlers.base_handler import BaseActionHandler
-from subprocess import run, DEVNULL
+from metrics.histogram import METRICS
+from concurrent.futures import ThreadPoolExecutor
+from subprocess import Popen, TimeoutExpired, DEVNULL
+from threading import Lock
+from time import monotonic
+from logging import getLogger
+import os
+import signal
+
+
+# Max number of shell commands (or command lists) running at the same time
+MAX_WORKERS = 2
+# Seconds after which a command is killed, can be changed per command with "timeout"
+DEFAULT_TIMEOUT = 30.0
+
+
+def _kill_group(process, sig):
+    """
+    Signal a command together with everything it started - commands run in their own process group
+    """
+    if process.returncode is not None:
+        return
+    try:
+        os.killpg(process.pid, sig)
+    except ProcessLookupError:
+        pass
 
 
 class ShellCommandsHandler(BaseActionHandler):
 
-    def call(self, command_dict: Dict):
+    def __init__(self):
+        self.logger = getLogger('MoodeIrController.ShellCommandsHandler')
+
+        # Command string -> argv, filled by verify()
+        self._parsed: Dict[str, List[str]] = dict()
+        self._executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix='shell')
+
+        self._semaphore: Optional['asyncio.Semaphore'] = None
+        self._tasks: Set['asyncio.Task'] = set()
+
+        # Processes still running (Popen or asyncio.subprocess.Process), terminated by stop()
+        self._processes = set()
+        self._lock = Lock()
+        self._stopped = False
+
+    def _get_commands(self, command_dict: Dict) -> List[List[str]]:
         command = command_dict['command']
 
         if not isinstance(command, list):
             command = [command]
 
+        parsed = []
         for _command in command:
-            parsed = self._parse_command(_command)
-            run(parsed, stdout=DEVNULL)
+            if _command not in self._parsed:
+                self._parsed[_command] = self._parse_command(_command)
+            parsed.append(self._parsed[_command])
+        return parsed
+
+    def _log_result(self, argv: List[str], return_code, start):
+        duration = monotonic() - start
+        METRICS.observe('backend_call', duration, target='shell')
+        if return_code:
+            self.logger.warning(f'{argv} exited with {return_code} after {duration:.2f}s')
+        else:
+            self.logger.debug(f'{argv} finished in {duration:.2f}s')
+
+    def _run(self, commands, timeout: float):
+        for argv in commands:
+            start = monotonic()
+            with self._lock:
+                if self._stopped:
+                    return
+                # New session - 'sh -c' children are killed along with the shell
+                process = Popen(argv, stdout=DEVNULL, start_new_session=True)
+                self._processes.add(process)
+            try:
+                process.wait(timeout=timeout)
+            except TimeoutExpired:
+                _kill_group(process, signal.SIGKILL)
+                process.wait()
+                self.logger.error(f'{argv} killed after {timeout}s timeout')
+                return
+            finally:
+                with self._lock:
+                    self._processes.discard(process)
+            self._log_result(argv, process.returncode, start)
+
+    def compile(self, command_dict):
+        self.verify(command_dict)
+
+        return self._submit, MappingProxyType({
+            'commands': tuple(tuple(argv) for argv in self._get_commands(command_dict)),
+            'timeout': command_dict.get('timeout', DEFAULT_TIMEOUT),
+            'wait': command_dict.get('wait', True)
+        })
+
+    def call(self, command_dict: Dict):
+        func, args = self.compile(command_dict)
+        func(args)
+
+    def _log_failure(self, future):
+        # Commands that are not waited for have nobody else to report their errors
+        if not future.cancelled() and future.exception():
+            self.logger.error(f'Shell command failed: {future.exception()!r}')
+
+    def _submit(self, args):
+        future = self._executor.submit(self._run, args['commands'], args['timeout'])
+        if args['wait']:
+            future.result()
+        else:
+            future.add_done_callback(self._log_failure)
+
+    async def _run_async(self, commands, timeout: float):
+        import asyncio
+
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(MAX_WORKERS)
+
+        async with self._semaphore:
+            for argv in commands:
+                if self._stopped:
+                    return
+                start = monotonic()
+                process = await asyncio.create_subprocess_exec(*argv, stdout=DEVNULL, start_new_session=True)
+                with self._lock:
+                    self._processes.add(process)
+                try:
+                    await asyncio.wait_for(process.wait(), timeout)
+                except asyncio.TimeoutError:
+                    _kill_group(process, signal.SIGKILL)
+                    await process.wait()
+                    self.logger.error(f'{argv} killed after {timeout}s timeout')
+                    return
+                finally:
+                    with self._lock:
+                        self._processes.discard(process)
+                self._log_result(argv, process.returncode, start)
+
+    async def execute_async(self, func, args):
+        import asyncio
+
+        if func != self._submit:
+            return await super(ShellCommandsHandler, self).execute_async(func, args)
+
+        run = self._run_async(args['commands'], args['timeout'])
+        if args['wait']:
+            await run
+        else:
+            task = asyncio.create_task(run)
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+            task.add_done_callback(self._log_failure)
 
     def verify(self, command_dict):
-        command = command_dict['command']
+        self._get_commands(command_dict)
 
-        if not isinstance(command, list):
-            command = [command]
+        if 'timeout' in command_dict:
+            assert isinstance(command_dict['timeout'], (int, float)) and command_dict['timeout'] > 0, \
+                f'"timeout" must be a positive number of seconds in {command_dict}'
+        if 'wait' in command_dict:
+            assert isinstance(command_dict['wait'], bool), f'"wait" must be true or false in {command_dict}'
 
-        for _command in command:
-            self._parse_command(_command)
+    def stop(self):
+        with self._lock:
+            self._stopped = True
+            processes = list(self._processes)
+        for process in processes:
+            self.logger.info(f'Terminating shell command still running (pid {process.pid})')
+            _kill_group(process, signal.SIGTERM)
+        self._executor.shutdown(wait=False, cancel_futures=True)
 
     @staticmethod
     def _parse_command(command: str) -> List[str]:
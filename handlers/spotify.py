@@ -1,18 +1,29 @@
 from handlers.base_handler import BaseActionHandler
 from handlers.spotify_auth import AuthServer
 from handlers.moode import MoodeHandler
+from handlers.spotify_library import SpotifyLibraryIndex, PLAYLIST, ALBUM
+from metrics.histogram import METRICS
+from util.polling import wait_until
 from spotipy.oauth2 import SpotifyOAuth
-from spotipy import Spotify
-from requests.exceptions import ConnectionError
-from time import time, sleep
-from typing import Dict
+from spotipy import Spotify, SpotifyException
+from requests.exceptions import ConnectionError, Timeout
+from time import time, sleep, monotonic
+from typing import Dict, Optional
+from types import MappingProxyType
 from logging import getLogger
+import requests
 
 
 SCOPE = ['user-read-playback-state', 'user-modify-playback-state', 'user-read-currently-playing',
          'user-read-recently-played', 'user-top-read', 'user-read-playback-position', 'playlist-read-private',
          'playlist-read-collaborative', 'user-library-read']
 AUTH_TIMEOUT = 120
+# Max seconds to wait for Moode to report Spotify as active renderer after transferring playback
+TRANSFER_TIMEOUT = 5.0
+# Seconds a cached device name -> id mapping stays valid
+DEVICE_CACHE_TTL = 60.0
+# Seconds cached device status and playback state stay valid
+STATUS_CACHE_TTL = 2.0
 
 
 class AuthenticationException(Exception):
@@ -46,6 +57,8 @@ class SpotifyHandler(BaseActionHandler):
 
     # List of command that require a value
     require_value = ['vol_up', 'vol_dn', 'seek', 'playlist', 'album']
+    # Commands that read current playback state
+    needs_playback = ['toggle', 'shuffle', 'repeat', 'playlist', 'album']
 
     def __init__(self, config: Dict, cache_path):
         self.logger = getLogger('MoodeIrController.SpotifyHandler')
@@ -53,6 +66,29 @@ class SpotifyHandler(BaseActionHandler):
         self.device_id = None
         self.device_name = None
 
+        # Last devices() response by device id, and current_playback() response
+        self._devices: Dict[str, Dict] = dict()
+        self._devices_time = 0.0
+        self._playback: Optional[Dict] = None
+        self._playback_time = 0.0
+        self.library: Optional[SpotifyLibraryIndex] = None
+
+        self.operations = {
+            'toggle': self._toggle,
+            'pause': self._pause,
+            'play': self._play,
+            'next': self._next,
+            'previous': self._previous,
+            'shuffle': self._shuffle,
+            'repeat': self._repeat,
+            'mute': self._mute,
+            'vol_up': self._vol_up,
+            'vol_dn': self._vol_dn,
+            'seek': self._seek,
+            'playlist': self._play_context,
+            'album': self._play_context
+        }
+
         if {'client_id', 'client_secret', 'redirect_uri', 'listen_ip'} <= config.keys() or \
                 False in [bool(value) for value in config.values()]:
             self.logger.error('Spotify config is missing')
@@ -68,17 +104,30 @@ class SpotifyHandler(BaseActionHandler):
             scope=SCOPE
         )
 
-        self.spotify = Spotify(auth_manager=self.spotify_auth)
+        requests_session = requests.Session()
+        requests_session.hooks['response'].append(self._observe_response)
+        self.spotify = Spotify(auth_manager=self.spotify_auth, requests_session=requests_session)
+        if config.get('api_url'):
+            self.spotify.prefix = config['api_url']
+        self.library = SpotifyLibraryIndex(self.spotify, cache_file=cache_path + '-library.json')
+        self.library.load()
 
+        self.spotify_auth.initiated = True
+        self.last_volume = 0
+
+    def prefetch_device(self):
+        """
+        Look up Moode's Spotify device ahead of the first command - commands look it up themselves when it is missing,
+        so startup does not have to wait for this
+        """
+        if not self.library:
+            return
         try:
             self.device_name = MoodeHandler().read_cfg_system()['spotifyname']
             self.device_id = self._get_id(self.device_name)
-        except (TimeoutError, ConnectionError) as e:
+        except (TimeoutError, ConnectionError, Timeout, SpotifyException) as e:
             self.logger.exception(e)
 
-        self.spotify_auth.initiated = True
-        self.last_volume = 0
-
     def stop(self):
         if self.spotify_auth:
             self.spotify_auth.auth_server.close()
@@ -93,8 +142,56 @@ class SpotifyHandler(BaseActionHandler):
             assert isinstance(command_dict['value'], str) or isinstance(command_dict['value'], int), \
                 f'\'{command_dict["command"]}\' type({type(command_dict["command"])}) value is not allowed!'
 
-    def call(self, command_dict):
+        if command_dict['command'] in [PLAYLIST, ALBUM] and self.library:
+            # Library may change at any time - report missing entries but do not refuse to start
+            try:
+                self.library.ensure_refreshed()
+                if not self.library.find(command_dict['command'], command_dict['value']):
+                    self.logger.error(f'{command_dict["command"]} "{command_dict["value"]}" not found in library')
+            except (SpotifyException, ConnectionError, Timeout) as e:
+                self.logger.warning(f'Unable to verify {command_dict["command"]} "{command_dict["value"]}": {e}')
+
+    @staticmethod
+    def _observe_response(response, *_args, **_kwargs):
+        # Track ids in request paths would make labels unbounded, calls are labelled by target only
+        METRICS.observe('backend_call', response.elapsed.total_seconds(), target='spotify')
+
+    def invalidate_devices(self):
+        self._devices = dict()
+        self._devices_time = 0.0
+        self._playback = None
+
+    def compile(self, command_dict):
+        self.verify(command_dict)
+
         command = command_dict['command']
+        compiled = dict(command_dict)
+        # 'transfer-playback' has no operation of its own
+        compiled['op'] = self.operations.get(command)
+        if command in ['vol_up', 'vol_dn', 'seek']:
+            compiled['value'] = int(command_dict['value'])
+
+        return self._run, MappingProxyType(compiled)
+
+    def call(self, command_dict):
+        func, args = self.compile(command_dict)
+        func(args)
+
+    def _run(self, values):
+        try:
+            self._call(values)
+        except SpotifyException as e:
+            if e.http_status != 404:
+                raise
+
+            # Device was restarted or re-registered under a new id
+            self.logger.info(f'Spotify device not found, refreshing devices: {e.msg}')
+            self.invalidate_devices()
+            self.device_id = None
+            self._call(values)
+
+    def _call(self, values):
+        command = values['command']
 
         device_name = MoodeHandler().read_cfg_system()['spotifyname']
         if device_name != self.device_name or not self.device_id:
@@ -113,118 +210,158 @@ class SpotifyHandler(BaseActionHandler):
             self.logger.error('Error when reading device status')
             return
 
-        if not device_status['is_active']:
+        was_active = device_status['is_active']
+        if not was_active:
             self.spotify.transfer_playback(self.device_id, force_play=False)
-            for _ in range(5):
-                sleep(1)
-                if MoodeHandler().get_active_renderer() == 'spotify':
-                    break
-
-        if command == 'transfer-playback':
+            self._playback = None
+            MoodeHandler().invalidate_cfg_system()
+            elapsed = wait_until(lambda: MoodeHandler().get_active_renderer(max_age=0) == 'spotify',
+                                 timeout=TRANSFER_TIMEOUT)
+            MoodeHandler().record_switch('moode', 'spotify', elapsed)
+            device_status['is_active'] = True
+
+        if not values['op']:
             return
 
-        current = self.spotify.current_playback()
-
-        if command == 'toggle':
-            if not current['is_playing']:
-                self.spotify.start_playback(self.device_id)
-            else:
-                self.spotify.pause_playback(self.device_id)
-        elif command == 'pause':
-            self.spotify.pause_playback(self.device_id)
-        elif command == 'play':
-            if device_status['is_active']:
-                self.spotify.start_playback(self.device_id)
-            else:
-                self.spotify.transfer_playback(self.device_id)
-        elif command == 'next':
-            self.spotify.next_track(self.device_id)
-        elif command == 'previous':
-            self.spotify.previous_track(self.device_id)
-        elif command == 'shuffle':
-            self.spotify.shuffle(not current['shuffle_state'], self.device_id)
-        elif command == 'repeat':
-            repeat_values = ["track", "context", "off"]
-            new = (repeat_values.index(current['repeat_state']) + 1) % 3
-            self.spotify.repeat(repeat_values[new], self.device_id)
-        elif command == 'mute':
-            if self.last_volume == 0:
-                self.last_volume = device_status['volume_percent']
-                self.spotify.volume(0, self.device_id)
-            else:
-                self.spotify.volume(self.last_volume, self.device_id)
-                self.last_volume = 0
-
-        # Commands with a value
-        elif command == 'vol_up':
-            self.spotify.volume(min(device_status['volume_percent'] + int(command_dict['value']), 100), self.device_id)
-        elif command == 'vol_dn':
-            self.spotify.volume(max(device_status['volume_percent'] - int(command_dict['value']), 0), self.device_id)
+        if command in self.needs_playback:
+            current = self._current_playback()
         elif command == 'seek':
-            self.spotify.seek_track(int(current['progress_ms']) + int(command_dict['value']), self.device_id)
-        elif command in ['playlist', 'album']:
-            if command == 'playlist':
-                uri, count = self._find_playlist(command_dict['value'])
-            else:
-                uri, count = self._find_user_saved_album(command_dict['value'])
-
-            if uri:
-                # None -> do not change, False -> disable, True -> enabled
-                desired_shuffle_state = command_dict.get('shuffled', None)
-                shuffled = desired_shuffle_state if desired_shuffle_state is not None \
-                    else current.get('shuffle_state', False)
-
-                # librespot is broken
-                # 1. We have to toggle shuffle after start_playback otherwise librespot would not reset seed and we'd
-                #    have same "random" order everytime.
-                # 2. librespot always starts with first track from list so have to switch to next one.
-                #    We can't use "offset" because librespot just ignores every track before offset.
-                # 3. And finally we have to toggle "shuffle" again, otherwise track 1 would always be last on the list.
-                #
-                # It's still broken because librespot seems to only load 50 tracks at first and only shuffle those,
-                # then load another 50 tracks, and another but I have no idea how to workaround this.
-                # This whole code could be shortened to 2 lines if only librespot would fix its shuffle implementation.
-                self.spotify.shuffle(False, self.device_id)
-                self.spotify.start_playback(self.device_id, context_uri=uri)
-                if shuffled:
-                    self.spotify.shuffle(True, self.device_id)      # 1.
-                    self.spotify.next_track(self.device_id)         # 2.
-                    self.spotify.shuffle(False, self.device_id)     # 3.
-                    self.spotify.shuffle(True, self.device_id)
+            # Progress changes all the time, never use cached value
+            current = self._current_playback(max_age=0)
+        else:
+            current = dict()
 
-    def _get_id(self, device_name):
+        values['op'](values, device_status, current, was_active)
+
+    def _toggle(self, values, device_status, current, was_active):
+        if not current['is_playing']:
+            self.spotify.start_playback(self.device_id)
+        else:
+            self.spotify.pause_playback(self.device_id)
+        current['is_playing'] = not current['is_playing']
+
+    def _pause(self, values, device_status, current, was_active):
+        self.spotify.pause_playback(self.device_id)
+        self._update_playback(is_playing=False)
+
+    def _play(self, values, device_status, current, was_active):
+        if was_active:
+            self.spotify.start_playback(self.device_id)
+        else:
+            self.spotify.transfer_playback(self.device_id)
+        self._update_playback(is_playing=True)
+
+    def _next(self, values, device_status, current, was_active):
+        self.spotify.next_track(self.device_id)
+
+    def _previous(self, values, device_status, current, was_active):
+        self.spotify.previous_track(self.device_id)
+
+    def _shuffle(self, values, device_status, current, was_active):
+        self.spotify.shuffle(not current['shuffle_state'], self.device_id)
+        current['shuffle_state'] = not current['shuffle_state']
+
+    def _repeat(self, values, device_status, current, was_active):
+        repeat_values = ["track", "context", "off"]
+        new = (repeat_values.index(current['repeat_state']) + 1) % 3
+        self.spotify.repeat(repeat_values[new], self.device_id)
+        current['repeat_state'] = repeat_values[new]
+
+    def _mute(self, values, device_status, current, was_active):
+        if self.last_volume == 0:
+            self.last_volume = device_status['volume_percent']
+            self._set_volume(device_status, 0)
+        else:
+            self._set_volume(device_status, self.last_volume)
+            self.last_volume = 0
+
+    # Commands with a value
+    def _vol_up(self, values, device_status, current, was_active):
+        self._set_volume(device_status, min(device_status['volume_percent'] + values['value'], 100))
+
+    def _vol_dn(self, values, device_status, current, was_active):
+        self._set_volume(device_status, max(device_status['volume_percent'] - values['value'], 0))
+
+    def _seek(self, values, device_status, current, was_active):
+        self.spotify.seek_track(int(current['progress_ms']) + values['value'], self.device_id)
+
+    def _play_context(self, values, device_status, current, was_active):
+        if values['command'] == PLAYLIST:
+            uri, count = self._find_playlist(values['value'])
+        else:
+            uri, count = self._find_user_saved_album(values['value'])
+
+        if uri:
+            # None -> do not change, False -> disable, True -> enabled
+            desired_shuffle_state = values.get('shuffled', None)
+            shuffled = desired_shuffle_state if desired_shuffle_state is not None \
+                else current.get('shuffle_state', False)
+
+            # librespot is broken
+            # 1. We have to toggle shuffle after start_playback otherwise librespot would not reset seed and we'd
+            #    have same "random" order everytime.
+            # 2. librespot always starts with first track from list so have to switch to next one.
+            #    We can't use "offset" because librespot just ignores every track before offset.
+            # 3. And finally we have to toggle "shuffle" again, otherwise track 1 would always be last on the list.
+            #
+            # It's still broken because librespot seems to only load 50 tracks at first and only shuffle those,
+            # then load another 50 tracks, and another but I have no idea how to workaround this.
+            # This whole code could be shortened to 2 lines if only librespot would fix its shuffle implementation.
+            self.spotify.shuffle(False, self.device_id)
+            self.spotify.start_playback(self.device_id, context_uri=uri)
+            if shuffled:
+                self.spotify.shuffle(True, self.device_id)      # 1.
+                self.spotify.next_track(self.device_id)         # 2.
+                self.spotify.shuffle(False, self.device_id)     # 3.
+                self.spotify.shuffle(True, self.device_id)
+            self._playback = None
+
+    def _set_volume(self, device_status, volume):
+        self.spotify.volume(volume, self.device_id)
+        device_status['volume_percent'] = volume
+
+    def _refresh_devices(self):
         response = self.spotify.devices()
         if 'devices' not in response:
-            return None
+            return
 
-        for device in response['devices']:
+        self._devices = {device['id']: device for device in response['devices']}
+        self._devices_time = monotonic()
+
+    def _find_device_id(self, device_name) -> Optional[str]:
+        for device in self._devices.values():
             if device['name'] == device_name:
                 return device['id']
-
         return None
 
-    def _get_device_status(self):
-        response = self.spotify.devices()
-        if 'devices' not in response:
-            return None
+    def _get_id(self, device_name):
+        if monotonic() - self._devices_time >= DEVICE_CACHE_TTL or not self._find_device_id(device_name):
+            self._refresh_devices()
+        return self._find_device_id(device_name)
 
-        for device in response['devices']:
-            if device['id'] == self.device_id:
-                return device
-        return None
+    def _get_device_status(self) -> Optional[Dict]:
+        if self.device_id not in self._devices or monotonic() - self._devices_time > STATUS_CACHE_TTL:
+            self._refresh_devices()
+        return self._devices.get(self.device_id)
+
+    def _current_playback(self, max_age=STATUS_CACHE_TTL) -> Dict:
+        if self._playback is None or monotonic() - self._playback_time >= max_age:
+            self._playback = self.spotify.current_playback() or dict()
+            self._playback_time = monotonic()
+        return self._playback
+
+    def _update_playback(self, **state):
+        if self._playback is not None:
+            self._playback.update(state)
 
     def _find_playlist(self, name):
-        # TODO: Expand to multiple pages
-        playlists = self.spotify.current_user_playlists()
-        for playlist in playlists['items']:
-            if playlist['name'] == name:
-                return playlist['uri'], playlist['tracks']['total']
+        playlist = self.library.find(PLAYLIST, name)
+        if playlist:
+            return playlist['uri'], playlist['total']
         return None, None
 
     def _find_user_saved_album(self, name):
-        # TODO: Expand to multiple pages
-        albums = self.spotify.current_user_saved_albums()
-        for album in albums['items']:
-            if album['album']['name'] == name:
-                return album['album']['uri'], album['album']['total_tracks']
+        album = self.library.find(ALBUM, name)
+        if album:
+            return album['uri'], album['total']
         return None, None
@@ -0,0 +1,165 @@
+from time import monotonic
+from threading import Lock
+from typing import Dict, Optional
+from logging import getLogger
+from os import path, replace
+import json
+
+
+PAGE_LIMIT = 50
+# Min seconds between refreshes triggered by failed lookups
+MIN_REFRESH_INTERVAL = 60.0
+
+PLAYLIST = 'playlist'
+ALBUM = 'album'
+
+
+def normalize_name(name: str) -> str:
+    return ' '.join(name.casefold().split())
+
+
+class SpotifyLibraryIndex(object):
+    """
+    Index of user playlists and saved albums. Pages through the whole library, is persisted on disk and refreshed
+    incrementally - playlists by 'snapshot_id', albums until the first already known one.
+    """
+
+    def __init__(self, spotify, cache_file):
+        self.logger = getLogger('MoodeIrController.SpotifyLibraryIndex')
+        self.spotify = spotify
+        self.cache_file = cache_file
+
+        # id -> {'name', 'uri', 'total', ('snapshot_id' | 'added_at')}
+        self.items: Dict[str, Dict[str, Dict]] = {PLAYLIST: dict(), ALBUM: dict()}
+        self._by_name: Dict[str, Dict[str, Dict]] = {PLAYLIST: dict(), ALBUM: dict()}
+        self._by_normalized: Dict[str, Dict[str, Dict]] = {PLAYLIST: dict(), ALBUM: dict()}
+
+        self._lock = Lock()
+        self._refresh_time: Optional[float] = None
+
+    def ensure_refreshed(self):
+        # Refresh once per run, disk cache alone may be outdated
+        if self._refresh_time is None:
+            self.refresh()
+
+    def load(self):
+        if not path.exists(self.cache_file):
+            return
+
+        try:
+            with open(self.cache_file, 'r') as cache_file:
+                items = json.load(cache_file)
+            self.items = {PLAYLIST: items.get(PLAYLIST, dict()), ALBUM: items.get(ALBUM, dict())}
+            self._build_lookup()
+        except (ValueError, OSError) as e:
+            self.logger.warning(f'Unable to read library cache: {e}')
+
+    def save(self):
+        tmp_file = self.cache_file + '.tmp'
+        with open(tmp_file, 'w') as cache_file:
+            json.dump(self.items, cache_file)
+        replace(tmp_file, self.cache_file)
+
+    def _build_lookup(self):
+        for kind, items in self.items.items():
+            by_name, by_normalized = dict(), dict()
+            for item in items.values():
+                by_name.setdefault(item['name'], item)
+                by_normalized.setdefault(normalize_name(item['name']), item)
+            self._by_name[kind] = by_name
+            self._by_normalized[kind] = by_normalized
+
+    def _pages(self, page):
+        while page:
+            yield page
+            page = self.spotify.next(page) if page.get('next') else None
+
+    def _refresh_playlists(self) -> int:
+        known = self.items[PLAYLIST]
+        playlists, changed = dict(), 0
+        for page in self._pages(self.spotify.current_user_playlists(limit=PAGE_LIMIT)):
+            for playlist in page['items']:
+                cached = known.get(playlist['id'])
+                if cached and cached['snapshot_id'] == playlist['snapshot_id']:
+                    playlists[playlist['id']] = cached
+                    continue
+
+                changed += 1
+                playlists[playlist['id']] = {
+                    'name': playlist['name'],
+                    'uri': playlist['uri'],
+                    'total': playlist['tracks']['total'],
+                    'snapshot_id': playlist['snapshot_id']
+                }
+
+        changed += len(known.keys() - playlists.keys())
+        self.items[PLAYLIST] = playlists
+        return changed
+
+    def _saved_albums(self):
+        """
+        :return: (saved album, total number of saved albums) newest first, pages are fetched as needed
+        """
+        for page in self._pages(self.spotify.current_user_saved_albums(limit=PAGE_LIMIT)):
+            for saved in page['items']:
+                yield saved, page['total']
+
+    def _refresh_albums(self) -> int:
+        known = self.items[ALBUM]
+        # Cache keeps albums in the order Spotify lists them - newest first
+        known_ids = list(known.keys())
+        known_index = {album_id: index for index, album_id in enumerate(known_ids)}
+        albums, changed = dict(), 0
+        for saved, total in self._saved_albums():
+            album = saved['album']
+            cached = known.get(album['id'])
+            if cached and cached['added_at'] == saved['added_at']:
+                # Albums are only added in front, older ones can only be removed. If the known albums from here on
+                # make up the rest of the count, none of them was removed and the rest is not fetched.
+                rest = known_ids[known_index[album['id']]:]
+                if len(albums) + len(rest) == total and not albums.keys() & set(rest):
+                    albums.update((album_id, known[album_id]) for album_id in rest)
+                    break
+
+            if not cached:
+                changed += 1
+            albums[album['id']] = {
+                'name': album['name'],
+                'uri': album['uri'],
+                'total': album['total_tracks'],
+                'added_at': saved['added_at']
+            }
+
+        changed += len(known.keys() - albums.keys())
+        self.items[ALBUM] = albums
+        return changed
+
+    def refresh(self):
+        with self._lock:
+            start = monotonic()
+            changed = self._refresh_playlists() + self._refresh_albums()
+            self._build_lookup()
+            self._refresh_time = monotonic()
+
+            if changed:
+                self.save()
+            self.logger.info(f'Library refreshed in {self._refresh_time - start:.1f}s: '
+                             f'{len(self.items[PLAYLIST])} playlists, {len(self.items[ALBUM])} albums, '
+                             f'{changed} changed')
+
+    def _lookup(self, kind, name) -> Optional[Dict]:
+        return self._by_name[kind].get(name) or self._by_normalized[kind].get(normalize_name(name))
+
+    def find(self, kind, name) -> Optional[Dict]:
+        """
+        Find a playlist or album by exact, then normalized name. Unknown names trigger a (rate limited) refresh.
+
+        :param kind: PLAYLIST or ALBUM
+        :param name: str
+        :return: dict with 'uri' and 'total' or None
+        """
+        item = self._lookup(kind, name)
+        if item is None and (self._refresh_time is None or monotonic() - self._refresh_time > MIN_REFRESH_INTERVAL):
+            self.refresh()
+            item = self._lookup(kind, name)
+        return item
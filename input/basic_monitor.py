@@ -1,4 +1,4 @@
-from threading import Thread
+from threading import Thread, Event
 
 
 class BasicEventMonitor(Thread):
@@ -7,6 +7,9 @@ class BasicEventMonitor(Thread):
         super().__init__()
         self.queue_handler = queue_handler
         self._running = True
+        self._stopped = Event()
+        # TraceRecorder - raw events are recorded when set
+        self.tracer = None
 
     def run(self):
         raise NotImplementedError
@@ -15,5 +18,14 @@ class BasicEventMonitor(Thread):
     def is_running(self):
         return self._running
 
+    def wait(self, timeout) -> bool:
+        """
+        Sleep that is interrupted by stop()
+
+        :return: bool - True if monitor was stopped
+        """
+        return self._stopped.wait(timeout)
+
     def stop(self):
         self._running = False
+        self._stopped.set()
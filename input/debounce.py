@@ -0,0 +1,76 @@
+from metrics.histogram import METRICS
+from collections import defaultdict
+from threading import Lock
+from typing import Dict, Optional, Tuple
+from logging import getLogger
+
+
+# Seconds after a press in which further presses of the same key are treated as duplicate frames
+DEBOUNCE_WINDOW = 0.15
+# Seconds in which the same code received on another IR receiver pin is the same press seen by several receivers
+CROSS_PIN_WINDOW = 0.2
+
+
+def parse_debounce_window(value) -> Optional[float]:
+    """
+    :param value: key level "debounce" option of commands/*.json - seconds, 0 disables debouncing of the key
+    :raises AssertionError: on invalid value
+    """
+    if value is None:
+        return None
+    assert isinstance(value, (int, float)) and not isinstance(value, bool) and value >= 0, \
+        f'"debounce" must be a non-negative number of seconds, got {value}'
+    return float(value)
+
+
+class Debouncer(object):
+    """
+    Suppress duplicate presses - remotes sending a frame twice per press, or both codes of an alternating pair.
+    Works on key names, so all codes of a key share one window measured from the last accepted press. Keys handled
+    per IR receiver pin have a window per pin.
+    """
+
+    def __init__(self, windows: Dict[str, float], default_window=DEBOUNCE_WINDOW):
+        self.logger = getLogger('MoodeIrController.Debouncer')
+        self.windows = windows
+        self.default_window = default_window
+
+        # (key name, pin) -> time of the last accepted press
+        self._last_press: Dict[Tuple[str, Optional[int]], float] = dict()
+        self._lock = Lock()
+
+        self.suppressed: Dict[str, int] = defaultdict(int)
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return {'suppressed': sum(self.suppressed.values())}
+
+    def window_of(self, key_name) -> float:
+        return self.windows.get(key_name, self.default_window)
+
+    def suppress(self, key_name, timestamp: float, pin: Optional[int] = None) -> bool:
+        """
+        :param key_name: key of a new press (not a repeat), None for unknown codes which are never suppressed
+        :param pin: IR receiver pin of keys with commands bound to pins, None for other keys
+        :return: True if the press duplicates the previous one
+        """
+        if key_name is None:
+            return False
+        window = self.window_of(key_name)
+        if not window:
+            return False
+
+        with self._lock:
+            last_press = self._last_press.get((key_name, pin))
+            if last_press is not None and timestamp - last_press < window:
+                self.suppressed[key_name] += 1
+                gap = timestamp - last_press
+            else:
+                self._last_press[(key_name, pin)] = timestamp
+                return False
+
+        # Gaps of suppressed presses show how far the window can be shortened
+        METRICS.observe('debounce_gap', gap, key=key_name)
+        self.logger.debug(f'Duplicate "{key_name}" press {gap * 1000:.0f}ms after the previous one suppressed, '
+                          f'{self.suppressed[key_name]} so far')
+        return True
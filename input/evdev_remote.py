@@ -0,0 +1,272 @@
+from input.basic_monitor import BasicEventMonitor
+from input.file_watch import Inotify, IN_ATTRIB, IN_CREATE, IN_DELETE, IN_MOVED_FROM, IN_MOVED_TO
+from input.usb_remote import KeyHoldFilter
+from time import monotonic
+from typing import Callable, Dict, List, Optional
+from logging import getLogger
+from os import path
+import errno
+import os
+import selectors
+import struct
+
+
+INPUT_DIR = '/dev/input'
+SYSFS_DIR = '/sys/class/input'
+HOTPLUG_MASK = IN_CREATE | IN_DELETE | IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO
+
+# struct input_event - timeval (two longs), type, code, value
+INPUT_EVENT = struct.Struct('llHHi')
+EV_KEY = 0x01
+# EV_KEY values
+KEY_UP = 0
+KEY_DOWN = 1
+KEY_AUTOREPEAT = 2
+
+# Seconds between device rescans when inotify is not available, also retries devices that could not be opened
+RESCAN_INTERVAL = 5.0
+# Longest time a select may block, bounds how long stop() takes
+WAKE_INTERVAL = 1.0
+
+
+def _read_sysfs(file_name) -> str:
+    try:
+        with open(file_name, 'r') as sysfs_file:
+            return sysfs_file.read().strip()
+    except OSError:
+        return ''
+
+
+class _Device(object):
+    __slots__ = ['path', 'fd', 'name', 'device_id', 'buffer']
+
+    def __init__(self, device_path, fd, name, device_id):
+        self.path = device_path
+        self.fd = fd
+        self.name = name
+        self.device_id = device_id
+        self.buffer = b''
+
+
+class EvdevReader(object):
+    """
+    Key events of input devices read straight from their event device nodes. Devices are limited to 'devices' -
+    names or 'vendor:product' IDs (hex, as shown by lsusb), all devices with keys when empty.
+
+    Opened devices are reported through on_open/on_close so the caller can watch their file descriptors, read() is
+    called once one becomes readable. 'input_dir' and 'sysfs_dir' can point to fake devices (i.e. named pipes).
+    """
+
+    def __init__(self, queue_handler, event_type: str, devices: List[str] = (), input_dir=INPUT_DIR,
+                 sysfs_dir=SYSFS_DIR):
+        self.logger = getLogger('MoodeIrController.EvdevReader')
+        self.queue_handler = queue_handler
+        self.hold = KeyHoldFilter(event_type)
+        self.filters = [device.lower() for device in devices]
+        self.input_dir = input_dir
+        self.sysfs_dir = sysfs_dir
+        # TraceRecorder - raw events are recorded when set
+        self.tracer = None
+
+        self.on_open: Callable[[int], None] = lambda fd: None
+        self.on_close: Callable[[int], None] = lambda fd: None
+
+        # fd -> device
+        self.devices: Dict[int, _Device] = dict()
+        # Devices that did not match filters - not checked again
+        self._ignored = set()
+
+    def _identify(self, node) -> Optional[tuple]:
+        """
+        :return: (name, 'vendor:product') or None if the device is not wanted
+        """
+        device_dir = path.join(self.sysfs_dir, node, 'device')
+        name = _read_sysfs(path.join(device_dir, 'name'))
+        device_id = f'{_read_sysfs(path.join(device_dir, "id", "vendor"))}:' \
+                    f'{_read_sysfs(path.join(device_dir, "id", "product"))}'
+
+        if self.filters:
+            if name.lower() not in self.filters and device_id.lower() not in self.filters:
+                return None
+        else:
+            capabilities = _read_sysfs(path.join(device_dir, 'capabilities', 'ev'))
+            # Unknown capabilities (no sysfs) - device is tried anyway
+            if capabilities and not int(capabilities, 16) & (1 << EV_KEY):
+                return None
+        return name, device_id
+
+    def scan(self):
+        """
+        Open new devices and close those that were removed
+        """
+        try:
+            nodes = {node for node in os.listdir(self.input_dir) if node.startswith('event')}
+        except OSError as e:
+            self.logger.warning(f'Unable to list input devices: {e}')
+            nodes = set()
+
+        for device in list(self.devices.values()):
+            if path.basename(device.path) not in nodes:
+                self.close(device.fd)
+        self._ignored &= nodes
+
+        opened = {path.basename(device.path) for device in self.devices.values()}
+        for node in sorted(nodes - opened - self._ignored):
+            identity = self._identify(node)
+            if identity is None:
+                self._ignored.add(node)
+                continue
+
+            device_path = path.join(self.input_dir, node)
+            try:
+                fd = os.open(device_path, os.O_RDONLY | os.O_NONBLOCK)
+            except OSError as e:
+                # Permissions are often set a moment after the node appears, next scan tries again
+                self.logger.debug(f'Unable to open {device_path}: {e}')
+                continue
+
+            name, device_id = identity
+            self.devices[fd] = _Device(device_path, fd, name, device_id)
+            self.logger.info(f'Listening to "{name}" ({device_id}) on {device_path}')
+            self.on_open(fd)
+
+    def close(self, fd):
+        device = self.devices.pop(fd, None)
+        if device is None:
+            return
+        self.on_close(fd)
+        os.close(fd)
+        self.logger.info(f'"{device.name}" ({device.path}) closed')
+
+    def close_all(self):
+        for fd in list(self.devices.keys()):
+            self.close(fd)
+
+    def read(self, fd):
+        device = self.devices.get(fd)
+        if device is None:
+            return
+
+        try:
+            data = os.read(fd, INPUT_EVENT.size * 64)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            if e.errno != errno.ENODEV:
+                self.logger.warning(f'Error reading {device.path}: {e}')
+            self.close(fd)
+            return
+        if not data:
+            # Writer of a pipe went away
+            self.close(fd)
+            return
+
+        data = device.buffer + data
+        end = len(data) - len(data) % INPUT_EVENT.size
+        device.buffer = data[end:]
+        for _sec, _usec, event_type, code, value in INPUT_EVENT.iter_unpack(data[:end]):
+            if event_type == EV_KEY:
+                self._on_key(code, 'up' if value == KEY_UP else 'down')
+
+    def _on_key(self, scan_code, event_type):
+        if self.tracer:
+            self.tracer.record('usb', 'scan', [scan_code, event_type])
+
+        repeat = self.hold.classify(scan_code, event_type)
+        if repeat is None:
+            return
+
+        if not repeat:
+            self.logger.debug(f'Received code {scan_code}')
+        self.queue_handler.enqueue(scan_code, repeat=repeat)
+
+
+def _hotplug_watch(input_dir) -> Optional[Inotify]:
+    try:
+        return Inotify([input_dir], HOTPLUG_MASK)
+    except (OSError, AttributeError) as e:
+        getLogger('MoodeIrController.EvdevReader').info(f'inotify not available, rescanning devices: {e}')
+        return None
+
+
+class EvdevRemoteMonitor(BasicEventMonitor):
+    """
+    USB remote monitor reading input devices in a single selector loop, scan codes go straight to the event queue
+    """
+
+    def __init__(self, queue_handler, event_type: str, devices: List[str] = (), input_dir=INPUT_DIR,
+                 sysfs_dir=SYSFS_DIR):
+        self.logger = getLogger('MoodeIrController.EvdevRemoteMonitor')
+        self.reader = EvdevReader(queue_handler, event_type, devices, input_dir=input_dir, sysfs_dir=sysfs_dir)
+        super(EvdevRemoteMonitor, self).__init__(queue_handler=queue_handler)
+
+    @property
+    def tracer(self):
+        return self.reader.tracer
+
+    @tracer.setter
+    def tracer(self, tracer):
+        self.reader.tracer = tracer
+
+    def run(self):
+        selector = selectors.DefaultSelector()
+        hotplug = _hotplug_watch(self.reader.input_dir)
+        if hotplug:
+            selector.register(hotplug.fileno(), selectors.EVENT_READ, hotplug)
+        self.reader.on_open = lambda fd: selector.register(fd, selectors.EVENT_READ)
+        self.reader.on_close = selector.unregister
+
+        try:
+            self.reader.scan()
+            next_scan = monotonic() + RESCAN_INTERVAL
+            while self.is_running:
+                for key, _ in selector.select(timeout=WAKE_INTERVAL):
+                    if hotplug and key.data is hotplug:
+                        hotplug.read_names()
+                        self.reader.scan()
+                    else:
+                        self.reader.read(key.fd)
+
+                if monotonic() >= next_scan:
+                    self.reader.scan()
+                    next_scan = monotonic() + RESCAN_INTERVAL
+        finally:
+            self.reader.close_all()
+            if hotplug:
+                hotplug.close()
+            selector.close()
+
+
+class AsyncEvdevSource(object):
+    """
+    USB remote input for the asyncio runtime - device file descriptors are watched by the event loop itself
+    """
+
+    def __init__(self, queue_handler, event_type: str, devices: List[str] = (), input_dir=INPUT_DIR,
+                 sysfs_dir=SYSFS_DIR):
+        self.reader = EvdevReader(queue_handler, event_type, devices, input_dir=input_dir, sysfs_dir=sysfs_dir)
+
+    async def run(self):
+        import asyncio
+
+        loop = asyncio.get_running_loop()
+        hotplug = _hotplug_watch(self.reader.input_dir)
+
+        def _on_hotplug():
+            hotplug.read_names()
+            self.reader.scan()
+
+        if hotplug:
+            loop.add_reader(hotplug.fileno(), _on_hotplug)
+        self.reader.on_open = lambda fd: loop.add_reader(fd, self.reader.read, fd)
+        self.reader.on_close = loop.remove_reader
+
+        try:
+            while True:
+                self.reader.scan()
+                await asyncio.sleep(RESCAN_INTERVAL)
+        finally:
+            self.reader.close_all()
+            if hotplug:
+                loop.remove_reader(hotplug.fileno())
+                hotplug.close()
@@ -1,39 +1,163 @@
 from threading import Condition
+from collections import deque
+from time import monotonic
+from typing import Any, Callable, NamedTuple, Optional, Dict, List
+from logging import getLogger
 
 
 MAX_QUEUE_LEN = 10
+# Seconds after which a queued event is considered stale and dropped
+MAX_EVENT_AGE = 5.0
+
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+
+
+class QueuedEvent(NamedTuple):
+    item: Any
+    timestamp: float
+    priority: int
+    # Generated by a held key (IR repeat frame, keyboard autorepeat) rather than a new press
+    repeat: bool = False
+    # GPIO pin of the IR receiver that got the code, None for other inputs
+    gpio: Optional[int] = None
 
 
 class Queue:
 
-    def __init__(self):
+    def __init__(self, max_len=MAX_QUEUE_LEN, max_age=MAX_EVENT_AGE,
+                 priority_of: Optional[Callable[[Any], int]] = None,
+                 is_duplicate: Optional[Callable[[Any, float, Optional[int]], bool]] = None):
+        self.logger = getLogger('MoodeIrController.Queue')
         self._condition = Condition()
-        self._queue = list()
+        self._lanes = (deque(), deque())     # One lane per priority, PRIORITY_HIGH first
         self._running = True
 
+        self.max_len = max_len
+        self.max_age = max_age
+        self.priority_of = priority_of
+        # Debounce stage - (item, timestamp, gpio) -> True for duplicate presses which are not queued
+        self.is_duplicate = is_duplicate
+
+        self.dropped = 0
+        self.expired = 0
+        self.collapsed = 0
+
+        # Called (from the enqueuing thread) whenever queue state changes - used by the asyncio runtime to wake up
+        self.on_change: Optional[Callable[[], None]] = None
+
     @property
     def is_running(self):
         return self._running
 
+    @property
+    def stats(self) -> Dict[str, int]:
+        return {'queued': len(self), 'dropped': self.dropped, 'expired': self.expired, 'collapsed': self.collapsed}
+
+    def __len__(self):
+        return sum(len(lane) for lane in self._lanes)
+
     def stop(self):
-        self._running = False
+        with self._condition:
+            self._running = False
+            self._condition.notify_all()
+        if self.on_change:
+            self.on_change()
+
+    def enqueue(self, item, *args, priority: Optional[int] = None, repeat=False, gpio: Optional[int] = None,
+                **kwargs):
+        timestamp = monotonic()
+        if not repeat and self.is_duplicate and self.is_duplicate(item, timestamp, gpio):
+            return
+
+        if priority is None:
+            priority = self.priority_of(item) if self.priority_of else PRIORITY_NORMAL
 
-    def enqueue(self, item, *args, **kwargs):
         with self._condition:
-            # Do not queue too many commands at the same time
-            if len(self._queue) < MAX_QUEUE_LEN:
-                self._queue.append(item)
+            lane = self._lanes[priority]
+            if repeat and lane and lane[-1].repeat and lane[-1].item == item:
+                # Key is still held and its last repeat was not handled yet - one waiting repeat is enough
+                self.collapsed += 1
+                return
+
+            # Do not queue too many commands at the same time - oldest, least important event makes room
+            if len(self) >= self.max_len:
+                victim = max(_priority for _priority, _lane in enumerate(self._lanes) if _lane)
+                self.dropped += 1
+                if victim < priority:
+                    # Only more important events are queued - the new one is dropped instead
+                    self.logger.warning(f'Event queue full, new event dropped {self.stats}')
+                    return
+                self._lanes[victim].popleft()
+                self.logger.warning(f'Event queue full, oldest event dropped {self.stats}')
+
+            lane.append(QueuedEvent(item, timestamp, priority, repeat, gpio))
             self._condition.notify()
+        if self.on_change:
+            self.on_change()
 
-    def dequeue(self):
+    def _pop(self) -> Optional[QueuedEvent]:
+        now = monotonic()
+        for lane in self._lanes:
+            while lane:
+                event = lane.popleft()
+                if self.max_age and now - event.timestamp > self.max_age:
+                    self.expired += 1
+                    self.logger.info(f'Stale event expired after {now - event.timestamp:.1f}s {self.stats}')
+                    continue
+                return event
+        return None
+
+    def requeue(self, events: List[QueuedEvent]):
+        """
+        Put events that were held back outside of the queue in front of their lanes, in original order. They are not
+        debounced again and their age starts over.
+        """
+        if not events:
+            return
+        now = monotonic()
+        with self._condition:
+            for event in reversed(events):
+                self._lanes[event.priority].appendleft(event._replace(timestamp=now))
+            self._condition.notify()
+        if self.on_change:
+            self.on_change()
+
+    def pop_event(self) -> Optional[QueuedEvent]:
+        """
+        Non-blocking dequeue_event()
+        """
         with self._condition:
-            while not self.has_more() and self.is_running:
-                self._condition.wait(timeout=1.0)
+            return self._pop()
 
-            if not self.has_more():
-                return None
-            return self._queue.pop(0)
+    def dequeue_event(self) -> Optional[QueuedEvent]:
+        with self._condition:
+            while self.is_running:
+                event = self._pop()
+                if event:
+                    return event
+                self._condition.wait()
+            return None
+
+    def take_while(self, predicate: Callable[[QueuedEvent], bool], priority=PRIORITY_NORMAL) -> List[QueuedEvent]:
+        """
+        Remove and return consecutive events from the head of a lane as long as they match predicate
+
+        :param predicate: callable(QueuedEvent) -> bool
+        :param priority: int - lane to take events from
+        :return: list of events
+        """
+        taken = []
+        with self._condition:
+            lane = self._lanes[priority]
+            while lane and predicate(lane[0]):
+                taken.append(lane.popleft())
+        return taken
+
+    def dequeue(self):
+        event = self.dequeue_event()
+        return event.item if event else None
 
     def has_more(self) -> bool:
         with self._condition:
-            return len(self._queue) > 0
+            return len(self) > 0
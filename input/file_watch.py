@@ -0,0 +1,177 @@
+from ctypes.util import find_library
+from threading import Event, Thread
+from typing import Callable, Dict, List, Optional, Tuple
+from logging import getLogger
+from os import path
+import ctypes
+import os
+import select
+import struct
+
+
+# inotify(7) flags
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+# struct inotify_event header - wd, mask, cookie, len
+EVENT_HEADER = struct.Struct('iIII')
+
+# Seconds without further changes before the callback runs - editors write files in several steps
+SETTLE_TIME = 0.3
+# Seconds between mtime checks when inotify is not available
+POLL_INTERVAL = 2.0
+# Longest time a blocking inotify read may take, bounds how long stop() takes
+WAKE_INTERVAL = 1.0
+
+
+class Inotify(object):
+    """
+    Minimal inotify binding through ctypes
+
+    :raises OSError: when inotify is not available
+    """
+
+    def __init__(self, directories: List[str], mask=WATCH_MASK):
+        libc_name = find_library('c')
+        if not libc_name:
+            raise OSError('libc not found')
+        libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError('inotify is not supported')
+
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+
+        for directory in directories:
+            if libc.inotify_add_watch(self.fd, os.fsencode(directory), mask) < 0:
+                errno = ctypes.get_errno()
+                os.close(self.fd)
+                raise OSError(errno, f'inotify_add_watch failed for {directory}')
+
+    def fileno(self) -> int:
+        return self.fd
+
+    def read(self, timeout: float) -> List[str]:
+        """
+        :return: names of changed files, empty list on timeout
+        """
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        return self.read_names()
+
+    def read_names(self) -> List[str]:
+        """
+        Non-blocking read of pending events
+
+        :return: names of changed files
+        """
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+
+        names = []
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(data):
+            _wd, _mask, _cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            names.append(data[offset:offset + length].rstrip(b'\0').decode('utf-8', 'replace'))
+            offset += length
+        return names
+
+    def close(self):
+        os.close(self.fd)
+
+
+class FileWatcher(Thread):
+    """
+    Call 'callback' (from the watcher thread) once files with one of 'suffixes' in 'directories' stop changing.
+    Uses inotify, falls back to polling modification times where it is not available.
+    """
+
+    def __init__(self, directories: List[str], callback: Callable[[], None], suffixes: Tuple[str, ...] = ('.json',),
+                 settle_time=SETTLE_TIME, poll_interval=POLL_INTERVAL, use_inotify=True):
+        super().__init__(name='file-watch', daemon=True)
+        self.logger = getLogger('MoodeIrController.FileWatcher')
+        self.directories = directories
+        self.callback = callback
+        self.suffixes = suffixes
+        self.settle_time = settle_time
+        self.poll_interval = poll_interval
+
+        self._stopped = Event()
+        self._inotify: Optional[Inotify] = None
+        if use_inotify:
+            try:
+                self._inotify = Inotify(directories)
+            except (OSError, AttributeError) as e:
+                self.logger.info(f'inotify not available, polling for changes: {e}')
+
+        self._mtimes = self._scan()
+
+    @property
+    def mode(self) -> str:
+        return 'inotify' if self._inotify else 'polling'
+
+    def stop(self):
+        self._stopped.set()
+
+    def _scan(self) -> Dict[str, Tuple[int, int]]:
+        mtimes = dict()
+        for directory in self.directories:
+            try:
+                names = os.listdir(directory)
+            except OSError:
+                continue
+            for name in names:
+                if not name.endswith(self.suffixes):
+                    continue
+                try:
+                    stat = os.stat(path.join(directory, name))
+                except OSError:
+                    continue
+                mtimes[path.join(directory, name)] = (stat.st_mtime_ns, stat.st_size)
+        return mtimes
+
+    def _changed(self, timeout: float) -> bool:
+        if self._inotify:
+            return any(name.endswith(self.suffixes) for name in self._inotify.read(timeout))
+
+        if self._stopped.wait(timeout):
+            return False
+        mtimes = self._scan()
+        if mtimes == self._mtimes:
+            return False
+        self._mtimes = mtimes
+        return True
+
+    def run(self):
+        self.logger.debug(f'Watching {", ".join(self.directories)} ({self.mode})')
+        try:
+            while not self._stopped.is_set():
+                if not self._changed(WAKE_INTERVAL if self._inotify else self.poll_interval):
+                    continue
+
+                # Wait until writing is finished
+                while not self._stopped.is_set() and self._changed(self.settle_time):
+                    pass
+                if self._stopped.is_set():
+                    break
+
+                try:
+                    self.callback()
+                except Exception as e:
+                    self.logger.exception(e)
+        finally:
+            if self._inotify:
+                self._inotify.close()
+                self._inotify = None
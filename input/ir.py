@@ -1,58 +1,284 @@
 from input.basic_monitor import BasicEventMonitor
+from input.debounce import CROSS_PIN_WINDOW
+from metrics.histogram import METRICS
 from piir.decode import decode
-from time import sleep
+from collections import defaultdict
+from queue import Queue, Empty
+from time import monotonic
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
 from logging import getLogger
 import pigpio
 
 
-class IrMonitor(BasicEventMonitor):
+# pigpio watchdog reports a timeout every 'timeout' ms while the line is idle, so a connection that stays silent
+# for this long (seconds) is considered dead
+HEARTBEAT_TIMEOUT = 5.0
+RECONNECT_DELAY = 1.0
+MAX_RECONNECT_DELAY = 30.0
+# Spaces at least this long (us) separate frames of a held key (same as PiIR 'min_gap')
+FRAME_GAP = 15000
 
-    def __init__(self, queue_handler, ir_gpio_pin):
-        self.logger = getLogger('MoodeIrController.IrMonitor')
-        self.ir_gpio_pin = ir_gpio_pin
-        super(IrMonitor, self).__init__(queue_handler=queue_handler)
 
-    def receive(self, gpio, glitch=100, timeout=200):
-        last_tick = 0
-        in_code = False
-        recording = False
-        pulses = []
-
-        def callback(_gpio, _level, _tick):
-            nonlocal last_tick, in_code, recording
-            usec = pigpio.tickDiff(last_tick, _tick)
-            last_tick = _tick
-            if _level == pigpio.TIMEOUT:
-                if in_code:
-                    in_code = False
-                    recording = False
+class IrPin(NamedTuple):
+    gpio: int
+    glitch: int = 100       # Edges closer than this (us) are ignored
+    timeout: int = 200      # Idle time (ms) that ends a pulse train
+
+
+def parse_ir_pins(value) -> List[IrPin]:
+    """
+    :param value: "ir_gpio_pin" of config.json - a pin number, {"pin": .., "glitch": .., "timeout": ..} or a list
+        of those
+    :raises AssertionError: on invalid value
+    """
+    if value is None:
+        return []
+
+    pins = []
+    for item in (value if isinstance(value, list) else [value]):
+        if isinstance(item, dict):
+            assert 'pin' in item, f'\'pin\' missing from {item}'
+            assert not set(item.keys()) - {'pin', 'glitch', 'timeout'}, f'Unknown IR pin options in {item}'
+            pin = IrPin(item['pin'], **{key: value for key, value in item.items() if key != 'pin'})
+        else:
+            pin = IrPin(item)
+        assert all(isinstance(field, int) and not isinstance(field, bool) and field >= 0 for field in pin), \
+            f'IR pin settings must be non-negative integers, got {item}'
+        pins.append(pin)
+
+    assert len({pin.gpio for pin in pins}) == len(pins), f'Same GPIO pin configured twice in {value}'
+    return pins
+
+
+class _PinState(object):
+    __slots__ = ['last_tick', 'in_code', 'pulses', 'code_start', 'repeat']
+
+    def __init__(self):
+        self.last_tick = 0
+        self.in_code = False
+        self.pulses: List[int] = []
+        self.code_start = 0.0
+        self.repeat = False
+
+
+class IrReceiver(object):
+    """
+    Long-lived pigpio connection with a callback per receiver pin. Complete pulse trains are handed over to
+    receive(), tagged with the pin they were received on.
+
+    While a key is held the remote keeps sending (repeat) frames without the line going idle. Each of them is handed
+    over as soon as the next one starts, marked as 'repeat'.
+    """
+
+    def __init__(self, pins: List[IrPin], pigpio_module=pigpio):
+        self.logger = getLogger('MoodeIrController.IrReceiver')
+        self.pins: Dict[int, IrPin] = {pin.gpio: pin for pin in pins}
+        self._pigpio = pigpio_module
+
+        self._pi = None
+        self._callbacks = []
+        self._frames: Queue = Queue()
+        # Alternative to receive() - called from pigpio callback thread with every complete pulse train
+        self.on_frame: Optional[Callable[[List[int], bool, int], None]] = None
+
+        self._last_seen = 0.0
+        self._states: Dict[int, _PinState] = {gpio: _PinState() for gpio in self.pins}
+
+    @property
+    def connected(self) -> bool:
+        return self._pi is not None
+
+    def connect(self):
+        self.disconnect()
+
+        pi = self._pigpio.pi()      # Connect to Pi.
+        if not pi.connected:
+            raise IOError('Unable to connect to pigpiod')
+
+        self._states = {gpio: _PinState() for gpio in self.pins}
+        self._last_seen = monotonic()
+
+        for pin in self.pins.values():
+            pi.set_mode(pin.gpio, self._pigpio.INPUT)           # IR RX connected to this GPIO.
+            pi.set_glitch_filter(pin.gpio, pin.glitch)          # Ignore glitches.
+            pi.set_watchdog(pin.gpio, pin.timeout)
+            self._callbacks.append(pi.callback(pin.gpio, self._pigpio.EITHER_EDGE, self._on_edge))
+        self._pi = pi
+
+    def disconnect(self):
+        pi, self._pi = self._pi, None
+        callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback.cancel()
+        if pi:
+            try:
+                for gpio in self.pins:
+                    pi.set_watchdog(gpio, 0)
+                pi.stop()
+            except Exception as e:
+                self.logger.debug(f'Error while closing pigpio connection: {e}')
+
+    def is_alive(self) -> bool:
+        return self.connected and monotonic() - self._last_seen < HEARTBEAT_TIMEOUT
+
+    def _emit(self, gpio, state: _PinState):
+        if state.pulses:
+            METRICS.observe('ir_capture', self._last_seen - state.code_start, gpio=gpio)
+            if self.on_frame:
+                self.on_frame(state.pulses, state.repeat, gpio)
             else:
-                if in_code:
-                    pulses.append(usec)
+                self._frames.put((state.pulses, state.repeat, gpio))
+            state.pulses = []
+
+    def _on_edge(self, gpio, level, tick):
+        # pigpio runs callbacks of all pins on one thread
+        self._last_seen = monotonic()
+        state = self._states.get(gpio)
+        if state is None:
+            return
+        usec = self._pigpio.tickDiff(state.last_tick, tick)
+        state.last_tick = tick
+        if level == self._pigpio.TIMEOUT:
+            if state.in_code:
+                state.in_code = False
+                self._emit(gpio, state)
+                state.repeat = False
+        else:
+            if state.in_code:
+                if usec >= FRAME_GAP and state.pulses:
+                    # Gap between frames of a held key
+                    self._emit(gpio, state)
+                    state.repeat = True
+                    state.code_start = self._last_seen
                 else:
-                    # Ignore the first one (time since last timeout).
-                    in_code = True
+                    state.pulses.append(usec)
+            else:
+                # Ignore the first one (time since last timeout).
+                state.in_code = True
+                state.code_start = self._last_seen
 
-        pi = pigpio.pi()    # Connect to Pi.
+    def receive(self, timeout=None) -> Optional[Tuple[List[int], bool, int]]:
+        """
+        Block until a complete pulse train is received
 
-        if not pi.connected:
-            raise IOError
+        :param timeout: float - seconds
+        :return: (list of pulse lengths, repeat, gpio) or None on timeout/wake()
+        """
+        try:
+            return self._frames.get(timeout=timeout)
+        except Empty:
+            return None
 
-        pi.set_mode(gpio, pigpio.INPUT)     # IR RX connected to this GPIO.
-        pi.set_glitch_filter(gpio, glitch)  # Ignore glitches.
-        pi.set_watchdog(gpio, timeout)
-        pi.callback(gpio, pigpio.EITHER_EDGE, callback)
+    def wake(self):
+        self._frames.put(None)
 
-        while self.is_running:
-            recording = True
-            while recording and self.is_running:
-                sleep(0.01)
-            if pulses:
-                break
 
-        pi.stop()
+class HoldTracker(object):
+    """
+    Resolve frames of a held key to the code of the frame that started the hold
+    """
+
+    def __init__(self):
+        self.last_code = None
+
+    def resolve(self, code, repeat: bool) -> Tuple[Optional[dict], bool]:
+        """
+        :param code: decoded frame, None for frames that do not decode (NEC repeat frames)
+        :param repeat: frame followed the previous one without the line going idle
+        :return: (code, is repeat)
+        """
+        if repeat and (code is None or code == self.last_code):
+            return self.last_code, True
+
+        self.last_code = code
+        return code, False
+
+
+class IrDecoder(object):
+    """
+    Codes of pulse trains from all receiver pins. Holds are tracked per pin, a press seen by several receivers at
+    once is reported only for the pin that received it first. That pin keeps the hold until it stops reporting it.
+
+    Which pin decodes first is a matter of timing, so presses of codes 'pin_bound' accepts (keys with commands bound
+    to pins) are reported for every pin - the dispatcher runs each of their commands once.
+    """
 
-        return pulses
+    def __init__(self, window=CROSS_PIN_WINDOW):
+        self.logger = getLogger('MoodeIrController.IrDecoder')
+        self.window = window
+        # PulseTemplateMatcher - known buttons are resolved without decoding
+        self.matcher = None
+        # code -> True if the key has commands bound to pins
+        self.pin_bound: Optional[Callable[[Dict], bool]] = None
+
+        self._holds: Dict[int, HoldTracker] = defaultdict(HoldTracker)
+        self._owner = None
+        self._last_code = None
+        self._last_time = 0.0
+
+        self.duplicates = 0
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return {'duplicates': self.duplicates}
+
+    def _is_duplicate(self, code, gpio, repeat: bool, timestamp) -> bool:
+        if gpio != self._owner and code == self._last_code and timestamp - self._last_time < self.window:
+            if not repeat and self.pin_bound and self.pin_bound(code):
+                # Hold stays with the first pin
+                return False
+            self.duplicates += 1
+            return True
+
+        self._owner = gpio
+        self._last_code = code
+        self._last_time = timestamp
+        return False
+
+    def resolve(self, pulses, repeat: bool, gpio, timestamp: Optional[float] = None) -> Tuple[Optional[dict], bool]:
+        """
+        :param timestamp: time the pulse train was received, now by default
+        :return: (code or None if there is nothing to report, is repeat)
+        """
+        code, repeat = self._holds[gpio].resolve(IrMonitor.frame_to_code(pulses, self.matcher), repeat)
+        if code and self._is_duplicate(code, gpio, repeat, monotonic() if timestamp is None else timestamp):
+            if not repeat:
+                self.logger.debug(f'Code {code} on GPIO {gpio} already received on GPIO {self._owner}')
+            return None, repeat
+        return code, repeat
+
+
+class IrMonitor(BasicEventMonitor):
+
+    def __init__(self, queue_handler, ir_gpio_pin, pigpio_module=pigpio):
+        self.logger = getLogger('MoodeIrController.IrMonitor')
+        self.pins = parse_ir_pins(ir_gpio_pin)
+        self.receiver = IrReceiver(self.pins, pigpio_module=pigpio_module)
+        self.decoder = IrDecoder()
+        super(IrMonitor, self).__init__(queue_handler=queue_handler)
+
+    @property
+    def matcher(self):
+        return self.decoder.matcher
+
+    @matcher.setter
+    def matcher(self, matcher):
+        self.decoder.matcher = matcher
+
+    def stop(self):
+        super(IrMonitor, self).stop()
+        self.receiver.wake()
+
+    def _reconnect(self, delay) -> float:
+        try:
+            self.receiver.connect()
+            self.logger.info(f'Listening on GPIO {", ".join(str(pin.gpio) for pin in self.pins)}')
+            return RECONNECT_DELAY
+        except Exception as e:
+            self.receiver.disconnect()
+            self.logger.error(f'pigpio connection failed ({e}), retrying in {delay:.0f}s')
+            self.wait(delay)
+            return min(delay * 2, MAX_RECONNECT_DELAY)
 
     @staticmethod
     def _parse_code(code):
@@ -89,10 +315,109 @@ class IrMonitor(BasicEventMonitor):
 
             return code
 
+    @classmethod
+    def decode_frame(cls, pulses):
+        with METRICS.timer('ir_decode'):
+            decoded = decode(pulses)
+        with METRICS.timer('ir_parse'):
+            return cls._parse_code(decoded)
+
+    @classmethod
+    def frame_to_code(cls, pulses, matcher=None):
+        """
+        Code of a pulse train - from a matching template if there is one, full decode otherwise
+        """
+        if matcher:
+            with METRICS.timer('ir_match'):
+                code = matcher.match(pulses)
+            if code is not None:
+                return code
+        return cls.decode_frame(pulses)
+
     def run(self):
+        delay = RECONNECT_DELAY
         while self.is_running:
-            code = decode(self.receive(self.ir_gpio_pin))
-            parsed = self._parse_code(code)
-            if parsed:
-                self.logger.debug(f'Received code {parsed}')
-                self.queue_handler.enqueue(parsed)
+            if not self.receiver.is_alive():
+                if self.receiver.connected:
+                    self.logger.warning('pigpio connection lost, reconnecting')
+                delay = self._reconnect(delay)
+                continue
+
+            frame = self.receiver.receive(timeout=HEARTBEAT_TIMEOUT)
+            if not frame:
+                continue
+            pulses, repeat, gpio = frame
+
+            tracer = self.tracer
+            if tracer:
+                tracer.record('ir', 'held' if repeat else 'pulses', pulses, gpio=gpio)
+
+            parsed, repeat = self.decoder.resolve(pulses, repeat, gpio)
+            if not parsed:
+                continue
+
+            if repeat:
+                self.queue_handler.enqueue(parsed, repeat=True, gpio=gpio)
+            else:
+                self.logger.debug(f'Received code {parsed} on GPIO {gpio}')
+                if tracer:
+                    tracer.record('ir', 'code', parsed, gpio=gpio)
+                self.queue_handler.enqueue(parsed, gpio=gpio)
+
+        self.receiver.disconnect()
+
+
+class AsyncIrSource(object):
+    """
+    IR input for the asyncio runtime. Pulse trains are decoded on the event loop, no dedicated thread is used.
+    """
+
+    def __init__(self, queue_handler, ir_gpio_pin, pigpio_module=pigpio):
+        self.logger = getLogger('MoodeIrController.AsyncIrSource')
+        self.queue_handler = queue_handler
+        self.pins = parse_ir_pins(ir_gpio_pin)
+        self.receiver = IrReceiver(self.pins, pigpio_module=pigpio_module)
+        self.decoder = IrDecoder()
+
+    @property
+    def matcher(self):
+        return self.decoder.matcher
+
+    @matcher.setter
+    def matcher(self, matcher):
+        self.decoder.matcher = matcher
+
+    def _on_frame(self, pulses, repeat, gpio):
+        parsed, repeat = self.decoder.resolve(pulses, repeat, gpio)
+        if not parsed:
+            return
+
+        if not repeat:
+            self.logger.debug(f'Received code {parsed} on GPIO {gpio}')
+        self.queue_handler.enqueue(parsed, repeat=repeat, gpio=gpio)
+
+    async def run(self):
+        import asyncio
+
+        loop = asyncio.get_running_loop()
+        self.receiver.on_frame = lambda pulses, repeat, gpio: loop.call_soon_threadsafe(
+            self._on_frame, pulses, repeat, gpio)
+
+        delay = RECONNECT_DELAY
+        try:
+            while True:
+                if not self.receiver.is_alive():
+                    try:
+                        self.receiver.connect()
+                        self.logger.info(f'Listening on GPIO {", ".join(str(pin.gpio) for pin in self.pins)}')
+                        delay = RECONNECT_DELAY
+                    except Exception as e:
+                        self.receiver.disconnect()
+                        self.logger.error(f'pigpio connection failed ({e}), retrying in {delay:.0f}s')
+                        await asyncio.sleep(delay)
+                        delay = min(delay * 2, MAX_RECONNECT_DELAY)
+                        continue
+
+                await asyncio.sleep(HEARTBEAT_TIMEOUT)
+        finally:
+            self.receiver.disconnect()
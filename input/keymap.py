@@ -0,0 +1,72 @@
+from typing import Dict, Hashable, List, Optional, Union
+from os import path
+
+
+TEMPLATES_SUFFIX = '.templates.json'
+
+
+def _deep_signature(code) -> Hashable:
+    if isinstance(code, dict):
+        return frozenset((key, _deep_signature(value)) for key, value in code.items())
+    if isinstance(code, (list, tuple, set)):
+        return tuple(_deep_signature(value) for value in code)
+    return code
+
+
+def code_signature(code) -> Hashable:
+    """
+    Convert a received or stored code to a canonical, hashable form
+
+    IR codes are dicts (key order and list/tuple differences are ignored), USB codes are plain scan codes.
+
+    :param code: dict, list or scalar
+    :return: hashable signature
+    """
+
+    # Fast path for PiIR codes: flat dict of scalars and lists of ints
+    if isinstance(code, dict):
+        signature = frozenset([(key, tuple(value) if isinstance(value, (list, tuple)) else value)
+                               for key, value in code.items()])
+    elif isinstance(code, (list, tuple)):
+        signature = tuple(code)
+    else:
+        return code
+
+    try:
+        hash(signature)
+    except TypeError:
+        return _deep_signature(code)
+    return signature
+
+
+def build_code_index(keymap: Dict[str, Union[List, str]]) -> Dict[Hashable, str]:
+    """
+    Build a code signature -> key name index. First key that defines a code wins.
+
+    :param keymap: dict
+    :return: dict
+    """
+
+    index: Dict[Hashable, str] = dict()
+    for key_name, codes in keymap.items():
+        if isinstance(codes, str):
+            # Keymap description fields
+            continue
+
+        for code in codes:
+            index.setdefault(code_signature(code), key_name)
+
+    return index
+
+
+def lookup_key(index: Dict[Hashable, str], code) -> Optional[str]:
+    if code is None:
+        return None
+    return index.get(code_signature(code))
+
+
+def templates_file(keymap_file) -> str:
+    """
+    Sidecar file with pulse templates of a keymap - 'keymaps/default.json' -> 'keymaps/default.templates.json'
+    """
+    return path.splitext(keymap_file)[0] + TEMPLATES_SUFFIX
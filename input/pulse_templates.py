@@ -0,0 +1,122 @@
+from typing import Dict, List, Optional, Tuple
+from os import path
+import json
+
+try:
+    import numpy
+except ImportError:
+    # Without NumPy comparing against every template is slower than decoding, pulse trains are always decoded
+    numpy = None
+
+MATCHER_AVAILABLE = numpy is not None
+
+
+# Spaces at least this long (us) end a frame - following repeat frames are not part of a template
+MIN_GAP = 15000
+# Max relative difference of any pulse from the template
+TOLERANCE = 0.25
+
+
+def trim_frame(pulses: List[int]) -> List[int]:
+    """
+    First frame of a pulse train - everything before the first long gap
+    """
+    for index in range(1, len(pulses), 2):
+        if pulses[index] >= MIN_GAP:
+            return pulses[:index]
+    return pulses
+
+
+def build_template(pulse_trains: List[List[int]]) -> Optional[List[int]]:
+    """
+    Average pulse trains of a single button, trains with an unusual number of pulses are left out
+
+    :return: list of pulse lengths (us) or None
+    """
+    frames = [trim_frame(pulses) for pulses in pulse_trains if pulses]
+    if not frames:
+        return None
+
+    lengths = [len(frame) for frame in frames]
+    length = max(set(lengths), key=lengths.count)
+    frames = [frame for frame in frames if len(frame) == length]
+    return [round(sum(column) / len(frames)) for column in zip(*frames)]
+
+
+def load_templates(file_name) -> List[Dict]:
+    """
+    :return: list of {'key', 'code', 'pulses'}
+    """
+    if not path.exists(file_name):
+        return []
+    with open(file_name, 'r') as templates:
+        return json.load(templates)
+
+
+def save_templates(file_name, templates: List[Dict]):
+    with open(file_name, 'w') as templates_out:
+        json.dump(templates, templates_out)
+
+
+class PulseTemplateMatcher(object):
+    """
+    Resolve received pulse trains to codes by comparing them with templates recorded during setup, without decoding.
+    All templates with the same number of pulses are compared in one vectorized operation. Requires NumPy.
+    """
+
+    def __init__(self, templates: List[Dict], tolerance=TOLERANCE):
+        self.tolerance = tolerance
+        # number of pulses -> (templates matrix, codes)
+        self._groups: Dict[int, Tuple['numpy.ndarray', List]] = dict()
+
+        groups: Dict[int, Tuple[List[List[int]], List]] = dict()
+        for template in templates:
+            pulses, codes = groups.setdefault(len(template['pulses']), ([], []))
+            pulses.append(template['pulses'])
+            codes.append(template['code'])
+
+        for length, (pulses, codes) in groups.items():
+            self._groups[length] = (numpy.array(pulses, dtype=numpy.float32), codes)
+
+    def __len__(self):
+        return sum(len(codes) for _, codes in self._groups.values())
+
+    def match(self, pulses: List[int]):
+        """
+        :return: code of the closest template within tolerance or None
+        """
+        frame = trim_frame(pulses)
+        group = self._groups.get(len(frame))
+        if group is None:
+            return None
+
+        templates, codes = group
+        # Max relative deviation of each template from the frame
+        errors = (numpy.abs(templates - numpy.array(frame, dtype=numpy.float32)) / templates).max(axis=1)
+        best = int(errors.argmin())
+        return codes[best] if errors[best] <= self.tolerance else None
+
+
+class PulseCollector(object):
+    """
+    Input tracer collecting pulse trains with the codes they were decoded to, used to build templates in setup
+    """
+
+    def __init__(self):
+        self.frames: List[Tuple[object, List[int]]] = []
+        self._last_pulses: Optional[List[int]] = None
+
+    def record(self, source, kind, data, gpio=None):
+        # Same interface as TraceRecorder.record - pulses are followed by their code on the same thread
+        if kind == 'pulses':
+            self._last_pulses = data
+        elif kind == 'code' and self._last_pulses:
+            self.frames.append((data, self._last_pulses))
+            self._last_pulses = None
+
+    def clear(self):
+        self.frames = []
+        self._last_pulses = None
+
+    def pulses_of(self, code) -> List[List[int]]:
+        return [pulses for _code, pulses in self.frames if _code == code]
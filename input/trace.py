@@ -0,0 +1,158 @@
+from input.ir import HoldTracker, IrDecoder
+from input.usb_remote import KeyHoldFilter
+from threading import Thread, Lock
+from time import monotonic, sleep, time
+from typing import Iterator, List, Optional
+from logging import getLogger
+import gzip
+import json
+
+
+TRACE_VERSION = 2
+# Version 1 traces lack IR receiver pins, they replay as received on an unknown pin
+SUPPORTED_VERSIONS = [1, 2]
+
+# Sources and kinds of trace records
+IR = 'ir'
+USB = 'usb'
+PULSES = 'pulses'       # IR pulse train - list of pulse lengths (us)
+HELD = 'held'           # IR pulse train that followed the previous one while a key was held
+CODE = 'code'           # Code decoded from the preceding pulse train
+SCAN = 'scan'           # USB keyboard event - [scan_code, event_type]
+
+
+class TraceRecorder(object):
+    """
+    Write timestamped raw input events to a gzipped JSON lines file - [seconds since start, source, kind, data, gpio]
+    """
+
+    def __init__(self, file_name, **header):
+        self.file_name = file_name
+        self._file = gzip.open(file_name, 'wt', encoding='utf-8')
+        self._lock = Lock()
+        self._start = monotonic()
+        self.count = 0
+
+        self._write({'version': TRACE_VERSION, 'created': time(), **header})
+
+    def _write(self, record):
+        self._file.write(json.dumps(record, separators=(',', ':')) + '\n')
+
+    def record(self, source, kind, data, gpio=None):
+        with self._lock:
+            if self._file is None:
+                return
+            self._write([round(monotonic() - self._start, 6), source, kind, data, gpio])
+            self.count += 1
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+def read_trace(file_name) -> Iterator[List]:
+    """
+    :return: trace records, header is skipped
+    """
+    with gzip.open(file_name, 'rt', encoding='utf-8') as trace_file:
+        header = json.loads(trace_file.readline())
+        if header.get('version') not in SUPPORTED_VERSIONS:
+            raise ValueError(f'Unsupported trace version {header.get("version")} in {file_name}')
+
+        for line in trace_file:
+            if line.strip():
+                record = json.loads(line)
+                yield record if len(record) == 5 else record + [None]
+
+
+class TraceReplayer(Thread):
+    """
+    Feed a recorded trace into the event queue at recorded speed times 'speed', or as fast as possible (speed=None)
+
+    IR pulse trains go through the same decoding as live input, recorded codes are then only compared to the
+    result. With decode=False recorded codes are queued directly instead.
+    """
+
+    def __init__(self, file_name, queue_handler, speed: Optional[float] = 1.0, decode=True, event_type='up'):
+        super().__init__(name='trace-replay', daemon=True)
+        self.logger = getLogger('MoodeIrController.TraceReplayer')
+        self.file_name = file_name
+        self.queue_handler = queue_handler
+        self.speed = speed
+        self.decode = decode
+        self.ir_decoder = IrDecoder()
+        self.ir_hold = HoldTracker()
+        self.usb_hold = KeyHoldFilter(event_type)
+
+        self._running = True
+        self.replayed = 0
+        self.mismatched = 0
+        self.duration = 0.0
+
+    @property
+    def matcher(self):
+        return self.ir_decoder.matcher
+
+    @matcher.setter
+    def matcher(self, matcher):
+        # PulseTemplateMatcher used instead of decoding for known pulse trains
+        self.ir_decoder.matcher = matcher
+
+    def stop(self):
+        self._running = False
+
+    def _wait(self, start, offset):
+        if not self.speed:
+            return
+        delay = start + offset / self.speed - monotonic()
+        if delay > 0:
+            sleep(delay)
+
+    def run(self):
+        start = monotonic()
+        decoded = None
+        for offset, source, kind, data, gpio in read_trace(self.file_name):
+            if not self._running:
+                break
+
+            if source == IR and kind in [PULSES, HELD] and self.decode:
+                self._wait(start, offset)
+                # Recorded time - presses seen by several receivers are told apart the same way at any speed
+                code, repeat = self.ir_decoder.resolve(data, kind == HELD, gpio, timestamp=offset)
+                if not repeat:
+                    decoded = code
+                if code:
+                    self.queue_handler.enqueue(code, repeat=repeat, gpio=gpio)
+                    self.replayed += 1
+
+            elif source == IR and kind == HELD:
+                # Recorded codes only - repeat the last one
+                if self.ir_hold.last_code:
+                    self._wait(start, offset)
+                    self.queue_handler.enqueue(self.ir_hold.last_code, repeat=True, gpio=gpio)
+                    self.replayed += 1
+
+            elif source == IR and kind == CODE:
+                if not self.decode:
+                    self._wait(start, offset)
+                    self.ir_hold.last_code = data
+                    self.queue_handler.enqueue(data, gpio=gpio)
+                    self.replayed += 1
+                elif decoded != data:
+                    # Decoder result differs from the one seen when recording
+                    self.mismatched += 1
+                    self.logger.warning(f'Decoded {decoded}, recorded {data}')
+
+            elif source == USB and kind == SCAN:
+                scan_code, event_type = data
+                repeat = self.usb_hold.classify(scan_code, event_type)
+                if repeat is not None:
+                    self._wait(start, offset)
+                    self.queue_handler.enqueue(scan_code, repeat=repeat)
+                    self.replayed += 1
+
+        self.duration = monotonic() - start
+        self.logger.info(f'Replayed {self.replayed} events in {self.duration:.2f}s'
+                         + (f', {self.mismatched} decoded differently' if self.mismatched else ''))
@@ -1,7 +1,31 @@
 from input.basic_monitor import BasicEventMonitor
 from input.event_queue import Queue
+from typing import Optional
 from logging import getLogger
-from keyboard import read_event, hook
+from keyboard import hook, unhook
+
+
+class KeyHoldFilter(object):
+    """
+    Classify keyboard events - 'down' events of a key that was not released are autorepeat of a held key
+    """
+
+    def __init__(self, event_type: str):
+        self.event_type = event_type.lower()
+        self._held = set()
+
+    def classify(self, scan_code, event_type) -> Optional[bool]:
+        """
+        :return: None - ignore event, False - key press, True - repeat of a held key
+        """
+        if event_type == 'down':
+            if scan_code in self._held:
+                return True
+            self._held.add(scan_code)
+        else:
+            self._held.discard(scan_code)
+
+        return False if event_type == self.event_type else None
 
 
 class UsbRemoteMonitor(BasicEventMonitor):
@@ -10,6 +34,7 @@ class UsbRemoteMonitor(BasicEventMonitor):
         self.logger = getLogger('MoodeIrController.UsbRemoteMonitor')
         self._queue = Queue()
         self.event_type:str = event_type
+        self.hold = KeyHoldFilter(event_type)
         super(UsbRemoteMonitor, self).__init__(queue_handler=queue_handler)
 
     def stop(self):
@@ -23,8 +48,42 @@ class UsbRemoteMonitor(BasicEventMonitor):
 
             if key is None:
                 continue
-            if key.event_type != self.event_type.lower():
+            if self.tracer:
+                self.tracer.record('usb', 'scan', [key.scan_code, key.event_type])
+
+            repeat = self.hold.classify(key.scan_code, key.event_type)
+            if repeat is None:
                 continue
 
+            if not repeat:
+                self.logger.debug(f'Received code {key.scan_code}')
+            self.queue_handler.enqueue(key.scan_code, repeat=repeat)
+
+
+class AsyncUsbSource(object):
+    """
+    USB remote input for the asyncio runtime. Key events are filtered and queued directly from the keyboard hook.
+    """
+
+    def __init__(self, queue_handler, event_type: str):
+        self.logger = getLogger('MoodeIrController.AsyncUsbSource')
+        self.queue_handler = queue_handler
+        self.hold = KeyHoldFilter(event_type)
+
+    def _on_key(self, key):
+        repeat = self.hold.classify(key.scan_code, key.event_type)
+        if repeat is None:
+            return
+
+        if not repeat:
             self.logger.debug(f'Received code {key.scan_code}')
-            self.queue_handler.enqueue(key.scan_code)
+        self.queue_handler.enqueue(key.scan_code, repeat=repeat)
+
+    async def run(self):
+        import asyncio
+
+        remove = hook(self._on_key)
+        try:
+            await asyncio.Event().wait()
+        finally:
+            unhook(remove)
@@ -0,0 +1,136 @@
+from contextlib import contextmanager
+from threading import Lock
+from time import monotonic
+from typing import Callable, Dict, List, Optional, Tuple
+from bisect import bisect_left
+
+
+# Upper bounds (seconds) of histogram buckets, last one is +Inf
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+PREFIX = 'moode_remote'
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class Histogram(object):
+    """
+    Fixed-memory latency histogram
+    """
+
+    __slots__ = ['counts', 'total', 'count']
+
+    def __init__(self):
+        self.counts: List[int] = [0] * (len(BUCKETS) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, seconds: float):
+        self.counts[bisect_left(BUCKETS, seconds)] += 1
+        self.total += seconds
+        self.count += 1
+
+    def quantile(self, q: float) -> Optional[float]:
+        """
+        Estimate a quantile - upper bound of the bucket it falls into
+        """
+        if not self.count:
+            return None
+
+        rank = q * self.count
+        cumulative = 0
+        for index, count in enumerate(self.counts):
+            cumulative += count
+            if cumulative >= rank:
+                return BUCKETS[index] if index < len(BUCKETS) else float('inf')
+        return float('inf')
+
+
+class Metrics(object):
+    """
+    Registry of per-stage latency histograms labelled by key/target, plus counters read from collectors
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._histograms: Dict[Tuple[str, Labels], Histogram] = dict()
+        self._collectors: Dict[str, Callable[[], Dict[str, float]]] = dict()
+
+    def observe(self, stage: str, seconds: float, **labels):
+        key = (stage, tuple(sorted((name, str(value)) for name, value in labels.items() if value is not None)))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+            histogram.observe(seconds)
+
+    @contextmanager
+    def timer(self, stage: str, **labels):
+        start = monotonic()
+        try:
+            yield
+        finally:
+            self.observe(stage, monotonic() - start, **labels)
+
+    def reset(self):
+        with self._lock:
+            self._histograms.clear()
+
+    def register_collector(self, name: str, collector: Callable[[], Dict[str, float]]):
+        """
+        :param collector: callable returning {field: number}, exported as gauges
+        """
+        self._collectors[name] = collector
+
+    def _collect(self) -> Dict[str, Dict[str, float]]:
+        collected = dict()
+        for name, collector in list(self._collectors.items()):
+            try:
+                collected[name] = {field: value for field, value in collector().items()
+                                   if isinstance(value, (int, float)) and not isinstance(value, bool)}
+            except Exception:
+                continue
+        return collected
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            histograms = list(self._histograms.items())
+
+        stages = []
+        for (stage, labels), histogram in sorted(histograms, key=lambda item: item[0]):
+            stages.append({
+                'stage': stage,
+                'labels': dict(labels),
+                'count': histogram.count,
+                'avg': histogram.total / histogram.count if histogram.count else None,
+                'p50': histogram.quantile(0.5),
+                'p95': histogram.quantile(0.95),
+                'p99': histogram.quantile(0.99)
+            })
+
+        return {'stages': stages, 'counters': self._collect()}
+
+    def render_prometheus(self) -> str:
+        with self._lock:
+            histograms = [(key, list(histogram.counts), histogram.total, histogram.count)
+                          for key, histogram in sorted(self._histograms.items(), key=lambda item: item[0])]
+
+        lines = [f'# HELP {PREFIX}_stage_seconds Latency of processing stages',
+                 f'# TYPE {PREFIX}_stage_seconds histogram']
+        for (stage, labels), counts, total, count in histograms:
+            label_str = ','.join([f'stage="{stage}"'] + [f'{name}="{value}"' for name, value in labels])
+            cumulative = 0
+            for bound, bucket_count in zip(BUCKETS + ('+Inf',), counts):
+                cumulative += bucket_count
+                lines.append(f'{PREFIX}_stage_seconds_bucket{{{label_str},le="{bound}"}} {cumulative}')
+            lines.append(f'{PREFIX}_stage_seconds_sum{{{label_str}}} {total}')
+            lines.append(f'{PREFIX}_stage_seconds_count{{{label_str}}} {count}')
+
+        for name, fields in self._collect().items():
+            for field, value in fields.items():
+                lines.append(f'# TYPE {PREFIX}_{name}_{field} gauge')
+                lines.append(f'{PREFIX}_{name}_{field} {value}')
+
+        return '\n'.join(lines) + '\n'
+
+
+METRICS = Metrics()
@@ -0,0 +1,97 @@
+from handlers.spotify_auth import MyWSGIRefServer
+from metrics.histogram import METRICS, Metrics
+from bottle import Bottle, response
+from threading import Thread
+from time import monotonic
+from typing import Optional
+from logging import getLogger
+from urllib.request import urlopen
+import json
+
+
+# Seconds close() waits for the server thread to finish
+CLOSE_TIMEOUT = 5.0
+
+
+class MetricsServer(object):
+    """
+    Local HTTP endpoint - '/metrics' in Prometheus text format, '/stats' as JSON
+    """
+
+    def __init__(self, listen_ip, listen_port, metrics: Metrics = METRICS):
+        self.logger = getLogger('MoodeIrController.MetricsServer')
+        self._app = Bottle()
+        self.listen_ip = listen_ip
+        self.listen_port = listen_port
+        self.metrics = metrics
+
+        self._app.route('/metrics', method='GET', callback=self.prometheus)
+        self._app.route('/stats', method='GET', callback=self.stats)
+
+        self.server: Optional[MyWSGIRefServer] = None
+        self.thread: Optional[Thread] = None
+
+    def prometheus(self):
+        response.content_type = 'text/plain; version=0.0.4'
+        return self.metrics.render_prometheus()
+
+    def stats(self):
+        response.content_type = 'application/json'
+        return json.dumps(self.metrics.snapshot())
+
+    def start(self):
+        self.server = MyWSGIRefServer(host=self.listen_ip, port=self.listen_port)
+        self.thread = Thread(target=self._serve, daemon=True)
+        self.thread.start()
+
+    def _serve(self):
+        try:
+            self._app.run(server=self.server, quiet=True)
+        except OSError as e:
+            # Metrics are optional - e.g. port already taken must not stop the controller
+            self.logger.error(f'Unable to start metrics server: {e}')
+
+    def close(self):
+        server, self.server = self.server, None
+        thread, self.thread = self.thread, None
+        if not thread:
+            return
+
+        # Server may still be starting - it is stopped as soon as it is up
+        deadline = monotonic() + CLOSE_TIMEOUT
+        while thread.is_alive() and monotonic() < deadline:
+            if server and server.server:
+                server.stop()
+                break
+            thread.join(timeout=0.01)
+
+        thread.join(timeout=max(deadline - monotonic(), 0))
+        if thread.is_alive():
+            self.logger.warning(f'Metrics server did not stop within {CLOSE_TIMEOUT}s')
+
+
+def _format_ms(seconds) -> str:
+    if seconds is None:
+        return '-'
+    if seconds == float('inf'):
+        return 'inf'
+    return f'{seconds * 1000:.1f}'
+
+
+def print_stats(host, port):
+    """
+    'stats' command - read and print stats of a running instance
+    """
+    with urlopen(f'http://{host}:{port}/stats', timeout=5) as stats_response:
+        print_snapshot(json.loads(stats_response.read().decode('utf-8')))
+
+
+def print_snapshot(stats):
+    print(f'{"stage":<18}{"labels":<36}{"count":>8}{"avg ms":>10}{"p50 ms":>10}{"p95 ms":>10}{"p99 ms":>10}')
+    for stage in stats['stages']:
+        labels = ' '.join(f'{name}={value}' for name, value in stage['labels'].items())
+        print(f'{stage["stage"]:<18}{labels:<36}{stage["count"]:>8}{_format_ms(stage["avg"]):>10}'
+              f'{_format_ms(stage["p50"]):>10}{_format_ms(stage["p95"]):>10}{_format_ms(stage["p99"]):>10}')
+
+    for name, fields in stats['counters'].items():
+        print(f'{name}: ' + ', '.join(f'{field}={value}' for field, value in fields.items()))
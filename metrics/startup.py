@@ -0,0 +1,52 @@
+from metrics.histogram import METRICS
+from contextlib import contextmanager
+from threading import Lock, current_thread
+from time import monotonic
+from typing import List, NamedTuple
+
+
+class Phase(NamedTuple):
+    name: str
+    start: float        # Seconds since profile start
+    duration: float
+    thread: str
+
+
+class StartupProfile(object):
+    """
+    Wall clock timing of startup phases. Phases may run in parallel threads, so durations do not add up to the total.
+    """
+
+    def __init__(self):
+        self.start = monotonic()
+        self.phases: List[Phase] = []
+        self._lock = Lock()
+
+    @contextmanager
+    def phase(self, name):
+        start = monotonic()
+        try:
+            yield
+        finally:
+            end = monotonic()
+            METRICS.observe('startup', end - start, phase=name)
+            with self._lock:
+                self.phases.append(Phase(name, start - self.start, end - start, current_thread().name))
+
+    def mark(self, name):
+        """
+        Zero length phase - i.e. the moment first input is read
+        """
+        with self.phase(name):
+            pass
+
+    def report(self) -> str:
+        with self._lock:
+            phases = sorted(self.phases, key=lambda phase: phase.start)
+        total = max((phase.start + phase.duration for phase in phases), default=0.0)
+
+        lines = [f'{"phase":<28}{"start ms":>10}{"took ms":>10}   thread']
+        for phase in phases:
+            lines.append(f'{phase.name:<28}{phase.start * 1000:>10.1f}{phase.duration * 1000:>10.1f}   {phase.thread}')
+        lines.append(f'{"total":<28}{"":>10}{total * 1000:>10.1f}')
+        return '\n'.join(lines)
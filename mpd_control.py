@@ -1,20 +1,29 @@
 from handlers.base_handler import BaseActionHandler
 from handlers.shell import ShellCommandsHandler
-from handlers.spotify import SpotifyHandler
 from handlers.moode import MoodeHandler
 from handlers.bluetooth import BluetoothHandler
 from input.basic_monitor import BasicEventMonitor
-from input.ir import IrMonitor
-from input.usb_remote import UsbRemoteMonitor
-from input.event_queue import Queue
+from input.debounce import CROSS_PIN_WINDOW, DEBOUNCE_WINDOW, Debouncer, parse_debounce_window
+from input.event_queue import Queue, QueuedEvent, PRIORITY_HIGH, PRIORITY_NORMAL
+from input.keymap import build_code_index, lookup_key, templates_file
+from dispatch.lanes import LaneDispatcher
+from dispatch.pending import MAX_PENDING, MAX_PENDING_AGE, PendingCommands
+from dispatch.plan import DispatchPlan, Operation, TargetMap, command_targets, compile_plan, filter_gpio, \
+    filter_handled_pins, pin_bound_keys, select_operations
+from dispatch.repeat import KeyRepeater, RepeatOptions, parse_repeat_options
+from metrics.histogram import METRICS
+from metrics.startup import StartupProfile
 from pprint import pformat
-from typing import Optional, List, Dict, Tuple
+from typing import Optional, List, Dict, Tuple, Hashable, Union, FrozenSet
 from os import path, makedirs
 from logging import getLogger, StreamHandler, Formatter, basicConfig
 from logging.handlers import TimedRotatingFileHandler
-from requests.exceptions import ConnectionError
-from time import sleep, time
+from requests.exceptions import ConnectionError, Timeout
+from util.polling import wait_until
+from time import sleep, monotonic
 from copy import deepcopy
+from functools import partial
+from threading import Lock, Thread
 import json
 import sys
 import atexit
@@ -22,18 +31,38 @@ import atexit
 
 DIR = path.dirname(path.realpath(__file__))
 INIT_TIMEOUT = 120
+# Moode readiness probes start fast and back off to this interval (seconds)
+MOODE_PROBE_INTERVAL = 5.0
 
 
 class Config(object):
 
     def __init__(self):
-        self.ir_gpio_pin: Optional[int] = None
+        self.ir_gpio_pin: Union[int, Dict, List[Union[int, Dict]], None] = None
         self.enable_ir_remote: bool = True
         self.enable_usb_remote: bool = False
         self.keyboard_event_type: str = 'up'
+        self.usb_backend: str = 'keyboard'
+        self.usb_devices: List[str] = []
+        self.runtime: str = 'threads'
         self.remotes: List[str] = []
         self.spotify: Dict[str, str] = {}
         self.default_moode_set: str = "set_playlist"
+        self.moode_url: str = "http://localhost/"
+        self.hot_reload: bool = True
+        self.event_queue = {
+            "max_len": 10,
+            "max_age": 5.0,
+            "priority_keys": ["power", "mute", "pause"],
+            "debounce": DEBOUNCE_WINDOW,
+            "pending_max_len": MAX_PENDING,
+            "pending_max_age": MAX_PENDING_AGE
+        }
+        self.metrics = {
+            "enabled": True,
+            "listen_ip": "127.0.0.1",
+            "listen_port": 9101
+        }
         self.logging = {
             "level": "INFO",
             "file_level": "DEBUG",
@@ -45,16 +74,25 @@ class Config(object):
         with open(path.join(DIR, 'config.json')) as file:
             config: Dict = json.load(file)
             for key, value in config.items():
+                if isinstance(getattr(self, key, None), dict) and isinstance(value, dict):
+                    # Keep defaults for sections that are only partially configured
+                    value = {**getattr(self, key), **value}
                 setattr(self, key, value)
 
 
 class ControllerApp(object):
 
-    def __init__(self, test_mode=False):
+    def __init__(self, test_mode=False, config: Optional[Config] = None, cache_path=path.join(DIR, '.cache'),
+                 profile: Optional[StartupProfile] = None):
         self.test_mode = test_mode
+        self.profile = profile or StartupProfile()
+        # Print startup phase timings once monitoring starts
+        self.print_profile = False
 
-        self.config: Config = Config()
-        self.config.load()
+        if config is None:
+            config = Config()
+            config.load()
+        self.config: Config = config
 
         self.logger = getLogger('MoodeIrController')
         self._logger_init()
@@ -62,66 +100,248 @@ class ControllerApp(object):
         if not self.config.remotes:
             self.logger.error('There are no remotes configured!')
 
-        self.keymap: Dict[str, Optional[List, str]] = dict()
+        self.keymap: Dict[str, Union[List, str]] = dict()
+        self.keymap_file: Optional[str] = None
+        self.code_index: Dict[Hashable, str] = dict()
+        # PulseTemplateMatcher of the loaded keymap
+        self.pulse_matcher = None
         self.commands: Dict[str, Dict] = dict()
-
+        self.plan: Optional[DispatchPlan] = None
+        self.command_targets: TargetMap = dict()
+        self.pin_bound_keys: FrozenSet[str] = frozenset()
+        # Key -> (time of its last press, pins the press was handled for)
+        self._pin_presses: Dict[str, Tuple[float, FrozenSet[int]]] = dict()
+        self.repeater = KeyRepeater(dict())
+        self.debouncer = Debouncer(dict(), self.config.event_queue['debounce'])
+
+        # Handlers register here once initialized, key presses for targets not ready yet wait in 'pending'
         self.handlers: Dict[str, BaseActionHandler] = {}
+        self._handlers_lock = Lock()
+        self.init_error: Optional[Exception] = None
+        targets = [] if self.test_mode else self.targets
+        self.pending = PendingCommands(targets, max_len=self.config.event_queue['pending_max_len'],
+                                       max_age=self.config.event_queue['pending_max_age'])
+
+        self.lanes: Optional[LaneDispatcher] = None
+        if targets and not self.use_asyncio:
+            # Presses waiting behind a slow command are bounded and expire like those in the event queue
+            self.lanes = LaneDispatcher(targets, max_len=self.config.event_queue['max_len'],
+                                        max_age=self.config.event_queue['max_age'])
+
+        with self.profile.phase('load_commands'):
+            self.load_commands()
+
+        self.event_queue = Queue(max_len=self.config.event_queue['max_len'],
+                                 max_age=self.config.event_queue['max_age'],
+                                 priority_of=self._event_priority,
+                                 is_duplicate=self._is_duplicate_press)
+        with self.profile.phase('input_handlers'):
+            self._load_input_handlers()
+
+        self.metrics_server = None
+        self.watcher = None
+        self.runtime = None
         if not self.test_mode:
-            self._wait_for_moode()
-            self.handlers = {
-                'shell': ShellCommandsHandler(),
-                'spotify': SpotifyHandler(config=self.config.spotify, cache_path=path.join(DIR, '.cache')),
-                'moode': MoodeHandler(),
-                'bluetooth': BluetoothHandler()
-            }
-            self.handlers['moode'].default_set = self.config.default_moode_set
-            self.handlers['moode'].current_set = self.config.default_moode_set
+            with self.profile.phase('metrics'):
+                self._start_metrics()
+            self._init_handlers(cache_path)
+
+        atexit.register(self.stop)
 
-        self.load_commands()
+    @property
+    def spotify_configured(self) -> bool:
+        return all(self.config.spotify.get(key) for key in ['client_id', 'client_secret', 'redirect_uri'])
+
+    @property
+    def targets(self) -> List[str]:
+        return ['shell', 'bluetooth', 'moode'] + (['spotify'] if self.spotify_configured else [])
+
+    def _init_handlers(self, cache_path):
+        """
+        Start handler initialization in background - inputs already run and key presses for targets that are not
+        ready yet wait in self.pending. Shell and bluetooth do not need Moode and are ready while it is booting,
+        Spotify is imported meanwhile and created as soon as Moode responds.
+        """
+        def _timed(name, func):
+            with self.profile.phase(name):
+                return func()
+
+        initializers = {
+            'shell': lambda: _timed('handler_shell', ShellCommandsHandler),
+            'bluetooth': lambda: _timed('handler_bluetooth', BluetoothHandler),
+            'moode': self._init_moode
+        }
+        if self.spotify_configured:
+            initializers['spotify'] = lambda: self._init_spotify(cache_path)
+        else:
+            self.logger.info('Spotify is not configured')
 
-        self.event_queue = Queue()
-        self._load_input_handlers()
+        for target, initializer in initializers.items():
+            Thread(target=self._init_handler, args=(target, initializer), name=f'init-{target}', daemon=True).start()
 
-        atexit.register(self.stop)
+    def _init_handler(self, target, initializer):
+        try:
+            handler = initializer()
+            with self._handlers_lock:
+                handlers = {**self.handlers, target: handler}
+                if self.plan is not None:
+                    # Commands of the target are verified now and swapped in with the rest of the plan
+                    self.plan = compile_plan(self.commands, handlers)
+                self.handlers = handlers
+        except Exception as e:
+            # Same as a failure during a blocking start - the script exits
+            self.logger.error(f'Unable to initialize "{target}"')
+            self.logger.exception(e)
+            self.init_error = e
+            self.pending.failed(target)
+            self.event_queue.stop()
+            return
+
+        self.profile.mark(f'{target}_ready')
+        self.event_queue.requeue(self.pending.ready(target))
+
+    def wait_ready(self, timeout: Optional[float] = None) -> bool:
+        """
+        Block until all handlers are initialized
+
+        :return: False on timeout
+        """
+        return self.pending.wait(timeout=timeout)
+
+    def _init_moode(self) -> MoodeHandler:
+        with self.profile.phase('wait_for_moode'):
+            self._wait_for_moode()
+        moode = MoodeHandler()
+        moode.default_set = self.config.default_moode_set
+        moode.current_set = self.config.default_moode_set
+        return moode
+
+    def _init_spotify(self, cache_path):
+        with self.profile.phase('import_spotify'):
+            # Imported only when configured, spares loading spotipy and bottle otherwise
+            from handlers.spotify import SpotifyHandler
+        # Spotify reads its device name from Moode
+        self.pending.wait(['moode'])
+        if 'moode' not in self.handlers:
+            raise RuntimeError('Moode is not available')
+        with self.profile.phase('handler_spotify'):
+            spotify = SpotifyHandler(config=self.config.spotify, cache_path=cache_path)
+        Thread(target=spotify.prefetch_device, name='spotify-prefetch', daemon=True).start()
+        return spotify
+
+    @property
+    def use_asyncio(self) -> bool:
+        # Setup and test modes always read keys from monitor threads
+        return self.config.runtime == 'asyncio' and not self.test_mode
+
+    def _start_metrics(self):
+        METRICS.register_collector('event_queue', lambda: self.event_queue.stats)
+        METRICS.register_collector('key_repeat', lambda: self.repeater.stats)
+        METRICS.register_collector('debounce', lambda: self.debouncer.stats)
+        METRICS.register_collector('pending', lambda: self.pending.stats)
+        for _ih in self.input_handlers:
+            if hasattr(_ih, 'decoder'):
+                METRICS.register_collector('ir', lambda _decoder=_ih.decoder: _decoder.stats)
+        METRICS.register_collector('moode_cfg_cache',
+                                   lambda: self.handlers['moode'].cache_stats if 'moode' in self.handlers else {})
+        if self.lanes:
+            for target in self.lanes.lanes.keys():
+                METRICS.register_collector(f'lane_{target}', lambda _target=target: self.lanes.stats[_target])
+
+        if not self.config.metrics['enabled']:
+            return
+
+        # Imported only when enabled, spares loading bottle otherwise
+        from metrics.server import MetricsServer
+        self.metrics_server = MetricsServer(self.config.metrics['listen_ip'], self.config.metrics['listen_port'])
+        self.metrics_server.start()
 
     def _load_input_handlers(self):
         self.input_handlers: List[BasicEventMonitor] = []
+        if self.use_asyncio:
+            # Inputs are started as async sources by AsyncRuntime
+            return
+
+        # Input modules are imported only when enabled - they load pigpio or keyboard
         if self.config.enable_ir_remote:
-            self.input_handlers.append(IrMonitor(self.event_queue, self.config.ir_gpio_pin))
+            from input.ir import IrMonitor
+            monitor = IrMonitor(self.event_queue, self.config.ir_gpio_pin)
+            monitor.decoder.pin_bound = self.is_pin_bound
+            self.input_handlers.append(monitor)
         if self.config.enable_usb_remote:
-            self.input_handlers.append(UsbRemoteMonitor(self.event_queue, self.config.keyboard_event_type))
+            if self.config.usb_backend == 'evdev':
+                from input.evdev_remote import EvdevRemoteMonitor
+                self.input_handlers.append(EvdevRemoteMonitor(self.event_queue, self.config.keyboard_event_type,
+                                                              self.config.usb_devices))
+            else:
+                from input.usb_remote import UsbRemoteMonitor
+                self.input_handlers.append(UsbRemoteMonitor(self.event_queue, self.config.keyboard_event_type))
 
         for _ih in self.input_handlers:
             _ih.start()
 
     def stop(self):
-        if self.event_queue:
+        if self.watcher:
+            self.watcher.stop()
+            self.watcher = None
+        if self.event_queue is not None:
             self.event_queue.stop()
         for _ih in self.input_handlers:
             _ih.stop()
             _ih.join()
+        if self.lanes:
+            self.lanes.stop(timeout=INIT_TIMEOUT)
+            self.logger.info(f'Lane stats: {pformat(self.lanes.stats)}')
+            self.lanes = None
+        self.logger.info(f'Key repeat stats: {self.repeater.stats}')
+        self.logger.info(f'Debounce suppressed presses: {dict(self.debouncer.suppressed)}')
+        if self.metrics_server:
+            self.metrics_server.close()
+            self.metrics_server = None
         if 'spotify' in self.handlers:
             self.handlers['spotify'].stop()
+        if 'moode' in self.handlers:
+            self.handlers['moode'].session.close()
+        if 'bluetooth' in self.handlers:
+            self.handlers['bluetooth'].stop()
+        if 'shell' in self.handlers:
+            self.handlers['shell'].stop()
+
+    def _event_priority(self, code) -> int:
+        if lookup_key(self.code_index, code) in self.config.event_queue['priority_keys']:
+            return PRIORITY_HIGH
+        return PRIORITY_NORMAL
+
+    def _is_duplicate_press(self, code, timestamp, gpio: Optional[int] = None) -> bool:
+        key_name = lookup_key(self.code_index, code)
+        return self.debouncer.suppress(key_name, timestamp, pin=gpio if key_name in self.pin_bound_keys else None)
+
+    def is_pin_bound(self, code) -> bool:
+        """
+        :return: True if the key of an IR code has commands bound to receiver pins
+        """
+        return bool(self.pin_bound_keys) and lookup_key(self.code_index, code) in self.pin_bound_keys
 
     def get_handler(self, handler_name):
         if handler_name in self.handlers:
             return self.handlers[handler_name]
         return None
 
-    @staticmethod
-    def _wait_for_moode():
-        start = time()
-        while True:
-            try:
-                if MoodeHandler().read_cfg_system():
-                    return
-            except ConnectionError:
-                pass
+    def _wait_for_moode(self):
+        # First instance of the handler - binds the singleton to configured url
+        moode = MoodeHandler(base_url=self.config.moode_url)
 
-            if time() - start > INIT_TIMEOUT:
-                raise TimeoutError("Timeout while waiting for Moode to initialize")
+        def _ready() -> bool:
+            try:
+                return bool(moode.read_cfg_system(max_age=0))
+            except (ConnectionError, Timeout, ValueError):
+                # Not listening yet, or PHP up before its database
+                return False
 
-            sleep(5)
+        elapsed = wait_until(_ready, timeout=INIT_TIMEOUT, initial_interval=0.1, max_interval=MOODE_PROBE_INTERVAL)
+        if elapsed is None:
+            raise TimeoutError("Timeout while waiting for Moode to initialize")
+        self.logger.debug(f'Moode ready after {elapsed:.2f}s')
 
     def _logger_init(self):
         self.logger.setLevel("DEBUG")
@@ -152,57 +372,158 @@ class ControllerApp(object):
             getLogger().addHandler(file_handler)
 
     def verify_commands(self):
-
-        for command_dict in self.commands.values():
-            for command in command_dict.values():
-                assert 'target' in command, f'\'target\' missing from {command_dict}'
-                if command['target'] in self.handlers:
-                    handler = self.handlers[command['target']]
-                    handler.verify(command)
+        # Handlers that are not ready yet verify their commands when they register
+        with self.profile.phase('verify_commands'), self._handlers_lock:
+            self.plan = compile_plan(self.commands, self.handlers)
 
     def load_keymap(self, file_name=None):
-        self.keymap.clear()
+        # Kept for reloads
+        self.keymap_file = file_name
         remotes = self.config.remotes if not file_name else [file_name]
+        self.keymap = self._read_keymap(remotes)
+        self.code_index = build_code_index(self.keymap)
+        self._set_pulse_matcher(self._build_pulse_matcher(remotes, self.keymap))
+
+    def _read_keymap(self, remotes: List[str]) -> Dict[str, Union[List, str]]:
+        keymap = dict()
         for keymap_name in remotes:
             if not path.exists(path.join(DIR, 'keymaps', keymap_name)):
                 self.logger.error(f'File not found: {keymap_name}!')
                 continue
             with open(path.join(DIR, 'keymaps', keymap_name), 'r') as keymap_file:
-                keymap: Dict[str, List] = json.load(keymap_file)
-                for key_name, codes in keymap.items():
+                remote_keymap: Dict[str, List] = json.load(keymap_file)
+                for key_name, codes in remote_keymap.items():
                     if isinstance(codes, str):
                         # Keymap description fields
-                        self.keymap[key_name] = codes
+                        keymap[key_name] = codes
 
-                    if key_name not in self.keymap:
-                        self.keymap[key_name] = list()
+                    if key_name not in keymap:
+                        keymap[key_name] = list()
 
                     for code in codes:
-                        if code not in self.keymap[key_name]:
-                            self.keymap[key_name].append(code)
+                        if code not in keymap[key_name]:
+                            keymap[key_name].append(code)
+        return keymap
+
+    def _build_pulse_matcher(self, remotes: List[str], keymap: Dict):
+        """
+        :return: PulseTemplateMatcher or None
+        """
+        if not self.config.enable_ir_remote:
+            return None
+
+        # Most keymaps have no templates - NumPy is not loaded for nothing
+        files = [templates_file(path.join(DIR, 'keymaps', keymap_name)) for keymap_name in remotes]
+        files = [file_name for file_name in files if path.exists(file_name)]
+        if not files:
+            return None
+
+        from input.pulse_templates import PulseTemplateMatcher, MATCHER_AVAILABLE, load_templates
+        if not MATCHER_AVAILABLE:
+            return None
+
+        templates = []
+        for file_name in files:
+            for template in load_templates(file_name):
+                # Codes removed from keymap by hand leave stale templates behind
+                if template['code'] in keymap.get(template['key'], []):
+                    templates.append(template)
+
+        if templates:
+            self.logger.debug(f'Loaded {len(templates)} pulse templates')
+        return PulseTemplateMatcher(templates) if templates else None
+
+    def _set_pulse_matcher(self, pulse_matcher):
+        self.pulse_matcher = pulse_matcher
+        for _ih in self.input_handlers + (self.runtime.sources if self.runtime else []):
+            if hasattr(_ih, 'matcher'):
+                _ih.matcher = pulse_matcher
 
     def load_commands(self):
+        commands = self._read_commands()
+        repeat_options, debounce_windows = self._key_options(commands)
+
+        self.commands = commands
+        self.command_targets = command_targets(commands)
+        self.pin_bound_keys = pin_bound_keys(commands)
+        self.repeater.options = repeat_options
+        self.debouncer.windows = debounce_windows
+
+    def _read_commands(self) -> Dict[str, Dict]:
         with open(path.join(DIR, 'commands', 'base.json'), 'r') as commands_file:
-            self.commands = json.load(commands_file)
+            commands = json.load(commands_file)
 
         if path.exists(path.join(DIR, 'commands', 'custom.json')):
             with open(path.join(DIR, 'commands', 'custom.json'), 'r') as commands_file:
                 custom_commands: Dict = json.load(commands_file)
                 for key, value in custom_commands.items():
-                    if key in self.commands:
+                    if key in commands:
                         self.logger.warning(
                             f'"{key}" is duplicated. Value from "custom.json" replaces value from "base.json"!')
-                    self.commands[key] = value
+                    commands[key] = value
         else:
             self.logger.warning('custom.json file not found!')
+        return commands
+
+    @staticmethod
+    def _key_options(commands: Dict[str, Dict]) -> Tuple[Dict[str, RepeatOptions], Dict[str, float]]:
+        """
+        :return: "repeat" and "debounce" options of keys that set them
+        :raises AssertionError: on invalid option
+        """
+        repeat_options = {key_name: parse_repeat_options(renderers.get('repeat'))
+                          for key_name, renderers in commands.items()}
+        debounce_windows = {key_name: parse_debounce_window(renderers.get('debounce'))
+                            for key_name, renderers in commands.items()}
+        return ({key_name: options for key_name, options in repeat_options.items() if options},
+                {key_name: window for key_name, window in debounce_windows.items() if window is not None})
+
+    def reload(self) -> bool:
+        """
+        Load keymaps and commands again and swap them in at once. Invalid files are rejected and the loaded ones kept.
+        Key presses are handled meanwhile.
+
+        :return: True if reloaded
+        """
+        start = monotonic()
+        remotes = self.config.remotes if not self.keymap_file else [self.keymap_file]
+        try:
+            keymap = self._read_keymap(remotes)
+            assert keymap, 'keymap is empty'
+            code_index = build_code_index(keymap)
+            pulse_matcher = self._build_pulse_matcher(remotes, keymap)
+
+            commands = self._read_commands()
+            repeat_options, debounce_windows = self._key_options(commands)
+            targets = command_targets(commands)
+
+            with self._handlers_lock:
+                # Same lock as handler registration - a handler that gets ready now compiles the new commands
+                plan = compile_plan(commands, self.handlers) if self.plan is not None else None
+
+                self.keymap, self.code_index = keymap, code_index
+                self.commands, self.command_targets, self.plan = commands, targets, plan
+                self.pin_bound_keys = pin_bound_keys(commands)
+                self.repeater.options = repeat_options
+                self.debouncer.windows = debounce_windows
+                self._set_pulse_matcher(pulse_matcher)
+        except (OSError, ValueError, AssertionError) as e:
+            self.logger.error(f'Reload failed, keeping current keymaps and commands: {e}')
+            return False
+
+        elapsed = monotonic() - start
+        METRICS.observe('reload', elapsed)
+        self.logger.info(f'Keymaps and commands reloaded in {elapsed * 1000:.1f}ms')
+        return True
 
     def record_key(self) -> list:
         codes = []
         return_codes = []
         while True:
-            code = self.event_queue.dequeue()
-            if code is None:
+            event = self.event_queue.dequeue_event()
+            if event is None or event.repeat:
                 continue
+            code = event.item
 
             if codes and code == codes[-1]:
                 # Same code twice in a row
@@ -220,6 +541,14 @@ class ControllerApp(object):
             print('\t\tPress the key again to verify')
 
     def setup(self, file_name):
+        from input.pulse_templates import PulseCollector, build_template, load_templates, save_templates
+
+        templates_path = templates_file(path.join(DIR, 'keymaps', file_name))
+        templates = load_templates(templates_path)
+        collector = PulseCollector()
+        for _ih in self.input_handlers:
+            _ih.tracer = collector
+
         try:
             self.load_keymap(file_name)
 
@@ -231,6 +560,7 @@ class ControllerApp(object):
                     action = input(f'Button "{key_name}" \t(recorded: {recorded_len}) '
                                    f'[(R)ecord / (D)elete last / (C)lear all / (N)ext / (E)nd]: ')
                     if action.lower() == 'r':
+                        collector.clear()
                         codes = self.record_key()
 
                         if key_name not in self.keymap:
@@ -240,9 +570,18 @@ class ControllerApp(object):
                             if code not in self.keymap[key_name]:
                                 self.keymap[key_name].append(code)
 
+                            # Pulse template for matching the key without decoding (IR only)
+                            template = build_template(collector.pulses_of(code))
+                            if template:
+                                templates = [_template for _template in templates
+                                             if _template['key'] != key_name or _template['code'] != code]
+                                templates.append({'key': key_name, 'code': code, 'pulses': template})
+
                     elif action.lower() == 'd':
                         if self.keymap[key_name]:
-                            self.keymap[key_name].pop(-1)
+                            code = self.keymap[key_name].pop(-1)
+                            templates = [template for template in templates
+                                         if template['key'] != key_name or template['code'] != code]
 
                     elif action.lower() == 'c':
                         self.keymap[key_name] = list()
@@ -264,18 +603,149 @@ class ControllerApp(object):
                 with open(path.join(DIR, 'keymaps', file_name), 'w') as keymap_file:
                     json.dump(self.keymap, keymap_file, indent=2)
 
+            for _ih in self.input_handlers:
+                _ih.tracer = None
+            templates = [template for template in templates
+                         if template['code'] in self.keymap.get(template['key'], [])]
+            if templates or path.exists(templates_path):
+                save_templates(templates_path, templates)
+
             self.load_keymap()
 
-    def _execute(self, element: Tuple):
-        (func, args) = element
-        self.logger.debug(f"Running command {args}")
+    def record(self, trace_file, file_name=None):
+        """
+        Monitor keys in test mode while writing raw input events to a trace file
+        """
+        from input.trace import TraceRecorder
+
+        recorder = TraceRecorder(trace_file, ir_gpio_pin=self.config.ir_gpio_pin,
+                                 keyboard_event_type=self.config.keyboard_event_type)
+        for _ih in self.input_handlers:
+            _ih.tracer = recorder
+
+        self.logger.info(f'Recording input to {trace_file}, press Ctrl+C to finish')
         try:
-            func(*args)
-        except Exception as e:
-            self.logger.exception(e)
+            self.monitor(file_name)
+        finally:
+            for _ih in self.input_handlers:
+                _ih.tracer = None
+            recorder.close()
+            self.logger.info(f'Recorded {recorder.count} events to {trace_file}')
+
+    def replay(self, trace_file, file_name=None, speed: Optional[float] = 1.0, decode=True):
+        """
+        Run keys from a trace file instead of live input, returns when the whole trace was handled
+        """
+        from input.trace import TraceReplayer
+
+        replayer = TraceReplayer(trace_file, self.event_queue, speed=speed, decode=decode,
+                                 event_type=self.config.keyboard_event_type)
+        self.load_keymap(file_name)
+        replayer.matcher = self.pulse_matcher
+        replayer.ir_decoder.pin_bound = self.is_pin_bound
+
+        def _replay():
+            replayer.run()
+            while self.event_queue.has_more():
+                sleep(0.05)
+            self.event_queue.stop()
+
+        Thread(target=_replay, daemon=True).start()
+        self.monitor(file_name)
+        self.logger.info(f'Replay finished: {replayer.replayed} events in {replayer.duration:.2f}s, '
+                         f'{replayer.mismatched} decoded differently, queue {self.event_queue.stats}')
+
+    def _coalesce(self, key_name, event: QueuedEvent, operation: Operation) -> Operation:
+        """
+        Merge queued presses of the same key into a single operation with summed value
+        """
+        # Other receivers report presses of keys with pin-bound commands too - those are not further presses
+        same_pin = key_name in self.pin_bound_keys
+        merged = self.event_queue.take_while(
+            lambda _event: not _event.repeat and _event.timestamp - event.timestamp <= operation.coalesce and
+            lookup_key(self.code_index, _event.item) == key_name and (not same_pin or _event.gpio == event.gpio),
+            priority=event.priority)
+
+        if not merged:
+            return operation
+
+        self.logger.debug(f'Coalesced {len(merged) + 1} "{key_name}" presses')
+        return operation.with_value(operation.args['value'] * (len(merged) + 1))
+
+    def lookup_event(self, event: QueuedEvent) -> Optional[str]:
+        """
+        Find key name of a dequeued event, recording queue wait and lookup times
+        """
+        start = monotonic()
+        key_name = lookup_key(self.code_index, event.item)
+        METRICS.observe('queue_wait', start - event.timestamp, key=key_name)
+        METRICS.observe('keymap_lookup', monotonic() - start, key=key_name)
+        return key_name
+
+    def select_operations(self, key_name, event: QueuedEvent) -> Tuple[Operation, ...]:
+        """
+        Pick compiled operations of a key matching the currently active renderer
+        """
+        key_plan = self.plan.get(key_name)
+        if not key_plan:
+            return ()
+
+        if set(key_plan.keys()) - {'global'}:
+            with METRICS.timer('renderer_lookup', key=key_name):
+                renderer = MoodeHandler().get_active_renderer()
+        else:
+            # Same commands for every renderer - Moode is not asked
+            renderer = 'global'
+        operations = filter_gpio(select_operations(key_plan, renderer), event.gpio)
+        if key_name in self.pin_bound_keys and event.gpio is not None and not event.repeat:
+            operations = self._once_per_pin(key_name, event, operations)
+
+        if len(operations) == 1 and operations[0].coalesce:
+            operations = (self._coalesce(key_name, event, operations[0]),)
+
+        return operations
+
+    def _once_per_pin(self, key_name, event: QueuedEvent, operations: Tuple[Operation, ...]) -> Tuple[Operation, ...]:
+        """
+        Every receiver that saw a press of a key with pin-bound commands reports it. The first report runs the
+        commands for its pin, the others only commands bound to their own pins which did not run yet.
+        """
+        last = self._pin_presses.get(key_name)
+        if last and event.timestamp - last[0] < CROSS_PIN_WINDOW and event.gpio not in last[1]:
+            self._pin_presses[key_name] = (last[0], last[1] | {event.gpio})
+            return filter_handled_pins(operations, last[1])
+
+        self._pin_presses[key_name] = (event.timestamp, frozenset([event.gpio]))
+        return operations
+
+    def defer_event(self, key_name, event: QueuedEvent) -> bool:
+        """
+        Hold a key press back while a target it needs is still initializing
+
+        :return: True if the press was held back (or dropped - repeats of held keys are not run later)
+        """
+        if not self.pending.waiting:
+            return False
+
+        def _hold(target) -> bool:
+            if event.repeat:
+                return self.pending.is_waiting(target)
+            return self.pending.defer(target, event)
+
+        key_targets = self.command_targets.get(key_name, {})
+        if set(key_targets.keys()) - {'global'}:
+            # Active renderer is unknown until Moode responds
+            if _hold('moode'):
+                return True
+            renderer = MoodeHandler().get_active_renderer()
+        else:
+            renderer = 'global'
+
+        return any(_hold(target) for target in select_operations(key_targets, renderer))
 
     def monitor(self, file_name=None):
-        self.load_keymap(file_name=file_name)
+        with self.profile.phase('load_keymap'):
+            self.load_keymap(file_name=file_name)
 
         if file_name:
             self.logger.info(f'Loaded keymap {file_name}')
@@ -288,52 +758,137 @@ class ControllerApp(object):
         if diff:
             self.logger.info(f'Some keys are missing from setup! \n\t{pformat(diff)}')
 
-        self.logger.info('Monitoring started' + (' (test mode)' if self.test_mode else ''))
+        if self.plan is None and not self.test_mode:
+            self.verify_commands()
+
+        self.profile.mark('monitoring')
+        if self.print_profile:
+            Thread(target=self._print_profile, name='startup-profile', daemon=True).start()
+
+        if self.config.hot_reload:
+            from input.file_watch import FileWatcher
+            self.watcher = FileWatcher([path.join(DIR, 'keymaps'), path.join(DIR, 'commands')], self.reload)
+            self.watcher.start()
+
+        if self.use_asyncio:
+            from dispatch.async_runtime import AsyncRuntime
+            self.logger.info('Monitoring started (asyncio)')
+            self.runtime = AsyncRuntime(self)
+            self.runtime.run()
+        else:
+            self.logger.info('Monitoring started' + (' (test mode)' if self.test_mode else ''))
+            self.dispatch_events()
+
+        if self.init_error:
+            raise self.init_error
+
+    def _print_profile(self):
+        # Handlers become ready while monitoring already runs
+        self.wait_ready(timeout=INIT_TIMEOUT)
+        print(self.profile.report())
+
+    def dispatch_events(self):
+        """
+        Run commands of queued key presses until the event queue is stopped
+        """
         while True:
-            code = self.event_queue.dequeue()
-            try:
-                key_name = None
-                for _key, _codes in self.keymap.items():
-                    if isinstance(_codes, str):
-                        # Keymap description fields
-                        continue
+            event = self.event_queue.dequeue_event()
+            if event is None:
+                if not self.event_queue.is_running:
+                    break
+                continue
 
-                    if code in _codes:
-                        key_name = _key
+            key_name = self.lookup_event(event)
+            if key_name not in self.commands or not self.repeater.accept(key_name, event):
+                continue
 
-                command = self.commands[key_name]
-                if self.test_mode:
-                    print(f'Key "{key_name}" received.')
-                    continue
-            except KeyError:
+            if self.test_mode:
+                print(f'Key "{key_name}" ' + ('repeated.' if event.repeat else 'received.'))
                 continue
 
-            if isinstance(command, tuple):
-                self._execute(command)
-            elif isinstance(command, dict):
-                renderer = MoodeHandler().get_active_renderer()
-                if renderer in command.keys():
-                    commands = command[renderer]
-                elif 'global' in command.keys():
-                    commands = command['global']
-                else:
+            try:
+                if self.defer_event(key_name, event):
                     continue
+                operations = self.select_operations(key_name, event)
+            except Exception as e:
+                self.logger.exception(e)
+                continue
+            if self._merge_waiting(key_name, event, operations):
+                continue
+            on_discard = None
+            if operations and self.repeater.tracks(key_name):
+                # Key can repeat - mark it busy until its last command finished or the press was dropped
+                self.repeater.started(key_name)
+                on_discard = partial(self.repeater.finished, key_name)
+            self.lanes.submit_chain(self._jobs(key_name, operations), created=event.timestamp, on_discard=on_discard)
+
+    def _merge_waiting(self, key_name, event: QueuedEvent, operations: Tuple[Operation, ...]) -> bool:
+        """
+        Coalesce a press into the same key's press still waiting in the lane of its target - presses taken out of
+        the event queue while a slow command runs are merged there instead
+
+        :return: True if merged
+        """
+        if len(operations) != 1 or not operations[0].coalesce or event.repeat:
+            return False
+        operation = operations[0]
+
+        def _match(args, created) -> bool:
+            return created is not None and args[0] == key_name and args[1].coalesce and \
+                args[1].gpio == operation.gpio and event.timestamp - created <= operation.coalesce
+
+        def _update(args):
+            return args[0], args[1].with_value(args[1].args['value'] + operation.args['value'])
+
+        if not self.lanes.merge(operation.target, _match, _update):
+            return False
+        self.logger.debug(f'Coalesced "{key_name}" press with a waiting one')
+        return True
+
+    def _jobs(self, key_name, operations: Tuple[Operation, ...]) -> List[Tuple]:
+        jobs = [(operation.target, self._run, (key_name, operation)) for operation in operations]
+        if jobs and self.repeater.tracks(key_name):
+            jobs[-1] = (operations[-1].target, self._run_last, (key_name, operations[-1]))
+        return jobs
 
-                if not isinstance(commands, list):
-                    commands = [commands]
+    @staticmethod
+    def _run(key_name, operation: Operation):
+        operation.timed(key_name)
 
-                for command_dict in commands:
-                    handler: BaseActionHandler = self.get_handler(command_dict['target'])
-                    if handler:
-                        self._execute((handler.call, [command_dict]))
+    def _run_last(self, key_name, operation: Operation):
+        try:
+            operation.timed(key_name)
+        finally:
+            self.repeater.finished(key_name)
 
 
 if __name__ == '__main__':
     if '-h' in sys.argv[1:] or 'help' in sys.argv[1:]:
         print('')  # TODO
 
-    _test_mode = 'test' in sys.argv[1:] or 'setup' in sys.argv[1:]
-    controller_app = ControllerApp(test_mode=_test_mode)
+    if 'stats' in sys.argv[1:]:
+        from metrics.server import print_stats
+        _config = Config()
+        _config.load()
+        print_stats(_config.metrics['listen_ip'], _config.metrics['listen_port'])
+        sys.exit(0)
+
+    if 'bench' in sys.argv[1:]:
+        from benchmarks.end_to_end import main as bench
+        sys.exit(bench(sys.argv[sys.argv.index('bench') + 1:]))
+
+    _test_mode = 'test' in sys.argv[1:] or 'setup' in sys.argv[1:] or 'record' in sys.argv[1:]
+
+    _profile = StartupProfile()
+    _config = None
+    if 'replay' in sys.argv[1:]:
+        # Trace replaces live input
+        _config = Config()
+        _config.load()
+        _config.enable_ir_remote = False
+        _config.enable_usb_remote = False
+    controller_app = ControllerApp(test_mode=_test_mode, config=_config, profile=_profile)
+    controller_app.print_profile = '--startup-profile' in sys.argv[1:]
 
     _file_name = 'default.json'
     for arg in sys.argv[1:]:
@@ -341,6 +896,22 @@ if __name__ == '__main__':
             _file_name = arg
             break
 
+    if 'record' in sys.argv[1:] or 'replay' in sys.argv[1:]:
+        _trace_mode = 'record' if 'record' in sys.argv[1:] else 'replay'
+        _trace_file = sys.argv[sys.argv.index(_trace_mode) + 1]
+        _keymap = _file_name if any(arg.endswith('json') for arg in sys.argv[1:]) else None
+
+        if _trace_mode == 'record':
+            controller_app.record(_trace_file, _keymap)
+        else:
+            _speed = 1.0
+            if '--speed' in sys.argv[1:]:
+                _speed_arg = sys.argv[sys.argv.index('--speed') + 1]
+                _speed = None if _speed_arg == 'max' else float(_speed_arg)
+            controller_app.replay(_trace_file, _keymap, speed=_speed, decode='--no-decode' not in sys.argv[1:])
+        controller_app.stop()
+        sys.exit()
+
     if 'setup' in sys.argv[1:]:
         controller_app.setup(_file_name)
         controller_app.stop()
@@ -0,0 +1,6 @@
+from os import path
+import sys
+
+
+# Modules of the script are imported the same way mpd_control.py does - from the repository root
+sys.path.insert(0, path.dirname(path.dirname(path.realpath(__file__))))
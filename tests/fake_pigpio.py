@@ -0,0 +1,101 @@
+from typing import Callable, Dict, List
+
+
+class FakeCallback(object):
+
+    def __init__(self, gpio, func):
+        self.gpio = gpio
+        self.func = func
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class FakePi(object):
+    """
+    pigpio.pi stand-in - edges are fed by the test through send() instead of a pigpio daemon
+    """
+
+    def __init__(self, connected=True):
+        self.connected = connected
+        self.modes: Dict[int, int] = dict()
+        self.glitch: Dict[int, int] = dict()
+        self.watchdog: Dict[int, int] = dict()
+        self.callbacks: Dict[int, FakeCallback] = dict()
+        self.stopped = False
+        self.tick = 0
+
+    def set_mode(self, gpio, mode):
+        self.modes[gpio] = mode
+
+    def set_glitch_filter(self, gpio, steady):
+        self.glitch[gpio] = steady
+
+    def set_watchdog(self, gpio, timeout):
+        self.watchdog[gpio] = timeout
+
+    def callback(self, gpio, edge, func: Callable[[int, int, int], None]) -> FakeCallback:
+        self.callbacks[gpio] = FakeCallback(gpio, func)
+        return self.callbacks[gpio]
+
+    def stop(self):
+        self.stopped = True
+
+    def edge(self, gpio, level, usec):
+        """
+        Report an edge (or watchdog timeout) 'usec' after the previous one
+        """
+        self.tick = (self.tick + usec) & 0xffffffff
+        callback = self.callbacks[gpio]
+        if not callback.cancelled:
+            callback.func(gpio, level, self.tick)
+
+    def send(self, gpio, ticks: List[int], idle=50000):
+        """
+        Feed a tick stream - pulse and space lengths (us) of one transmission, the line is idle for 'idle' us before
+        it and the watchdog fires after it
+        """
+        self.edge(gpio, 0, idle)
+        level = 1
+        for usec in ticks:
+            self.edge(gpio, level, usec)
+            level ^= 1
+        self.edge(gpio, FakePigpio.TIMEOUT, self.watchdog.get(gpio, 200) * 1000)
+
+
+class FakePigpio(object):
+    """
+    Stand-in for the pigpio module, passed to IrReceiver/IrMonitor as 'pigpio_module'
+    """
+    INPUT = 0
+    EITHER_EDGE = 2
+    TIMEOUT = 2
+
+    def __init__(self, connected=True):
+        self.connected = connected
+        self.instances: List[FakePi] = []
+
+    def pi(self) -> FakePi:
+        self.instances.append(FakePi(self.connected))
+        return self.instances[-1]
+
+    @property
+    def last(self) -> FakePi:
+        return self.instances[-1]
+
+    @staticmethod
+    def tickDiff(t1, t2):
+        return (t2 - t1) & 0xffffffff
+
+
+def nec_frame(address: int, command: int) -> List[int]:
+    """
+    Pulse and space lengths (us) of an NEC frame
+    """
+    ticks = [9000, 4500]
+    for byte in [address, address ^ 0xff, command, command ^ 0xff]:
+        for bit in range(8):
+            ticks += [560, 1690 if (byte >> bit) & 1 else 560]
+    ticks.append(560)
+    return ticks
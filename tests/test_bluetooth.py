@@ -0,0 +1,122 @@
+from handlers.bluetooth import AmixerSession, BluetoothHandler
+from time import monotonic, sleep
+import os
+import stat
+import sys
+import pytest
+
+
+STATUS = """Simple mixer control 'Phone - A2DP',0
+  Capabilities: pvolume pswitch
+  Playback channels: Front Left - Front Right
+  Limits: Playback 0 - 127
+  Mono:
+  Front Left: Playback 51 [40%] [on]
+  Front Right: Playback 51 [40%] [on]
+"""
+
+# Records arguments and stdin lines of every run, prints STATUS when not in stdin mode
+FAKE_AMIXER = f"""#!{sys.executable}
+import os, sys
+log = os.environ['FAKE_AMIXER_LOG']
+with open(log, 'a') as file:
+    file.write('run ' + ' '.join(sys.argv[1:]) + '\\n')
+if '-s' not in sys.argv:
+    sys.stdout.write({STATUS!r})
+    sys.exit(0)
+for line in sys.stdin:
+    with open(log, 'a') as file:
+        file.write(line)
+"""
+
+
+@pytest.fixture
+def amixer_log(tmp_path, monkeypatch):
+    binary = tmp_path / 'amixer'
+    binary.write_text(FAKE_AMIXER)
+    binary.chmod(binary.stat().st_mode | stat.S_IEXEC)
+
+    log = tmp_path / 'amixer.log'
+    log.write_text('')
+    monkeypatch.setenv('PATH', f'{tmp_path}{os.pathsep}{os.environ["PATH"]}')
+    monkeypatch.setenv('FAKE_AMIXER_LOG', str(log))
+    return log
+
+
+def _lines(log, count, timeout=5.0):
+    deadline = monotonic() + timeout
+    while True:
+        lines = log.read_text().splitlines()
+        if len(lines) >= count or monotonic() > deadline:
+            return lines
+        sleep(0.01)
+
+
+def test_sset_lines_go_through_one_process(amixer_log):
+    session = AmixerSession()
+    try:
+        session.send('sset "Phone - A2DP" 45%')
+        session.send('sset "Phone - A2DP" 50%')
+        assert _lines(amixer_log, 3) == ['run -q -D bluealsa -s', 'sset "Phone - A2DP" 45%', 'sset "Phone - A2DP" 50%']
+    finally:
+        session.close()
+
+
+def test_session_restarts_after_process_dies(amixer_log):
+    session = AmixerSession()
+    try:
+        session.send('sset "Phone - A2DP" 45%')
+        _lines(amixer_log, 2)
+        first = session._process
+        first.kill()
+        first.wait()
+
+        session.send('sset "Phone - A2DP" 50%')
+        assert session._process is not first
+        assert _lines(amixer_log, 4) == ['run -q -D bluealsa -s', 'sset "Phone - A2DP" 45%',
+                                         'run -q -D bluealsa -s', 'sset "Phone - A2DP" 50%']
+    finally:
+        session.close()
+
+
+def test_close_ends_process(amixer_log):
+    session = AmixerSession()
+    session.send('sset "Phone - A2DP" 45%')
+    process = session._process
+    session.close()
+    assert process.poll() is not None
+
+
+def test_status_is_parsed_and_volume_stepped(amixer_log):
+    handler = BluetoothHandler()
+    handler.amixer = AmixerSession()
+    handler._status_time = 0.0
+    try:
+        assert handler._get_device_status() == {'device_name': 'Phone - A2DP', 'volume': '40'}
+
+        handler.call({'target': 'bluetooth', 'command': 'vol_up', 'value': 5})
+        handler.call({'target': 'bluetooth', 'command': 'vol_dn', 'value': '20'})
+        # Status is cached - amixer runs once to read it, steps are relative to the level amixer sees
+        assert _lines(amixer_log, 4) == ['run -D bluealsa', 'run -q -D bluealsa -s',
+                                         'sset "Phone - A2DP" 5%+', 'sset "Phone - A2DP" 20%-']
+    finally:
+        handler.stop()
+
+
+def test_mute_reads_current_volume(amixer_log):
+    handler = BluetoothHandler()
+    handler.amixer = AmixerSession()
+    handler._status_time = 0.0
+    handler.last_volume = 0
+    try:
+        handler.call({'target': 'bluetooth', 'command': 'vol_up', 'value': 5})
+        handler.call({'target': 'bluetooth', 'command': 'mute'})
+        handler.call({'target': 'bluetooth', 'command': 'mute'})
+        lines = _lines(amixer_log, 7)
+        # Session process logs its input on its own - only the order of set commands is certain
+        assert [line for line in lines if line.startswith('sset')] == \
+            ['sset "Phone - A2DP" 5%+', 'sset "Phone - A2DP" 0%', 'sset "Phone - A2DP" 40%']
+        # Status read for the first command and for each mute
+        assert lines.count('run -D bluealsa') == 3
+    finally:
+        handler.stop()
@@ -0,0 +1,186 @@
+from benchmarks.end_to_end import SCENARIOS, Bench, _write_token
+from benchmarks.fakes import FakeMoode, FakeSpotify
+from dispatch.lanes import LaneDispatcher
+from dispatch.plan import Operation
+from handlers.base_handler import Singleton
+from input.debounce import Debouncer
+from input.event_queue import PRIORITY_NORMAL, QueuedEvent
+from mpd_control import ControllerApp
+from types import SimpleNamespace
+from threading import Event
+from time import monotonic, sleep
+import pytest
+
+
+class SlowBackend(object):
+    """
+    Command target that blocks every call until released
+    """
+
+    def __init__(self):
+        self.calls = []
+        self.release = Event()
+        self.entered = Event()
+
+    def call(self, value):
+        self.entered.set()
+        self.release.wait(5)
+        self.calls.append(value)
+
+
+def _add(args):
+    return args[0] + 1,
+
+
+@pytest.fixture
+def backend():
+    fake = SlowBackend()
+    yield fake
+    fake.release.set()
+
+
+def test_presses_merge_into_waiting_job(backend):
+    lanes = LaneDispatcher(['moode'])
+    try:
+        lanes.submit_chain([('moode', backend.call, (1,))], created=0.0)
+        backend.entered.wait(5)
+        lanes.submit_chain([('moode', backend.call, (1,))], created=0.0)
+        # Running job is not changed, the waiting one collects later presses
+        for _ in range(5):
+            assert lanes.merge('moode', lambda args, created: True, _add)
+        backend.release.set()
+        assert lanes.wait_idle(timeout=5)
+        assert backend.calls == [1, 6]
+        assert lanes.stats['moode']['coalesced'] == 5
+    finally:
+        lanes.stop(timeout=5)
+
+
+def test_merge_skips_chained_and_rejected_jobs(backend):
+    lanes = LaneDispatcher(['moode', 'shell'])
+    try:
+        lanes.submit_chain([('moode', backend.call, (1,))])
+        backend.entered.wait(5)
+        assert not lanes.merge('moode', lambda args, created: True, _add)
+
+        lanes.submit_chain([('moode', backend.call, (1,)), ('shell', backend.call, (1,))])
+        assert not lanes.merge('moode', lambda args, created: True, _add)
+        lanes.submit_chain([('moode', backend.call, (1,))])
+        assert not lanes.merge('moode', lambda args, created: False, _add)
+    finally:
+        backend.release.set()
+        lanes.stop(timeout=5)
+    assert backend.calls == [1, 1, 1, 1]
+
+
+def test_stale_press_expires(backend):
+    lanes = LaneDispatcher(['moode'], max_age=0.1)
+    discarded = []
+    try:
+        lanes.submit_chain([('moode', backend.call, (1,))])
+        backend.entered.wait(5)
+        lanes.submit_chain([('moode', backend.call, (2,))], created=monotonic(), on_discard=lambda: discarded.append(2))
+        # Press without a time never expires
+        lanes.submit_chain([('moode', backend.call, (3,))])
+        sleep(0.2)
+        backend.release.set()
+        assert lanes.wait_idle(timeout=5)
+    finally:
+        lanes.stop(timeout=5)
+    assert backend.calls == [1, 3]
+    assert discarded == [2]
+    assert lanes.stats['moode']['expired'] == 1
+
+
+def test_full_lane_drops_oldest_press(backend):
+    lanes = LaneDispatcher(['moode'], max_len=2)
+    discarded = []
+    try:
+        lanes.submit_chain([('moode', backend.call, (0,))])
+        backend.entered.wait(5)
+        for value in range(1, 5):
+            lanes.submit_chain([('moode', backend.call, (value,))],
+                               on_discard=lambda _value=value: discarded.append(_value))
+        backend.release.set()
+        assert lanes.wait_idle(timeout=5)
+    finally:
+        lanes.stop(timeout=5)
+    assert backend.calls == [0, 3, 4]
+    assert discarded == [1, 2]
+    assert lanes.stats['moode']['dropped'] == 2
+
+
+def _operation(name, gpio=None) -> Operation:
+    return Operation('shell', None, lambda args: None, {'name': name}, gpio=frozenset(gpio) if gpio else None)
+
+
+def test_pin_bound_press_runs_commands_of_every_pin_once():
+    app = SimpleNamespace(_pin_presses=dict())
+    operations = {24: (_operation('all'), _operation('24', [24]), _operation('24/25', [24, 25])),
+                  25: (_operation('all'), _operation('25', [25]), _operation('24/25', [24, 25])),
+                  26: (_operation('all'), _operation('26', [26]))}
+
+    def _run(gpio, timestamp):
+        event = QueuedEvent({'data': '10ef20df'}, timestamp, PRIORITY_NORMAL, False, gpio)
+        return [operation.args['name']
+                for operation in ControllerApp._once_per_pin(app, 'play', event, operations[gpio])]
+
+    # Whichever pin decodes first, the same commands run
+    assert _run(25, 10.0) + _run(24, 10.01) + _run(26, 10.02) == ['all', '25', '24/25', '24', '26']
+    assert _run(24, 20.0) + _run(25, 20.01) + _run(26, 20.02) == ['all', '24', '24/25', '25', '26']
+    # Same pin again, or after the window - a new press
+    assert _run(24, 20.05) == ['all', '24', '24/25']
+    assert _run(25, 21.0) == ['all', '25', '24/25']
+
+
+def test_pin_bound_keys_are_debounced_per_pin():
+    debouncer = Debouncer(dict(), default_window=0.15)
+    assert not debouncer.suppress('play', 10.0, pin=24)
+    assert not debouncer.suppress('play', 10.01, pin=25)
+    assert debouncer.suppress('play', 10.05, pin=24)
+    assert not debouncer.suppress('next', 10.0)
+    assert debouncer.suppress('next', 10.05)
+
+
+@pytest.fixture
+def bench(tmp_path, request):
+    moode = FakeMoode(latency=0.2)
+    spotify = FakeSpotify(moode)
+    moode.start()
+    spotify.start()
+    cache_path = str(tmp_path / '.cache')
+    _write_token(cache_path)
+    fake = Bench(moode, spotify, cache_path, runtime=request.param)
+    yield fake
+    fake.stop()
+    moode.close()
+    spotify.close()
+    # Handlers were stopped with the app - later tests get new ones
+    Singleton._instances.clear()
+
+
+def _scenario(name):
+    scenario, = [scenario for scenario in SCENARIOS if scenario.name == name]
+    return scenario
+
+
+@pytest.mark.parametrize('bench', ['threads', 'asyncio'], indirect=True)
+def test_presses_behind_slow_backend_are_coalesced(bench):
+    result = bench.run(_scenario('volume_burst'), 20)
+    assert result['missed'] == 0
+    assert result['calls'] <= 4
+    assert result['p99'] < 1.0
+
+
+@pytest.mark.parametrize('bench', ['threads', 'asyncio'], indirect=True)
+def test_presses_behind_slow_backend_expire(bench):
+    if bench.runtime:
+        bench.runtime.max_age = 0.5
+    else:
+        for lane in bench.app.lanes.lanes.values():
+            lane.max_age = 0.5
+    # Each press takes longer than the time between presses
+    result = bench.run(_scenario('playlist_load'), 10)
+    assert 0 < result['missed'] < 10
+    expired = bench.runtime.expired if bench.runtime else bench.app.lanes.stats['moode']['expired']
+    assert expired == result['missed']
@@ -0,0 +1,243 @@
+from input import evdev_remote
+from input.evdev_remote import INPUT_EVENT, AsyncEvdevSource, EvdevReader, EvdevRemoteMonitor
+from time import monotonic, sleep
+import asyncio
+import os
+import pytest
+
+
+EV_SYN = 0
+EV_KEY = 1
+EV_MSC = 4
+KEY_PLAYPAUSE = 164
+KEY_VOLUMEUP = 115
+
+
+class FakeQueue(object):
+
+    def __init__(self):
+        self.events = []
+
+    def enqueue(self, item, repeat=False, **kwargs):
+        self.events.append((item, repeat))
+
+
+class FakeDevices(object):
+    """
+    /dev/input and /sys/class/input stand-ins - event devices are named pipes the test writes input events to
+    """
+
+    def __init__(self, root):
+        self.input_dir = str(root / 'input')
+        self.sysfs_dir = str(root / 'sys')
+        os.makedirs(self.input_dir)
+        os.makedirs(self.sysfs_dir)
+        self.writers = dict()
+
+    def add(self, node, name, vendor='1d57', product='ad02', capabilities='120013'):
+        device_dir = os.path.join(self.sysfs_dir, node, 'device')
+        os.makedirs(os.path.join(device_dir, 'id'))
+        os.makedirs(os.path.join(device_dir, 'capabilities'))
+        for file_name, value in [('name', name), ('id/vendor', vendor), ('id/product', product),
+                                 ('capabilities/ev', capabilities)]:
+            with open(os.path.join(device_dir, file_name), 'w') as file:
+                file.write(value + '\n')
+        os.mkfifo(os.path.join(self.input_dir, node))
+
+    def remove(self, node):
+        if node in self.writers:
+            os.close(self.writers.pop(node))
+        os.unlink(os.path.join(self.input_dir, node))
+
+    def write(self, node, data: bytes):
+        if node not in self.writers:
+            self.writers[node] = os.open(os.path.join(self.input_dir, node), os.O_WRONLY | os.O_NONBLOCK)
+        os.write(self.writers[node], data)
+
+    def close(self):
+        for writer in self.writers.values():
+            os.close(writer)
+
+
+def key(code, value) -> bytes:
+    # Key event followed by the scan code and a report separator, as a real keyboard sends them
+    return INPUT_EVENT.pack(0, 0, EV_MSC, 4, code) + INPUT_EVENT.pack(0, 0, EV_KEY, code, value) + \
+        INPUT_EVENT.pack(0, 0, EV_SYN, 0, 0)
+
+
+def press(code) -> bytes:
+    return key(code, 1) + key(code, 0)
+
+
+def _wait_for(predicate, timeout=5.0):
+    deadline = monotonic() + timeout
+    while not predicate():
+        assert monotonic() < deadline, 'timed out'
+        sleep(0.01)
+
+
+@pytest.fixture
+def devices(tmp_path):
+    fake = FakeDevices(tmp_path)
+    yield fake
+    fake.close()
+
+
+def _reader(devices, filters=(), event_type='up'):
+    queue = FakeQueue()
+    return EvdevReader(queue, event_type, filters, input_dir=devices.input_dir, sysfs_dir=devices.sysfs_dir), queue
+
+
+def _opened(reader):
+    return sorted(os.path.basename(device.path) for device in reader.devices.values())
+
+
+def test_filters_by_name_or_id(devices):
+    devices.add('event0', 'HID Remote', vendor='1d57', product='ad02')
+    devices.add('event1', 'Logitech Keyboard', vendor='046d', product='c52b')
+    devices.add('event2', 'Other Remote', vendor='0001', product='0002')
+
+    reader, _queue = _reader(devices, ['1D57:AD02', 'logitech keyboard'])
+    reader.scan()
+    try:
+        assert _opened(reader) == ['event0', 'event1']
+    finally:
+        reader.close_all()
+
+
+def test_devices_without_keys_are_skipped_without_filters(devices):
+    devices.add('event0', 'Remote')
+    # EV_SYN | EV_SW - a lid switch
+    devices.add('event1', 'Lid Switch', capabilities='21')
+    devices.add('event2', 'No sysfs')
+    devices.add('mouse0', 'Legacy node')
+
+    reader, _queue = _reader(devices)
+    os.rename(os.path.join(devices.sysfs_dir, 'event2'), os.path.join(devices.sysfs_dir, 'gone'))
+    reader.scan()
+    try:
+        assert _opened(reader) == ['event0', 'event2']
+    finally:
+        reader.close_all()
+
+
+def test_key_events_are_queued(devices):
+    devices.add('event0', 'Remote')
+    reader, queue = _reader(devices)
+    reader.scan()
+    try:
+        fd, = reader.devices.keys()
+        devices.write('event0', press(KEY_PLAYPAUSE))
+        reader.read(fd)
+        assert queue.events == [(KEY_PLAYPAUSE, False)]
+    finally:
+        reader.close_all()
+
+
+def test_partial_events_are_buffered(devices):
+    devices.add('event0', 'Remote')
+    reader, queue = _reader(devices)
+    reader.scan()
+    try:
+        fd, = reader.devices.keys()
+        data = press(KEY_PLAYPAUSE) + press(KEY_VOLUMEUP)
+        # Split inside events, not on their boundaries
+        for chunk in [data[:10], data[10:INPUT_EVENT.size * 4 + 3], data[INPUT_EVENT.size * 4 + 3:]]:
+            devices.write('event0', chunk)
+            reader.read(fd)
+        assert queue.events == [(KEY_PLAYPAUSE, False), (KEY_VOLUMEUP, False)]
+        assert reader.devices[fd].buffer == b''
+    finally:
+        reader.close_all()
+
+
+def test_autorepeat_of_held_key(devices):
+    devices.add('event0', 'Remote')
+    reader, queue = _reader(devices, event_type='down')
+    reader.scan()
+    try:
+        fd, = reader.devices.keys()
+        devices.write('event0', key(KEY_VOLUMEUP, 1) + key(KEY_VOLUMEUP, 2) + key(KEY_VOLUMEUP, 2) +
+                      key(KEY_VOLUMEUP, 0))
+        reader.read(fd)
+        assert queue.events == [(KEY_VOLUMEUP, False), (KEY_VOLUMEUP, True), (KEY_VOLUMEUP, True)]
+    finally:
+        reader.close_all()
+
+
+def test_closed_writer_closes_device(devices):
+    devices.add('event0', 'Remote')
+    reader, _queue = _reader(devices)
+    closed = []
+    reader.on_close = closed.append
+    reader.scan()
+
+    fd, = reader.devices.keys()
+    devices.write('event0', press(KEY_PLAYPAUSE))
+    os.close(devices.writers.pop('event0'))
+    reader.read(fd)
+    reader.read(fd)
+    assert closed == [fd]
+    assert not reader.devices
+
+
+def _monitor(devices, filters=()):
+    queue = FakeQueue()
+    monitor = EvdevRemoteMonitor(queue, 'up', filters, input_dir=devices.input_dir, sysfs_dir=devices.sysfs_dir)
+    monitor.start()
+    return monitor, queue
+
+
+@pytest.mark.parametrize('inotify', [True, False], ids=['inotify', 'rescan'])
+def test_monitor_hotplug(devices, monkeypatch, inotify):
+    if not inotify:
+        monkeypatch.setattr(evdev_remote, '_hotplug_watch', lambda input_dir: None)
+        monkeypatch.setattr(evdev_remote, 'RESCAN_INTERVAL', 0.05)
+        monkeypatch.setattr(evdev_remote, 'WAKE_INTERVAL', 0.05)
+
+    devices.add('event0', 'Remote')
+    monitor, queue = _monitor(devices, ['1d57:ad02'])
+    try:
+        _wait_for(lambda: _opened(monitor.reader) == ['event0'])
+        devices.write('event0', press(KEY_PLAYPAUSE))
+        _wait_for(lambda: queue.events == [(KEY_PLAYPAUSE, False)])
+
+        # Connected while running
+        devices.add('event1', 'Second remote')
+        _wait_for(lambda: _opened(monitor.reader) == ['event0', 'event1'])
+        devices.write('event1', press(KEY_VOLUMEUP))
+        _wait_for(lambda: queue.events == [(KEY_PLAYPAUSE, False), (KEY_VOLUMEUP, False)])
+
+        # Not matching filters
+        devices.add('event2', 'Keyboard', vendor='046d', product='c52b')
+        # Disconnected while running
+        devices.remove('event0')
+        _wait_for(lambda: _opened(monitor.reader) == ['event1'])
+    finally:
+        start = monotonic()
+        monitor.stop()
+        monitor.join(timeout=5)
+    assert not monitor.is_alive()
+    assert monotonic() - start < evdev_remote.WAKE_INTERVAL + 1
+    assert not monitor.reader.devices
+
+
+def test_async_source(devices):
+    devices.add('event0', 'Remote')
+    queue = FakeQueue()
+    source = AsyncEvdevSource(queue, 'up', input_dir=devices.input_dir, sysfs_dir=devices.sysfs_dir)
+
+    async def _run():
+        task = asyncio.create_task(source.run())
+        await asyncio.sleep(0.1)
+        devices.write('event0', press(KEY_PLAYPAUSE))
+        devices.add('event1', 'Second remote')
+        await asyncio.sleep(0.1)
+        devices.write('event1', press(KEY_VOLUMEUP))
+        await asyncio.sleep(0.1)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+    asyncio.run(_run())
+    assert queue.events == [(KEY_PLAYPAUSE, False), (KEY_VOLUMEUP, False)]
+    assert not source.reader.devices
@@ -0,0 +1,34 @@
+from input.event_queue import PRIORITY_HIGH, PRIORITY_NORMAL, Queue
+
+
+def _items(queue):
+    items = []
+    while queue.has_more():
+        items.append(queue.pop_event().item)
+    return items
+
+
+def test_full_queue_drops_oldest_least_important_event():
+    queue = Queue(max_len=3, max_age=0)
+    queue.enqueue('high', priority=PRIORITY_HIGH)
+    queue.enqueue('a')
+    queue.enqueue('b')
+    queue.enqueue('c')
+    assert _items(queue) == ['high', 'b', 'c']
+    assert queue.dropped == 1
+
+
+def test_full_queue_of_high_priority_events_drops_normal_one():
+    queue = Queue(max_len=2, max_age=0)
+    queue.enqueue('high 1', priority=PRIORITY_HIGH)
+    queue.enqueue('high 2', priority=PRIORITY_HIGH)
+    queue.enqueue('normal', priority=PRIORITY_NORMAL)
+    assert _items(queue) == ['high 1', 'high 2']
+    assert queue.dropped == 1
+
+    # High priority event still makes room among high priority ones
+    queue.enqueue('high 1', priority=PRIORITY_HIGH)
+    queue.enqueue('high 2', priority=PRIORITY_HIGH)
+    queue.enqueue('high 3', priority=PRIORITY_HIGH)
+    assert _items(queue) == ['high 2', 'high 3']
+    assert queue.dropped == 2
@@ -0,0 +1,213 @@
+from fake_pigpio import FakePigpio, nec_frame
+from input import ir
+from input.event_queue import Queue
+from input.ir import FRAME_GAP, IrDecoder, IrMonitor, IrPin, IrReceiver
+from time import monotonic, sleep
+import pytest
+
+
+def _receiver(pins=(24,)):
+    pigpio = FakePigpio()
+    receiver = IrReceiver([IrPin(pin) for pin in pins], pigpio_module=pigpio)
+    receiver.connect()
+    return receiver, pigpio.last
+
+
+def _wait_for(predicate, timeout=5.0):
+    deadline = monotonic() + timeout
+    while not predicate():
+        assert monotonic() < deadline, 'timed out'
+        sleep(0.01)
+
+
+def test_connect_configures_every_pin():
+    pigpio = FakePigpio()
+    receiver = IrReceiver([IrPin(24), IrPin(25, glitch=150, timeout=250)], pigpio_module=pigpio)
+    receiver.connect()
+
+    assert set(pigpio.last.callbacks) == {24, 25}
+    assert pigpio.last.glitch == {24: 100, 25: 150}
+    assert pigpio.last.watchdog == {24: 200, 25: 250}
+
+
+def test_watchdog_timeout_ends_frame():
+    receiver, pi = _receiver()
+    ticks = nec_frame(0x10, 0x20)
+
+    pi.edge(24, 0, 50000)
+    for level, usec in zip([1, 0] * len(ticks), ticks):
+        pi.edge(24, level, usec)
+    # Nothing is handed over while the line may still be active
+    assert receiver.receive(timeout=0) is None
+
+    pi.edge(24, FakePigpio.TIMEOUT, 200000)
+    pulses, repeat, gpio = receiver.receive(timeout=0)
+    assert pulses == ticks
+    assert not repeat
+    assert gpio == 24
+    assert IrMonitor.decode_frame(pulses)['data'] == '10ef20df'
+
+
+def test_timeout_while_idle_hands_nothing_over():
+    receiver, pi = _receiver()
+    pi.edge(24, FakePigpio.TIMEOUT, 200000)
+    pi.edge(24, FakePigpio.TIMEOUT, 200000)
+    assert receiver.receive(timeout=0) is None
+
+
+def test_frame_gap_splits_held_key():
+    receiver, pi = _receiver()
+    frame = nec_frame(0x10, 0x20)
+    # NEC repeat frame - leader and a single bit
+    held = [9000, 2250, 560]
+
+    pi.edge(24, 0, 50000)
+    level = 1
+    for ticks in [frame, held, held]:
+        for usec in ticks:
+            pi.edge(24, level, usec)
+            level ^= 1
+        # Space before the next frame
+        pi.edge(24, level, FRAME_GAP + 1000)
+        level ^= 1
+    pi.edge(24, FakePigpio.TIMEOUT, 200000)
+
+    frames = [receiver.receive(timeout=0) for _ in range(3)]
+    assert [pulses for pulses, _repeat, _gpio in frames] == [frame, held, held]
+    assert [repeat for _pulses, repeat, _gpio in frames] == [False, True, True]
+    assert receiver.receive(timeout=0) is None
+
+
+def test_space_shorter_than_frame_gap_does_not_split():
+    receiver, pi = _receiver()
+    ticks = [9000, 4500, 560, FRAME_GAP - 1, 560]
+    pi.send(24, ticks)
+    pulses, repeat, _gpio = receiver.receive(timeout=0)
+    assert pulses == ticks
+    assert not repeat
+
+
+def test_pins_capture_independently():
+    receiver, pi = _receiver((24, 25))
+    ticks = nec_frame(0x10, 0x20)
+
+    # Both receivers see the same transmission, their edges interleave
+    pi.edge(24, 0, 50000)
+    pi.edge(25, 0, 0)
+    level = 1
+    for usec in ticks:
+        pi.edge(24, level, usec)
+        pi.edge(25, level, 0)
+        level ^= 1
+    pi.edge(24, FakePigpio.TIMEOUT, 200000)
+    pi.edge(25, FakePigpio.TIMEOUT, 0)
+
+    frames = [receiver.receive(timeout=0) for _ in range(2)]
+    assert [(pulses, gpio) for pulses, _repeat, gpio in frames] == [(ticks, 24), (ticks, 25)]
+
+
+def test_receive_and_wake():
+    receiver, pi = _receiver()
+    start = monotonic()
+    assert receiver.receive(timeout=0.05) is None
+    assert monotonic() - start >= 0.05
+
+    receiver.wake()
+    assert receiver.receive(timeout=5) is None
+
+    pi.send(24, nec_frame(0x10, 0x20))
+    assert receiver.receive(timeout=5) is not None
+
+
+def test_on_frame_replaces_queue():
+    receiver, pi = _receiver()
+    frames = []
+    receiver.on_frame = lambda pulses, repeat, gpio: frames.append((pulses, repeat, gpio))
+    pi.send(24, nec_frame(0x10, 0x20))
+    assert len(frames) == 1
+    assert receiver.receive(timeout=0) is None
+
+
+def test_heartbeat(monkeypatch):
+    monkeypatch.setattr(ir, 'HEARTBEAT_TIMEOUT', 0.05)
+    receiver, pi = _receiver()
+    assert receiver.is_alive()
+
+    sleep(0.1)
+    assert not receiver.is_alive()
+    # Watchdog timeouts of an idle line keep the connection alive
+    pi.edge(24, FakePigpio.TIMEOUT, 200000)
+    assert receiver.is_alive()
+
+    receiver.disconnect()
+    assert not receiver.is_alive()
+    assert pi.stopped
+    assert pi.callbacks[24].cancelled
+    assert pi.watchdog[24] == 0
+
+
+def test_connect_fails_without_pigpiod():
+    receiver = IrReceiver([IrPin(24)], pigpio_module=FakePigpio(connected=False))
+    with pytest.raises(IOError):
+        receiver.connect()
+    assert not receiver.connected
+
+
+def test_monitor_reconnects_silent_connection(monkeypatch):
+    monkeypatch.setattr(ir, 'HEARTBEAT_TIMEOUT', 0.1)
+    pigpio = FakePigpio()
+    queue = Queue(max_age=0)
+    monitor = IrMonitor(queue, 24, pigpio_module=pigpio)
+    monitor.start()
+    try:
+        _wait_for(lambda: len(pigpio.instances) >= 2)
+        first = pigpio.instances[0]
+        assert first.stopped and first.callbacks[24].cancelled
+
+        # Keys work on the new connection - kept from now on
+        monkeypatch.setattr(ir, 'HEARTBEAT_TIMEOUT', 5.0)
+        sleep(0.2)
+        pigpio.last.send(24, nec_frame(0x10, 0x20))
+        _wait_for(queue.has_more)
+        event = queue.pop_event()
+        assert event.item['data'] == '10ef20df'
+        assert event.gpio == 24
+    finally:
+        monitor.stop()
+        monitor.join(timeout=5)
+    assert not monitor.is_alive()
+
+
+def test_monitor_retries_failed_connection(monkeypatch):
+    monkeypatch.setattr(ir, 'RECONNECT_DELAY', 0.01)
+    pigpio = FakePigpio(connected=False)
+    monitor = IrMonitor(Queue(), 24, pigpio_module=pigpio)
+    monitor.start()
+    try:
+        _wait_for(lambda: len(pigpio.instances) >= 3)
+        pigpio.connected = True
+        _wait_for(lambda: monitor.receiver.connected)
+    finally:
+        monitor.stop()
+        monitor.join(timeout=5)
+
+
+def _decoder_frames(decoder, frames):
+    return [decoder.resolve(nec_frame(0x10, 0x20), repeat, gpio, timestamp=timestamp)
+            for gpio, repeat, timestamp in frames]
+
+
+def test_press_seen_by_more_pins_is_reported_once():
+    decoder = IrDecoder()
+    reported = _decoder_frames(decoder, [(25, False, 10.0), (24, False, 10.01), (24, True, 10.1), (25, True, 10.11)])
+    assert [code is not None for code, _repeat in reported] == [True, False, False, True]
+    assert decoder.stats == {'duplicates': 2}
+
+
+def test_pin_bound_press_is_reported_for_every_pin():
+    decoder = IrDecoder()
+    decoder.pin_bound = lambda code: code['data'] == '10ef20df'
+    reported = _decoder_frames(decoder, [(25, False, 10.0), (24, False, 10.01), (24, True, 10.1), (25, True, 10.11)])
+    # The hold stays with the pin that reported first
+    assert [(code is not None, gpio) for (code, _repeat), gpio in zip(reported, [25, 24, 24, 25])] == \
+        [(True, 25), (True, 24), (False, 24), (True, 25)]
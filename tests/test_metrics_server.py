@@ -0,0 +1,36 @@
+from metrics.histogram import Metrics
+from metrics.server import MetricsServer
+from time import monotonic, sleep
+from urllib.request import urlopen
+import json
+
+
+def test_close_right_after_start_does_not_block():
+    server = MetricsServer('127.0.0.1', 0, Metrics())
+    server.start()
+    thread = server.thread
+
+    start = monotonic()
+    server.close()
+    assert monotonic() - start < 2
+    assert not thread.is_alive()
+
+
+def test_serves_stats_until_closed():
+    metrics = Metrics()
+    metrics.observe('command', 0.01, key='play', target='moode')
+    server = MetricsServer('127.0.0.1', 0, metrics)
+    server.start()
+    thread = server.thread
+
+    deadline = monotonic() + 5
+    while not (server.server and server.server.server) and monotonic() < deadline:
+        sleep(0.01)
+    port = server.server.server.server_port
+
+    with urlopen(f'http://127.0.0.1:{port}/stats', timeout=5) as response:
+        stats = json.loads(response.read().decode('utf-8'))
+    assert stats['stages'][0]['stage'] == 'command'
+
+    server.close()
+    assert not thread.is_alive()
@@ -0,0 +1,41 @@
+from fake_pigpio import FakePigpio, nec_frame
+from input.event_queue import Queue
+from input.ir import IrMonitor
+from input.pulse_templates import PulseCollector, build_template
+from mpd_control import ControllerApp
+from types import SimpleNamespace
+from threading import Thread
+
+
+def test_setup_records_codes_and_pulse_templates():
+    queue = Queue(max_age=0)
+    pigpio = FakePigpio()
+    monitor = IrMonitor(queue, [24, 25], pigpio_module=pigpio)
+    collector = PulseCollector()
+    monitor.tracer = collector
+    monitor.start()
+
+    result = []
+    recorder = Thread(target=lambda: result.extend(ControllerApp.record_key(SimpleNamespace(event_queue=queue))),
+                      daemon=True)
+    try:
+        for _ in range(100):
+            if pigpio.instances and pigpio.last.callbacks:
+                break
+            monitor.wait(0.01)
+
+        recorder.start()
+        # Setup asks for every key twice
+        pigpio.last.send(24, nec_frame(0x10, 0x20))
+        pigpio.last.send(24, nec_frame(0x10, 0x20))
+        recorder.join(timeout=5)
+        assert not recorder.is_alive(), 'monitor thread died before delivering the key'
+    finally:
+        monitor.stop()
+        monitor.join(timeout=5)
+        queue.stop()
+
+    assert len(result) == 1
+    assert result[0]['data'] == '10ef20df'
+    assert len(collector.pulses_of(result[0])) == 2
+    assert build_template(collector.pulses_of(result[0]))
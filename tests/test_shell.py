@@ -0,0 +1,100 @@
+from handlers.base_handler import Singleton
+from handlers.shell import ShellCommandsHandler
+from time import monotonic, sleep
+import asyncio
+import logging
+
+
+def test_errors_of_background_commands_are_logged(caplog):
+    handler = ShellCommandsHandler()
+    func, args = handler.compile({'target': 'shell', 'command': '/nonexistent/script.sh', 'wait': False})
+
+    with caplog.at_level(logging.ERROR, logger='MoodeIrController.ShellCommandsHandler'):
+        func(args)
+        deadline = monotonic() + 5
+        while 'FileNotFoundError' not in caplog.text and monotonic() < deadline:
+            sleep(0.01)
+        assert 'FileNotFoundError' in caplog.text
+
+
+def test_errors_of_background_async_commands_are_logged(caplog):
+    handler = ShellCommandsHandler()
+    func, args = handler.compile({'target': 'shell', 'command': '/nonexistent/script.sh', 'wait': False})
+
+    async def _run():
+        await handler.execute_async(func, args)
+        await asyncio.gather(*handler._tasks, return_exceptions=True)
+
+    with caplog.at_level(logging.ERROR, logger='MoodeIrController.ShellCommandsHandler'):
+        asyncio.run(_run())
+        assert 'FileNotFoundError' in caplog.text
+
+
+def test_commands_run_in_order_by_default(tmp_path):
+    handler = ShellCommandsHandler()
+    log = tmp_path / 'order.log'
+    first, first_args = handler.compile({'target': 'shell', 'command': f'sh -c "sleep 0.2; echo 1 >> {log}"'})
+    second, second_args = handler.compile({'target': 'shell', 'command': f'sh -c "echo 2 >> {log}"'})
+
+    first(first_args)
+    second(second_args)
+
+    assert log.read_text().split() == ['1', '2']
+
+
+def _running(pid) -> bool:
+    # Killed children of a killed shell may be left as zombies until init reaps them
+    try:
+        with open(f'/proc/{pid}/stat', 'r') as stat:
+            return stat.read().rsplit(')', 1)[1].split()[0] != 'Z'
+    except FileNotFoundError:
+        return False
+
+
+def _wait_for_pid(pid_file) -> int:
+    deadline = monotonic() + 5
+    while not (pid_file.exists() and pid_file.read_text().strip()):
+        assert monotonic() < deadline, 'command did not start'
+        sleep(0.01)
+    return int(pid_file.read_text())
+
+
+def _assert_ended(pid):
+    deadline = monotonic() + 5
+    while _running(pid):
+        assert monotonic() < deadline, f'{pid} still running'
+        sleep(0.01)
+
+
+def test_timeout_kills_children_of_shell(tmp_path):
+    handler = ShellCommandsHandler()
+    pid_file = tmp_path / 'child.pid'
+    handler.call({'target': 'shell', 'command': f'sh -c "sleep 30 & echo $! > {pid_file}; wait"', 'timeout': 0.5})
+    _assert_ended(_wait_for_pid(pid_file))
+
+
+def test_async_timeout_kills_children_of_shell(tmp_path):
+    handler = ShellCommandsHandler()
+    pid_file = tmp_path / 'child.pid'
+    func, args = handler.compile({'target': 'shell', 'command': f'sh -c "sleep 30 & echo $! > {pid_file}; wait"',
+                                  'timeout': 0.5})
+    asyncio.run(handler.execute_async(func, args))
+    _assert_ended(_wait_for_pid(pid_file))
+
+
+def test_stop_terminates_running_commands(tmp_path):
+    handler = ShellCommandsHandler()
+    pid_file = tmp_path / 'child.pid'
+    log = tmp_path / 'order.log'
+    try:
+        handler.call({'target': 'shell', 'command': [f'sh -c "sleep 30 & echo $! > {pid_file}; wait"',
+                                                     f'sh -c "echo 2 >> {log}"'], 'wait': False})
+        pid = _wait_for_pid(pid_file)
+        handler.stop()
+        _assert_ended(pid)
+        sleep(0.2)
+        # Rest of the command list does not run
+        assert not log.exists()
+    finally:
+        # Stopped handler can't run commands - later tests get a new one
+        Singleton._instances.pop(ShellCommandsHandler, None)
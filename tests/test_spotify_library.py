@@ -0,0 +1,69 @@
+from handlers import spotify_library
+from handlers.spotify_library import ALBUM, SpotifyLibraryIndex
+
+
+class FakeSpotify(object):
+    """
+    Saved albums endpoint of spotipy - 'albums' are (id, added_at), newest first
+    """
+
+    def __init__(self, albums):
+        self.albums = albums
+        self.fetched = 0
+
+    def _page(self, offset, limit):
+        self.fetched += 1
+        items = [{'added_at': added_at, 'album': {'id': album_id, 'name': album_id, 'uri': f'spotify:album:{album_id}',
+                                                  'total_tracks': 10}}
+                 for album_id, added_at in self.albums[offset:offset + limit]]
+        more = offset + limit < len(self.albums)
+        return {'items': items, 'total': len(self.albums), 'offset': offset, 'limit': limit, 'next': more or None}
+
+    def current_user_saved_albums(self, limit):
+        return self._page(0, limit)
+
+    def next(self, page):
+        return self._page(page['offset'] + page['limit'], page['limit'])
+
+    def current_user_playlists(self, limit):
+        return {'items': [], 'total': 0, 'next': None}
+
+
+def _library(tmp_path, monkeypatch, albums):
+    monkeypatch.setattr(spotify_library, 'PAGE_LIMIT', 2)
+    spotify = FakeSpotify(albums)
+    library = SpotifyLibraryIndex(spotify, str(tmp_path / 'library.json'))
+    library.refresh()
+    spotify.fetched = 0
+    return library, spotify
+
+
+def test_unchanged_library_fetches_first_page_only(tmp_path, monkeypatch):
+    library, spotify = _library(tmp_path, monkeypatch, [('e', 5), ('d', 4), ('c', 3), ('b', 2), ('a', 1)])
+    assert library._refresh_albums() == 0
+    assert spotify.fetched == 1
+    assert list(library.items[ALBUM]) == ['e', 'd', 'c', 'b', 'a']
+
+
+def test_new_albums_in_front(tmp_path, monkeypatch):
+    library, spotify = _library(tmp_path, monkeypatch, [('c', 3), ('b', 2), ('a', 1)])
+    spotify.albums = [('e', 5), ('d', 4)] + spotify.albums
+    assert library._refresh_albums() == 2
+    assert spotify.fetched == 2
+    assert list(library.items[ALBUM]) == ['e', 'd', 'c', 'b', 'a']
+
+
+def test_album_removed_while_another_added(tmp_path, monkeypatch):
+    library, spotify = _library(tmp_path, monkeypatch, [('d', 4), ('c', 3), ('b', 2), ('a', 1)])
+    # Count stays the same
+    spotify.albums = [('e', 5), ('d', 4), ('c', 3), ('a', 1)]
+    assert library._refresh_albums() == 2
+    assert list(library.items[ALBUM]) == ['e', 'd', 'c', 'a']
+
+
+def test_removed_newest_album(tmp_path, monkeypatch):
+    library, spotify = _library(tmp_path, monkeypatch, [('d', 4), ('c', 3), ('b', 2), ('a', 1)])
+    spotify.albums = [('c', 3), ('b', 2), ('a', 1)]
+    assert library._refresh_albums() == 1
+    assert spotify.fetched == 1
+    assert list(library.items[ALBUM]) == ['c', 'b', 'a']
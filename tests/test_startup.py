@@ -0,0 +1,38 @@
+from os import path
+from subprocess import check_output
+import sys
+
+
+ROOT = path.dirname(path.dirname(path.realpath(__file__)))
+
+
+def test_threads_runtime_does_not_load_optional_modules():
+    loaded = check_output([sys.executable, '-c', 'import mpd_control, sys; print(" ".join(sorted(sys.modules)))'],
+                          cwd=ROOT).decode('utf-8').split()
+    for module in ['asyncio', 'spotipy', 'numpy', 'keyboard', 'pigpio', 'bottle']:
+        assert module not in loaded, f'{module} imported on startup'
+
+
+def test_input_monitors_do_not_load_asyncio():
+    script = '; '.join([
+        'import sys',
+        'from input.event_queue import Queue',
+        'from input.ir import IrMonitor',
+        'from input.usb_remote import UsbRemoteMonitor',
+        'from input.evdev_remote import EvdevRemoteMonitor',
+        'monitors = [IrMonitor(Queue(), 24), UsbRemoteMonitor(Queue(), "up"), EvdevRemoteMonitor(Queue(), "up")]',
+        'print("asyncio" in sys.modules)',
+    ])
+    assert check_output([sys.executable, '-c', script], cwd=ROOT).decode('utf-8').strip() == 'False'
+
+
+def test_numpy_is_loaded_only_for_keymaps_with_templates(tmp_path):
+    (tmp_path / 'keymaps').mkdir()
+    script = '; '.join([
+        'import mpd_control, sys',
+        'from types import SimpleNamespace',
+        f'mpd_control.DIR = {str(tmp_path)!r}',
+        'app = SimpleNamespace(config=SimpleNamespace(enable_ir_remote=True))',
+        'print(mpd_control.ControllerApp._build_pulse_matcher(app, ["default"], {}), "numpy" in sys.modules)',
+    ])
+    assert check_output([sys.executable, '-c', script], cwd=ROOT).decode('utf-8').split() == ['None', 'False']
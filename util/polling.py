@@ -0,0 +1,23 @@
+from time import monotonic, sleep
+from typing import Callable, Optional
+
+
+def wait_until(predicate: Callable[[], bool], timeout: float, initial_interval=0.05, max_interval=1.0) -> \
+        Optional[float]:
+    """
+    Poll predicate with exponential backoff - fast first probes, then at most every max_interval
+
+    :return: seconds it took for predicate to become true, None on timeout
+    """
+    start = monotonic()
+    interval = initial_interval
+    while True:
+        if predicate():
+            return monotonic() - start
+
+        remaining = timeout - (monotonic() - start)
+        if remaining <= 0:
+            return None
+
+        sleep(min(interval, remaining))
+        interval = min(interval * 2, max_interval)